@@ -0,0 +1,243 @@
+import argparse
+import hashlib
+import json
+import signal
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+
+from z3 import Context, And, FreshConst, parse_smt2_string, substitute
+from final.main_program import current_session, Invariant, Limits, UNKNOWN, UNROLL_DEPTH, encoding_named
+from final.finalfeatures import SynthesisSession, filter_model
+from final.cache import ResultCache
+from final.syntax.while_lang import parse
+
+
+# A verification / synthesis job in a picklable form: the program text, and P, Q and linv as
+# SMT-LIB formulas over the program variables, e.g. "(and (> x 0) (< x 10))"
+class Job:
+    def __init__(self, name, program: str, P: str = "true", Q: str = "true", linv: str | None = None,
+                 examples=(), timeout: float | None = None, rlimit: int | None = None,
+                 max_memory: int | None = None, unroll: int | str = UNROLL_DEPTH, encoding: str = "int"):
+        self.name = name
+        self.program = program
+        self.P = P
+        self.Q = Q
+        self.linv = linv
+        self.examples = list(examples)  # [{'input': {...}, 'output': {...}}, ...] with int values
+        self.timeout = timeout  # seconds
+        self.rlimit = rlimit  # z3 resource units per solver call
+        self.max_memory = max_memory  # megabytes
+        self.unroll = unroll  # loop unrolling depth of main_func, or "adaptive"
+        self.encoding = encoding  # of the integers: "int", "bv<bits>" or "bounded<bits>"
+
+    def __repr__(self):
+        return "<Job {0}>".format(self.name)
+
+
+# Outcome of one job: 'verified', 'refuted', 'timeout', 'unknown' (the solver gave up, error holds why) or 'error'
+class JobResult:
+    def __init__(self, name, status: str, seconds: float, program: str | None = None, error: str | None = None,
+                 assignment: dict | None = None, cached: bool = False, model: dict | None = None):
+        self.name = name
+        self.status = status
+        self.seconds = seconds
+        self.program = program  # the program tree after filling holes
+        self.error = error
+        self.assignment = assignment  # hole -> value, as text
+        self.model = model  # the model the holes were filled from (filter_model), or of a verify (Verdict.model)
+        self.cached = cached  # whether the result comes from the result cache
+
+    def __repr__(self):
+        return "<JobResult {0}: {1} ({2:.3f}s{3})>".format(self.name, self.status, self.seconds,
+                                                           ", cached" if self.cached else "")
+
+
+# aggregate numbers of a batch, updated while the results stream in
+class BatchStats:
+    def __init__(self):
+        self.submitted = 0
+        self.completed = 0
+        self.statuses = {}  # status -> number of jobs
+        self.job_seconds = 0.0  # sum of the time spent inside the workers
+        self.start = time.perf_counter()
+        self.end = None
+
+    def add(self, result: JobResult) -> None:
+        self.completed += 1
+        self.statuses[result.status] = self.statuses.get(result.status, 0) + 1
+        self.job_seconds += result.seconds
+        self.end = time.perf_counter()
+
+    @property
+    def wall_seconds(self) -> float:
+        return (self.end if self.end is not None else time.perf_counter()) - self.start
+
+    # jobs per wall-clock second
+    @property
+    def throughput(self) -> float:
+        return self.completed / self.wall_seconds if self.wall_seconds > 0 else 0.0
+
+    def __repr__(self):
+        return "<BatchStats {0}/{1} jobs {2} in {3:.2f}s, {4:.1f} jobs/s>".format(
+            self.completed, self.submitted, self.statuses, self.wall_seconds, self.throughput)
+
+
+# turns an SMT-LIB formula over the program variables into an invariant
+def smtlib_spec(text: str | None) -> Invariant:
+    if text is None:
+        return lambda env: True
+    if not text.lstrip().startswith("(assert"):
+        text = "(assert {0})".format(text)
+
+    def spec(env):
+        session = current_session()
+        decls, values = {}, []
+        for var, value in env.items():
+            value = value[0] if isinstance(value, tuple) else value
+            value = session.encoding.val(value, session.ctx) if isinstance(value, int) else session.formula(value)
+            decls[var] = FreshConst(value.sort(), var)  # the parser only accepts constants
+            values.append((decls[var], value))
+        return substitute(And(*parse_smt2_string(text, decls=decls, ctx=session.ctx)), *values)
+
+    return spec
+
+
+# raised in a worker when a job runs out of time
+class JobTimeout(Exception):
+    pass
+
+
+def _alarm(signum, frame):
+    raise JobTimeout()
+
+
+# runs one job in a fresh session (own z3 context), inside a worker process
+def run_job(job: Job, synthesize: bool) -> JobResult:
+    start = time.perf_counter()
+    timeout_ms = int(job.timeout * 1000) if job.timeout is not None else None
+    use_alarm = job.timeout is not None and hasattr(signal, "SIGALRM")
+    try:
+        if use_alarm:  # guards the python side; the solver calls are bounded by the z3 timeout
+            signal.signal(signal.SIGALRM, _alarm)
+            signal.setitimer(signal.ITIMER_REAL, job.timeout)
+        tree = parse(job.program)
+        if tree is None:
+            raise ValueError("syntax error")
+        P, Q, linv = smtlib_spec(job.P), smtlib_spec(job.Q), smtlib_spec(job.linv)
+        session = SynthesisSession(Context(), limits=Limits(timeout_ms, job.rlimit, job.max_memory),
+                                   encoding=encoding_named(job.encoding))
+        if synthesize:
+            verdict = session.main_func(tree, P, Q, linv, job.examples, job.unroll)
+        else:
+            verdict = session.verify(P, tree, Q, linv)
+        if verdict.status == UNKNOWN and verdict.reason in ("timeout", "canceled"):
+            return JobResult(job.name, "timeout", time.perf_counter() - start, str(tree))
+        assignment = model = None
+        if session.model is not None:
+            model = {name: str(value) for name, value in filter_model(session.model).items()}
+            assignment = {hole: value for hole, value in model.items()
+                          if hole.startswith("hole_") and not hole.startswith("hole_z3")}
+        elif verdict.model:  # the values verify found for the constants left free in the query
+            model = {name: str(value) for name, value in verdict.model.items()}
+        return JobResult(job.name, verdict.status, time.perf_counter() - start, str(tree), verdict.reason, assignment,
+                         model=model)
+    except JobTimeout:
+        return JobResult(job.name, "timeout", time.perf_counter() - start)
+    except Exception as e:
+        return JobResult(job.name, "error", time.perf_counter() - start, error=str(e))
+    finally:
+        if use_alarm:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+
+
+ENGINE_VERSION = 2  # part of the cache keys: increase it when a change of the verifier may change results
+
+
+# the cache key of a job: a hash of the engine version, its normalized program tree, specifications, examples,
+# unroll depth, encoding and of whether holes are filled. None for a program that does not parse, its error is
+# not cached
+def job_key(job: Job, synthesize: bool) -> str | None:
+    tree = parse(job.program)
+    if tree is None:
+        return None
+    specs = [None if text is None else " ".join(text.split()) for text in (job.P, job.Q, job.linv)]
+    content = json.dumps([ENGINE_VERSION, synthesize, str(tree), specs, job.examples, job.unroll, job.encoding],
+                         sort_keys=True)
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+# runs the jobs on a process pool and yields their results as they finish. With a cache, jobs whose result
+# is stored are answered without running them, and verified or refuted results are stored
+def run_batch(jobs, synthesize: bool, max_workers: int | None = None, stats: BatchStats | None = None,
+              cache: ResultCache | None = None):
+    stats = BatchStats() if stats is None else stats
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        futures, hits = {}, []
+        for job in jobs:
+            start = time.perf_counter()
+            key = None if cache is None else job_key(job, synthesize)
+            stored = None if key is None else cache.get(key)
+            if stored is not None:
+                hits.append(JobResult(job.name, stored["status"], time.perf_counter() - start, stored["program"],
+                                      stored["error"], stored["assignment"], True, stored.get("model")))
+            else:
+                futures[pool.submit(run_job, job, synthesize)] = (job, key)
+        stats.submitted += len(hits) + len(futures)
+        for result in hits:
+            stats.add(result)
+            yield result
+        for future in as_completed(futures):
+            job, key = futures[future]
+            try:
+                result = future.result()
+            except BrokenProcessPool as e:  # the worker died, e.g. out of memory
+                result = JobResult(job.name, "error", 0.0, error=str(e))
+            if key is not None and result.status in ("verified", "refuted"):
+                cache.put(key, {"status": result.status, "program": result.program, "error": result.error,
+                                "assignment": result.assignment, "model": result.model})
+            stats.add(result)
+            yield result
+
+
+# verifies many programs in parallel (like verify)
+def verify_batch(jobs, max_workers: int | None = None, stats: BatchStats | None = None,
+                 cache: ResultCache | None = None):
+    return run_batch(jobs, False, max_workers, stats, cache)
+
+
+# fills holes and verifies many programs in parallel (like main_func)
+def synthesize_batch(jobs, max_workers: int | None = None, stats: BatchStats | None = None,
+                     cache: ResultCache | None = None):
+    return run_batch(jobs, True, max_workers, stats, cache)
+
+
+DEFAULT_CACHE = ".verification-cache.sqlite"
+
+
+# python -m final.batch jobs.jsonl: runs the jobs of a file with one JSON object per line (the arguments of Job),
+# prints one JSON result per line and the batch statistics on stderr
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(prog="python -m final.batch", description="Verify or synthesize a batch of jobs.")
+    parser.add_argument("jobs", help="JSON lines file, one job per line")
+    parser.add_argument("--verify", action="store_true", help="verify the programs instead of filling their holes")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes (default: one per cpu)")
+    parser.add_argument("--cache", default=DEFAULT_CACHE, help="result cache file (default: %(default)s)")
+    parser.add_argument("--no-cache", action="store_true", help="run every job, without reading or writing the cache")
+    args = parser.parse_args(argv)
+    with open(args.jobs) as f:
+        jobs = [Job(**json.loads(line)) for line in f if line.strip()]
+    cache = None if args.no_cache else ResultCache(args.cache)
+    stats = BatchStats()
+    try:
+        for result in run_batch(jobs, not args.verify, args.workers, stats, cache):
+            print(json.dumps(vars(result)), flush=True)
+    finally:
+        if cache is not None:
+            cache.close()
+    print(stats, file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+"""
+Micro-benchmarks, run with: python -m final.benchmarks
+Each benchmark prints the time per call of the old and the new code path.
+"""
+import json
+import os
+import tempfile
+import timeit
+
+from z3 import And
+
+from final.main_program import break_while_to_ifs, TermCache, VerificationSession
+from final.finalfeatures import SynthesisSession, stream
+from final.passive_form import to_passive, verify_passive, verify_havoc
+from final.partial_eval import residual_program
+from final.streaming import JsonlExamples
+from final.syntax.tree import TreeInterner
+from final.syntax.while_lang import WhileParser, parse, shared_parser
+
+PROGRAMS = [
+    "x := 1",
+    "x := ??; if (y - x) > 10 then z := 5 else z := 6",
+    "a := [ 1, 4, 5]; x := 0; while x < 3 do (a[x] := a[x] + 1; x := x + 1); y := a[0]; assert y = 2",
+]
+
+
+def report(name: str, old_seconds: float, new_seconds: float) -> None:
+    print("{0:<40} old {1:9.1f} us   new {2:9.1f} us   saved {3:9.1f} us/call".format(
+        name, old_seconds * 1e6, new_seconds * 1e6, (old_seconds - new_seconds) * 1e6))
+
+
+# parse() used to build a WhileParser (lexer regex + grammar) on every call
+def bench_parser_cache(number: int = 200) -> None:
+    report("WhileParser construction", timeit.timeit(WhileParser, number=number) / number, 0.0)
+    for program in PROGRAMS:
+        old = timeit.timeit(lambda: WhileParser()(program), number=number) / number
+        new = timeit.timeit(lambda: parse(program), number=number) / number
+        report("parse %d tokens" % len(program.split()), old, new)
+
+
+# a While program of n assignments
+def long_program(n: int) -> str:
+    return "; ".join("x{0} := x{0} + {0}".format(i) for i in range(n))
+
+
+# parse time per statement of growing programs, up to about 10k tokens. The chart lookups are constant time and
+# statement lists are left recursive (S -> S ; S1), so the time per statement stays flat
+def bench_parser_scaling(sizes=(100, 200, 400, 800, 1600)) -> None:
+    for n in sizes:
+        program = long_program(n)
+        seconds = timeit.timeit(lambda: parse(program), number=1)
+        print("parse {0:>5} statements {1:>6} tokens {2:9.3f} s   {3:9.1f} us/statement".format(
+            n, len(list(shared_parser().tokenizer(program))), seconds, seconds / n * 1e6))
+
+
+# hashing a loop unrolled ten times: a Tree hashes all of its nodes on every call, an interned tree keeps its hash
+def bench_tree_hash(number: int = 200) -> None:
+    tree = break_while_to_ifs(parse(PROGRAMS[2]))
+    frozen = TreeInterner().intern(tree)
+    report("hash of an unrolled loop", timeit.timeit(lambda: hash(tree), number=number) / number,
+           timeit.timeit(lambda: hash(frozen), number=number) / number)
+
+
+# adding the constraints of many I/O examples, without and with the term cache of the session
+def bench_term_cache(examples: int = 40) -> None:
+    program = ("a := [" + ", ".join(str(i) for i in range(30)) + "]; b := [[1, 2], [3, 4]]; c := ??; "
+               "x := (a[c] + (b[1][0] * c)) + y")
+    ios = [{'input': {'y': i}, 'output': {'x': i + 12}} for i in range(examples)]
+    seconds = []
+    for maxsize in (0, 4096):
+        session = SynthesisSession()
+        session.terms = TermCache(maxsize)
+        tree = parse(program)
+        session.detect_holes(tree)
+        seconds.append(timeit.timeit(lambda: session.add_constraints(tree, None, lambda env: True, None, ios),
+                                     number=1) / examples)
+    report("constraints of one example ({0})".format(session.terms), *seconds)
+
+
+# the constraint of one example of a loop over an array: the passive form of the unrolled program
+# against its partial evaluation on the input, and the size of both
+def bench_partial_eval(examples: int = 20) -> None:
+    program = ("a := [0, 0, 0, 0, 0, 0, 0, 0]; i := 0; while i < 8 do (a[i] := a[i] + (i * y); i := i + 1); "
+               "x := a[7] + ??")
+    seconds, sizes = [], []
+    for translate in (to_passive, residual_program):
+        with SynthesisSession() as session:
+            tree = parse(program)
+            session.detect_holes(tree)
+            tree = break_while_to_ifs(tree)
+            seconds.append(timeit.timeit(lambda: [translate(tree, lambda env: True, {'y': y})
+                                                  for y in range(examples)], number=1) / examples)
+            sizes.append(len(translate(tree, lambda env: True, {'y': 1}).definitions))
+    report("example of an unrolled loop ({0} -> {1} definitions)".format(*sizes), *seconds)
+
+
+# synthesis of a loop that runs at most 3 times (by P): ten copies of its body against the adaptive depth
+def bench_unroll(number: int = 5) -> None:
+    program = "i := 0; s := 0; while i < n do (s := s + (i * ??); i := i + 1); x := s + y"
+    P = lambda env: And(env['n'] >= 0, env['n'] <= 3)
+    ios = [{'input': {'n': n, 'y': y}, 'output': {'x': y + 2 * n * (n - 1) // 2}} for n in range(4) for y in range(3)]
+    seconds = []
+    for unroll in (10, "adaptive"):
+        run = lambda: SynthesisSession().main_func(parse(program), P, lambda env: True, lambda env: True, ios,
+                                                   unroll=unroll)
+        seconds.append(timeit.timeit(run, number=number) / number)
+    report("synthesis of a loop of at most 3 iterations", *seconds)
+
+# the phases of main_func (session.timings) against the same work done the old way:
+# the examples checked twice in a solver of their own, and the verification in a new session
+def bench_phases(examples: int = 20) -> None:
+    program = "x := ??; if (y - x) > 10 then z := 5 else z := 6"
+    ios = [{'input': {'y': y}, 'output': {'z': 5 if y - 7 > 10 else 6}} for y in range(examples)]
+    P, Q = lambda env: True, lambda env: True
+    session = SynthesisSession()
+    session.main_func(parse(program), P, Q, None, ios)
+
+    solver = session.new_solver()
+    solver.add(*[constraint for _, constraint in session.examples])
+    solve = timeit.timeit(lambda: (solver.check(), solver.model(), solver.check(), solver.model()), number=1)
+    verify = timeit.timeit(lambda: verify_passive(P, break_while_to_ifs(parse("x := 7; if (y - x) > 10 then z := 5 "
+                                                                           "else z := 6")), Q, None), number=1)
+    report("solve holes ({0} examples)".format(examples), solve, session.timings["solve"])
+    report("verify filled program", verify, session.timings["verify"])
+
+
+# a loop verified with its invariant: one quantified formula against the quantifier-free checks
+def bench_havoc(number: int = 5) -> None:
+    tree = parse("i := 0; s := 0; while i < n do (s := s + i; i := i + 1); assert s >= 0")
+    P = lambda env: env['n'] >= 0
+    Q = lambda env: And(env['i'] == env['n'], env['s'] >= 0)
+    linv = lambda env: And(env['i'] >= 0, env['i'] <= env['n'], env['s'] >= 0)
+    report("verify a loop with its invariant",
+           timeit.timeit(lambda: VerificationSession().verify(P, tree, Q, linv), number=number) / number,
+           timeit.timeit(lambda: verify_havoc(P, tree, Q, linv), number=number) / number)
+
+
+# holes filled from a file of examples: all of them given to the solver, against the streamed sample and passes
+def bench_stream(rows: int = 2000) -> None:
+    program = "if x > ?? then y := (x * ??) + ?? else y := x * ??"
+    true = lambda env: True
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "io.jsonl")
+        with open(path, "w") as f:
+            for k in range(rows):
+                x = (k * 37) % 2001 - 1000
+                f.write(json.dumps({'input': {'x': x}, 'output': {'y': 3 * x + 7 if x >= 0 else -x}}) + "\n")
+        examples = JsonlExamples(path)
+        report("fill holes from {0} examples".format(rows),
+               timeit.timeit(lambda: SynthesisSession().main_func(parse(program), true, true, true, list(examples)),
+                             number=1),
+               timeit.timeit(lambda: stream(parse(program), true, true, true, examples), number=1))
+
+
+if __name__ == "__main__":
+    bench_parser_cache()
+    bench_parser_scaling()
+    bench_tree_hash()
+    bench_term_cache()
+    bench_partial_eval()
+    bench_unroll()
+    bench_phases()
+    bench_havoc()
+    bench_stream()
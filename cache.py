@@ -0,0 +1,69 @@
+import json
+import sqlite3
+import time
+
+
+# A persistent cache of job results in a SQLite file, keyed by the content of a job (see batch.job_key).
+# The values are JSON objects; when they take more than max_bytes, the least recently used entries are evicted
+class ResultCache:
+    def __init__(self, path: str, max_bytes: int = 64 * 2 ** 20):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("PRAGMA journal_mode=WAL")  # one write per lookup, without a sync of the file
+        self.connection.execute("CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+                                "size INTEGER NOT NULL, used REAL NOT NULL)")
+        self.connection.commit()
+
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+
+    def __repr__(self):
+        return "<ResultCache {0}: {1} entries, {2} hits, {3} misses>".format(self.path, len(self), self.hits,
+                                                                           self.misses)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self) -> None:
+        self.connection.close()
+
+    # the value stored for the key, or None
+    def get(self, key: str) -> dict | None:
+        row = self.connection.execute("SELECT value FROM results WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        with self.connection:
+            self.connection.execute("UPDATE results SET used = ? WHERE key = ?", (time.time(), key))
+        return json.loads(row[0])
+
+    def put(self, key: str, value: dict) -> None:
+        text = json.dumps(value)
+        with self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)",
+                                    (key, text, len(text), time.time()))
+            self.evict()
+
+    # removes the least recently used entries until the values take at most max_bytes
+    def evict(self) -> None:
+        excess = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0] - self.max_bytes
+        if excess <= 0:
+            return
+        evicted = []
+        for key, size in self.connection.execute("SELECT key, size FROM results ORDER BY used"):
+            if excess <= 0:
+                break
+            evicted.append((key,))
+            excess -= size
+        self.connection.executemany("DELETE FROM results WHERE key = ?", evicted)
+
+    def clear(self) -> None:
+        with self.connection:
+            self.connection.execute("DELETE FROM results")
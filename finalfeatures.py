@@ -1,50 +1,326 @@
 import ast
+import time
 
-from final.main_program import upd, OP, parse_num_list, eval_expr, verify, wp,break_while_to_ifs, Formula, PVar, Env, Invariant
+from final.main_program import (upd, OP, parse_num_list, eval_expr, verify, break_while_to_ifs, find_holes, Formula,
+                                PVar, Env, Invariant, VerificationSession, current_session, invalidate_analysis,
+                                count_loops, UnrollReport, UNROLL_DEPTH, MAX_UNROLL, Limits, Verdict, SolverUnknown,
+                                UNKNOWN, IntEncoding)
 from z3 import *
 from final.syntax.tree import Tree
-hole_counter = 0  # holds the number of holes
+from final.passive_form import verify_passive, find_counterexample, cut_loops
+from final.partial_eval import residual_program
+from final.streaming import Deduplicator, stratified_sample, signature
 from final.syntax.while_lang import parse
 
+
+# Owns the hole counter and the examples of one synthesis request, next to the verification state
+# (context, solver) it inherits from VerificationSession. One solver holds the hole index definitions
+# and the examples, the verification runs in a frame pushed on top of them
+class SynthesisSession(VerificationSession):
+    def __init__(self, ctx: Context | None = None, timeout: int | None = None, limits: Limits | None = None,
+                 encoding: IntEncoding | None = None):
+        super().__init__(ctx, timeout, limits, encoding)
+        self.holes_solver = self.solver  # contains all holes constraints
+        self.hole_counter = 0  # holds the number of holes
+        self.unrolling = None  # UnrollReport of the last main_func
+        self.examples = []  # (io, constraint) of the examples asserted
+        self.model = None  # model of the holes constraints, until examples are added or retracted
+        self.hole_ranges = []  # the range constraints of the holes in a bounded encoding
+
+    # find holes in the tree's nodes, and numbers them
+    def detect_holes(self, initial: Tree):
+        if initial.root == "hole":
+            hole_id = self.encoding.var(f"hole_{self.hole_counter}", self.ctx)
+            self.hole_ranges.extend(self.encoding.ranges([hole_id]))
+            self.holes_solver.add(*self.encoding.ranges([hole_id]))
+            initial.root = hole_id
+            initial.info = None
+            self.hole_counter += 1
+        else:
+            for subtree in initial.subtrees[:4]:
+                self.detect_holes(subtree)
+            invalidate_analysis(initial)
+
+    # using wp calculator, we add all constraints of holes in the code
+    def add_constraints(self, tree: Tree, P, Q, linv, examples, unroll: int | list = UNROLL_DEPTH) -> None:
+        with self, self.phase("constraints"):
+            modified_tree = break_while_to_ifs(tree, unroll)
+            for io in examples:
+                self.add_example(example_constraint(modified_tree, Q, linv, io), io)
+
+    # asserts the constraint of an example. The examples stay at the base level of the solver (not in a
+    # pushed scope), so that the first check can use z3's non-incremental solver and its models
+    def add_example(self, constraint: Formula, io) -> None:
+        self.holes_solver.add(constraint)
+        self.examples.append((io, constraint))
+        self.model = None
+
+    # drops an example: the solver is refilled with the hole index definitions and the constraints
+    # of the other examples, which are kept and not rebuilt
+    def retract_example(self, io) -> None:
+        self.examples = [(example, constraint) for example, constraint in self.examples if example is not io]
+        self.solver = self.holes_solver = self.new_solver()
+        self.holes_solver.add(*self.index_definitions, *self.hole_ranges,
+                              *[constraint for _, constraint in self.examples])
+        self.model = None
+
+    # checks the holes constraints once, the model is kept until examples are added or retracted
+    def solve(self, limits: Limits | None = None) -> ModelRef:
+        if self.model is None:
+            with self.phase("solve"):
+                self.last_result = self.race(self.holes_solver, limits)
+            if self.last_result == unknown:
+                raise SolverUnknown(self.reason_of(self.holes_solver))
+            if self.last_result != sat:
+                raise ValueError("cannot fill holes")
+            self.model = self.model_of(self.holes_solver)
+        return self.model
+
+    # check if holes can be filled correctly
+    def check_solver(self) -> ModelRef | None:
+        return self.solve()
+
+    # checks if holes can be filled, and fills them
+    def check_fill(self, tree: Tree, limits: Limits | None = None):
+        filtered = filter_model(self.solve(limits))
+        fill_assignments(filtered, tree)
+
+    # counterexample guided synthesis: starts from a few examples and adds only the examples
+    # (or spec counterexamples) that the current hole values fail on
+    def cegis(self, tree: Tree, P: Invariant, Q: Invariant, linv: Invariant, examples, initial_examples: int = 1,
+              max_iterations: int = 100, unroll: int = UNROLL_DEPTH) -> "CegisResult":
+        with self:
+            self.detect_holes(tree)
+            modified_tree = break_while_to_ifs(tree, unroll)
+            holes = find_holes(modified_tree)
+            result = CegisResult()
+            solver = self.new_solver()
+            pending = list(examples)
+            for io in pending[:initial_examples]:
+                result.examples.append(io)
+                solver.add(example_constraint(modified_tree, Q, linv, io))
+            pending = pending[initial_examples:]
+
+            while result.iterations < max_iterations:
+                start = time.perf_counter()
+                self.last_result = self.check(solver)
+                if self.last_result == unsat:
+                    raise ValueError("cannot fill holes")
+                if self.last_result == unknown:
+                    result.reason = self.reason_of(solver)
+                    return result
+                candidate = {hole: self.encoding.number(value)
+                             for hole, value in propose_holes(self.model_of(solver), holes, solver.ctx).items()}
+                solved = time.perf_counter()
+
+                filled = modified_tree.clone()
+                fill_assignments(candidate, filled)
+                counterexample = None
+                for io in pending:  # first the given examples, they are cheap to run with concrete inputs
+                    if not holds(example_constraint(filled, Q, linv, io)):
+                        counterexample = io
+                        pending.remove(io)
+                        break
+                if counterexample is None:
+                    try:
+                        cex_input = find_counterexample(P, filled, Q, linv)
+                    except SolverUnknown as e:
+                        result.reason = e.reason
+                        return result
+                    if cex_input is not None:
+                        counterexample = {'input': cex_input, 'output': {}}
+                result.rounds.append((solved - start, time.perf_counter() - solved))
+
+                if counterexample is None:
+                    fill_assignments(candidate, tree)
+                    result.verified = True
+                    result.assignment = candidate
+                    return result
+                result.examples.append(counterexample)
+                solver.add(example_constraint(modified_tree, Q, linv, counterexample))
+            return result
+
+    # synthesis from a stream of examples too large to hold (e.g. streaming.JsonlExamples, read again on every
+    # pass): the holes are solved on a sample of sample_size examples of different signatures, then every pass
+    # over the stream checks the hole values on all the examples and adds at most batch_size that fail, until
+    # a pass finds none and the filled program is verified. At most max_examples are asserted
+    def stream(self, tree: Tree, P: Invariant, Q: Invariant, linv: Invariant, examples, sample_size: int = 16,
+               batch_size: int = 8, max_examples: int = 256, max_passes: int = 50, unroll: int = UNROLL_DEPTH,
+               limits: Limits | None = None) -> "StreamResult":
+        with self:
+            self.detect_holes(tree)
+            modified_tree = break_while_to_ifs(tree, unroll)
+            holes = find_holes(modified_tree)
+            self.unrolling = UnrollReport([unroll] * count_loops(tree))
+            result = StreamResult()
+            dedup = Deduplicator()
+            with self.phase("constraints"):
+                for io in stratified_sample(examples, sample_size, dedup):
+                    self.add_example(example_constraint(modified_tree, Q, linv, io), io)
+            result.duplicates = dedup.duplicates
+            while True:
+                try:
+                    model = self.solve(limits)
+                except SolverUnknown as e:
+                    result.verdict = Verdict(UNKNOWN, e.reason, [("synthesis", UNKNOWN, e.reason)])
+                    return result
+                candidate = {hole: self.encoding.number(value)
+                             for hole, value in propose_holes(model, holes, self.ctx).items()}
+                filled = modified_tree.clone()
+                fill_assignments(candidate, filled)
+                with self.phase("check"):
+                    failing = failing_examples(filled, Q, linv, examples, batch_size, result)
+                result.passes += 1
+                if not failing:
+                    break
+                if len(self.examples) + len(failing) > max_examples or result.passes >= max_passes:
+                    reason = "no hole values found within {0} examples and {1} passes".format(max_examples, max_passes)
+                    result.verdict = Verdict(UNKNOWN, reason, [("synthesis", UNKNOWN, reason)])
+                    return result
+                with self.phase("constraints"):
+                    for io in failing:
+                        self.add_example(example_constraint(modified_tree, Q, linv, io), io)
+            fill_assignments(candidate, tree)
+            result.assignment = candidate
+            result.examples = [io for io, _ in self.examples]
+            result.verdict = self.verify_unrolled(P, tree, Q, linv, limits)
+            return result
+
+    # Main Function. Loops are unrolled unroll times, or with unroll="adaptive" as deep as the examples and
+    # P need (up to max_unroll), the depths are reported in self.unrolling. limits apply to the solver calls
+    # of this request instead of the session's limits
+    def main_func(self, tree: Tree, P: Invariant, Q: Invariant, linv: Invariant, examples,
+                  unroll: int | str = UNROLL_DEPTH, max_unroll: int = MAX_UNROLL,
+                  limits: Limits | None = None) -> Verdict:
+        with self:
+            self.detect_holes(tree)
+            try:
+                if unroll == "adaptive":
+                    self.unrolling = self.deepen(tree, P, Q, linv, examples, max_unroll)
+                else:
+                    self.unrolling = UnrollReport([unroll] * count_loops(tree))
+                    self.add_constraints(tree, P, Q, linv, examples, unroll)
+                    self.check_fill(tree, limits)
+                    self.check_solver()
+            except SolverUnknown as e:
+                return Verdict(UNKNOWN, e.reason, [("synthesis", UNKNOWN, e.reason)])
+            return self.verify_unrolled(P, tree, Q, linv, limits)
+
+    # verifies the program with its holes filled, in a frame of the solver that is popped afterwards
+    def verify_filled(self, P: Invariant, tree: Tree, Q: Invariant, linv: Invariant,
+                      unroll: int | list = UNROLL_DEPTH, limits: Limits | None = None) -> Verdict:
+        with self, self.phase("verify"):
+            definitions = self.push()
+            try:
+                return verify_passive(P, break_while_to_ifs(tree, unroll), Q, linv, session=self, limits=limits)
+            finally:
+                self.pop(definitions)
+
+    # the last rung of the retry ladder: when the solver gives up on the filled program, it is verified
+    # again with its loops unrolled half as deep, down to depth 1. self.unrolling keeps the depths used
+    def verify_unrolled(self, P: Invariant, tree: Tree, Q: Invariant, linv: Invariant,
+                        limits: Limits | None = None) -> Verdict:
+        depths = list(self.unrolling.depths)
+        verdict = self.verify_filled(P, tree, Q, linv, depths, limits)
+        attempts = list(verdict.attempts)
+        while verdict.status == UNKNOWN and any(depth > 1 for depth in depths):
+            depths = [max(1, depth // 2) for depth in depths]
+            verdict = self.verify_filled(P, tree, Q, linv, depths, limits)
+            attempts.extend(("{0} at depths {1}".format(step, depths), status, reason)
+                            for step, status, reason in verdict.attempts)
+            self.unrolling = UnrollReport(depths, self.unrolling.cut)
+        return Verdict(verdict.status, verdict.reason, attempts)
+
+    # adaptive unrolling: every loop starts at depth 1, and the loops that are cut off on an example (under the
+    # hole values found) or on an input satisfying P are unrolled deeper, until the result no longer depends on
+    # the depths. The constraints of each depth are added in a scope of the holes solver that is
+    # popped before the next depth. Fills the holes of tree
+    def deepen(self, tree: Tree, P: Invariant, Q: Invariant, linv: Invariant, examples,
+               max_unroll: int) -> UnrollReport:
+        depths = [1] * count_loops(tree)
+        while True:
+            unrolled = break_while_to_ifs(tree, depths)
+            cutoffs = []
+            definitions = self.push()
+            try:
+                with self.phase("constraints"):
+                    for io in examples:
+                        self.holes_solver.add(example_constraint(unrolled, Q, linv, io, cutoffs))
+                with self.phase("solve"):
+                    self.last_result = self.race(self.holes_solver)
+                if self.last_result == unknown:
+                    raise SolverUnknown(self.reason_of(self.holes_solver))
+                if self.last_result == sat:
+                    model = self.model_of(self.holes_solver)
+                    assignment = filter_model(model)
+                    cutoffs = [(index, remaining) for index, reached, remaining in cutoffs
+                               if is_true(model.eval(self.formula(reached), model_completion=True))]
+                else:  # a deeper unrolling may make the examples satisfiable
+                    assignment = None
+                    cutoffs = [(index, remaining) for index, reached, remaining in cutoffs
+                               if not is_false(simplify(self.formula(reached)))]
+            finally:
+                self.pop(definitions)
+            if not cutoffs and assignment is not None:
+                filled = unrolled.clone()
+                fill_assignments(assignment, filled)
+                cutoffs = [(index, None) for index in cut_loops(P, filled, linv)]
+            deeper = {}  # loop number -> new depth: as many iterations as a known run needs, twice as deep otherwise
+            for index, remaining in cutoffs:
+                depth = depths[index] + remaining if remaining is not None else 2 * depths[index]
+                deeper[index] = min(max(depth, deeper.get(index, 0)), max_unroll)
+            if all(depth == depths[index] for index, depth in deeper.items()):
+                if assignment is None:
+                    raise ValueError("cannot fill holes")
+                fill_assignments(assignment, tree)
+                return UnrollReport(depths, set(deeper))
+            for index, depth in deeper.items():
+                depths[index] = depth
+
+
+# The session of the step-by-step functions below (detect_holes, add_constraints, check_solver) when no session
+# is active. They share its state on purpose, each call builds on the earlier ones: the hole counter, the
+# examples and the solver's assertions keep growing across calls, unrelated programs included. Run unrelated
+# requests in their own session (with SynthesisSession(): ...), or start over with reset_default_session()
+default_session = SynthesisSession(main_ctx())
+
+
+# drops the state of the step-by-step functions, returns the new default session
+def reset_default_session() -> SynthesisSession:
+    global default_session
+    default_session = SynthesisSession(main_ctx())
+    return default_session
+
+
+# the innermost active synthesis session, or the default one
+def synthesis_session() -> SynthesisSession:
+    session = current_session()
+    return session if isinstance(session, SynthesisSession) else default_session
+
+
 # find holes in the tree's nodes, and numbers them
 def detect_holes(initial: Tree):
-    global hole_counter
-    if initial.root == "hole":
-        hole_id = Int(f"hole_{hole_counter}")
-        initial.root = hole_id
-        hole_counter += 1
-    else:
-        if len(initial.subtrees) >= 1:
-            detect_holes(initial.subtrees[0])
-        if len(initial.subtrees) >= 2:
-            detect_holes(initial.subtrees[1])
-        if len(initial.subtrees) >= 3:
-            detect_holes(initial.subtrees[2])
-        if len(initial.subtrees) >= 4:
-            detect_holes(initial.subtrees[3])
+    synthesis_session().detect_holes(initial)
 
 
-holes_solver = Solver()  # contains all holes constraints
+# using wp calculator, we add all constraints of holes in the code
+def add_constraints(tree: Tree, P, Q, linv, examples, unroll: int | list = UNROLL_DEPTH) -> None:
+    synthesis_session().add_constraints(tree, P, Q, linv, examples, unroll)
 
 
-# using wp calculator, we add all constraints of holes in the code
-def add_constraints(tree: Tree, P, Q, linv, examples) -> None:
-    global holes_solver
-    modified_tree = break_while_to_ifs(tree)
-    for io in examples:
-        env = io['input']
-        Q_out = lambda e: And(Q(e), *[e[key] == value for key, value in io['output'].items()])
-        wp_prop = wp(Q_out, modified_tree, linv, env)
-        holes_solver.add(wp_prop(env))
+# the constraint a single I/O example puts on the holes of a loop-free program,
+# the paths on which an unrolled loop is cut off are added to cutoffs when it is given
+def example_constraint(tree: Tree, Q, linv, io, cutoffs: list | None = None) -> Formula:
+    Q_out = lambda e: And(current_session().formula(Q(e)), *[e[key] == value for key, value in io['output'].items()])
+    program = residual_program(tree, linv, io['input'])
+    if cutoffs is not None:
+        cutoffs.extend(program.cutoffs)
+    return And(*program.definitions, *program.goal(Q_out))
 
 
 # check if holes can be filled correctly
 def check_solver() -> ModelRef | None:
-    global holes_solver
-    if holes_solver.check() == unsat:
-        raise ValueError("cannot fill holes")
-    else:
-        return holes_solver.model()
+    return synthesis_session().check_solver()
 
 
 # fill values for holes
@@ -52,9 +328,11 @@ def fill_assignments(assign, tree: Tree):
     if str(tree.root) in assign:
         tree.subtrees = [Tree(str(assign[str(tree.root)]))]
         tree.root = "num"
+        tree.info = None
     else:
         for subtree in tree.subtrees:
             fill_assignments(assign, subtree)
+        invalidate_analysis(tree)
 
 
 # cleans model from unnecessary assignments
@@ -63,7 +341,8 @@ def filter_model(model: ModelRef) -> dict:
     for decl in model.decls():
         name = decl.name()
         if not name.startswith("k!"):  # Ignore identifiers starting with "k!"
-            filtered_assignments[name] = model[decl]
+            value = model[decl]  # bit-vectors are filled in as signed numbers
+            filtered_assignments[name] = value.as_signed_long() if is_bv_value(value) else value
         else:
             filtered_assignments[name] = name[2:]
     return filtered_assignments
@@ -71,21 +350,106 @@ def filter_model(model: ModelRef) -> dict:
 
 # checks if holes can be filled, and fills them
 def check_fill(tree: Tree):
-    global holes_solver
-    if holes_solver.check() == unsat:
-        raise ValueError("cannot fill holes")
-    else:
-        assignments = holes_solver.model()
-        filtered = filter_model(assignments)
-        fill_assignments(filtered, tree)
+    synthesis_session().check_fill(tree)
+
+
+# result of a CEGIS run: hole values, the examples that were needed and the time of every round
+class CegisResult:
+    def __init__(self):
+        self.verified = False
+        self.assignment = {}  # hole name -> value
+        self.examples = []  # the examples added to the solver, including counterexamples
+        self.rounds = []  # (solver seconds, verification seconds) per iteration
+        self.reason = None  # why the solver gave up, when it did
+
+    @property
+    def iterations(self) -> int:
+        return len(self.rounds)
+
+    def __repr__(self):
+        return "<CegisResult verified={0} iterations={1} examples={2} holes={3}>".format(
+            self.verified, self.iterations, len(self.examples), self.assignment)
+
+
+# result of a synthesis from a stream of examples: the verdict of the filled program, the hole values, the
+# examples asserted, the passes over the stream, the examples checked and the duplicates dropped
+class StreamResult:
+    def __init__(self):
+        self.verdict = None
+        self.assignment = {}  # hole name -> value
+        self.examples = []
+        self.passes = 0
+        self.checked = 0
+        self.duplicates = 0
+
+    @property
+    def verified(self) -> bool:
+        return bool(self.verdict)
+
+    def __repr__(self):
+        return "<StreamResult {0} passes={1} examples={2} holes={3}>".format(
+            self.verdict, self.passes, len(self.examples), self.assignment)
+
+
+# one pass over a stream with the holes filled: at most batch_size examples the program fails on, one of
+# every signature first, from the failures found before batch_size signatures are (or a window of
+# 4 * batch_size failures is full). Duplicates are checked once
+def failing_examples(filled: Tree, Q: Invariant, linv: Invariant, examples, batch_size: int,
+                     result: StreamResult) -> list:
+    failing, others, signatures = [], [], set()
+    dedup = Deduplicator()
+    for io in examples:
+        if not dedup.fresh(io):
+            continue
+        result.checked += 1
+        if holds(example_constraint(filled, Q, linv, io)):
+            continue
+        key = signature(io)
+        if key not in signatures:
+            signatures.add(key)
+            failing.append(io)
+        else:
+            others.append(io)
+        if len(failing) == batch_size or len(others) == 4 * batch_size:
+            break
+    return (failing + others)[:batch_size]
+
+
+# checks a constraint that (usually) has no unknowns left, falls back to the solver otherwise
+def holds(constraint: Formula) -> bool:
+    simplified = simplify(constraint)
+    if is_true(simplified) or is_false(simplified):
+        return is_true(simplified)
+    session = current_session()
+    solver = session.new_solver()
+    solver.add(simplified)
+    return session.check(solver) == sat  # unknown counts as failing, the example is then added to the solver
+
+
+# proposes values for all holes from a model of the holes constraints (unconstrained holes default to 0)
+def propose_holes(model: ModelRef, holes: set[str], ctx: Context) -> dict:
+    encoding = current_session().encoding
+    return {hole: model.eval(encoding.var(hole, ctx), model_completion=True) for hole in holes}
+
+
+# counterexample guided synthesis (in a fresh session)
+def cegis(tree: Tree, P: Invariant, Q: Invariant, linv: Invariant, examples, initial_examples: int = 1,
+          max_iterations: int = 100, unroll: int = UNROLL_DEPTH, encoding: IntEncoding | None = None) -> CegisResult:
+    return SynthesisSession(encoding=encoding).cegis(tree, P, Q, linv, examples, initial_examples, max_iterations,
+                                                     unroll)
 
 
-# Main Function
-def main_func(tree: Tree, P: Invariant, Q: Invariant, linv: Invariant, examples) -> bool:
-    detect_holes(tree)
-    add_constraints(tree, P, Q, linv, examples)
-    check_fill(tree)
-    check_solver()
-    return verify(P, break_while_to_ifs(tree), Q, linv)
+# synthesis from a stream of examples (in a fresh session)
+def stream(tree: Tree, P: Invariant, Q: Invariant, linv: Invariant, examples, sample_size: int = 16,
+           batch_size: int = 8, max_examples: int = 256, max_passes: int = 50, unroll: int = UNROLL_DEPTH,
+           limits: Limits | None = None, encoding: IntEncoding | None = None) -> StreamResult:
+    return SynthesisSession(limits=limits, encoding=encoding).stream(tree, P, Q, linv, examples, sample_size,
+                                                                     batch_size, max_examples, max_passes, unroll,
+                                                                     limits)
 
 
+# Main Function (in a fresh session)
+def main_func(tree: Tree, P: Invariant, Q: Invariant, linv: Invariant, examples,
+              unroll: int | str = UNROLL_DEPTH, max_unroll: int = MAX_UNROLL, limits: Limits | None = None,
+              encoding: IntEncoding | None = None) -> Verdict:
+    return SynthesisSession(limits=limits, encoding=encoding).main_func(tree, P, Q, linv, examples, unroll, max_unroll)
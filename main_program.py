@@ -1,16 +1,20 @@
 import typing
 import operator
-from z3 import (Int, IntVal, ForAll, simplify, Implies, Not, And, Or, Solver, unsat, Ast, Array, IntSort, K, Sort,
-                Store, Select)
+import itertools
+import contextlib
+import time
+from collections import OrderedDict
+from z3 import (Int, IntVal, ForAll, simplify, Implies, Not, And, Or, Solver, sat, unsat, unknown, Ast, Array, IntSort,
+                K, Sort, Store, Select, If, FreshConst, BoolSort, BoolVal, is_expr, is_const, Z3Exception, Context,
+                main_ctx, Then, Z3_OP_UNINTERPRETED, BitVec, BitVecVal, BitVecSort, is_int, is_int_value, is_bv_value)
 from final.syntax import Tree
+from final.syntax.tree.walk import PostorderWalk
 
 Formula: typing.TypeAlias = Ast | bool
 PVar: typing.TypeAlias = str
 Env: typing.TypeAlias = dict[PVar, Formula]
 Invariant: typing.TypeAlias = typing.Callable[[Env], Formula]
 
-z3_hole_counter = 0  # used to handle array access with hole expressions
-
 
 OP = {
     "+": operator.add,
@@ -24,13 +28,378 @@ OP = {
     ">=": operator.ge,
     "=": operator.eq,
 }
+ARITHMETIC = ("+", "-", "*", "/")
+
+
+# How program integers are represented in z3, chosen per session: unbounded Int (the default), BitVecEncoding
+# for n bit machine integers with wrap-around arithmetic, or BoundedIntEncoding for Int with the range of n bit
+# integers as constraints on the variables
+class IntEncoding:
+    name = "int"
+
+    def __repr__(self):
+        return "<{0} encoding>".format(self.name)
+
+    def sort(self, ctx: Context) -> Sort:
+        return IntSort(ctx)
+
+    def var(self, name: str, ctx: Context):
+        return Int(name, ctx)
+
+    def val(self, value: int, ctx: Context):
+        return IntVal(value, ctx)
+
+    # applies an operator of OP, on python ints as well as on terms
+    def apply(self, op: str, left, right):
+        return OP[op](left, right)
+
+    # constraints keeping the given terms within the range of the encoding
+    def ranges(self, terms) -> list:
+        return []
+
+    # the python int of a numeral of the encoding, None for other values
+    def number(self, value) -> int | None:
+        return value.as_long() if is_int_value(value) else None
+
+
+class BoundedIntEncoding(IntEncoding):
+    def __init__(self, bits: int = 32):
+        self.bits = bits
+        self.name = "bounded{0}".format(bits)
+        self.low, self.high = -2 ** (bits - 1), 2 ** (bits - 1) - 1
+
+    def ranges(self, terms) -> list:
+        return [And(term >= self.low, term <= self.high) for term in terms if is_expr(term) and is_int(term)]
+
+
+class BitVecEncoding(IntEncoding):
+    def __init__(self, bits: int = 32):
+        self.bits = bits
+        self.name = "bv{0}".format(bits)
+
+    def sort(self, ctx: Context) -> Sort:
+        return BitVecSort(self.bits, ctx)
+
+    def var(self, name: str, ctx: Context):
+        return BitVec(name, self.bits, ctx)
+
+    def val(self, value: int, ctx: Context):
+        return BitVecVal(value, self.bits, ctx)
+
+    # signed machine arithmetic: division truncates, python ints wrap around like the bit-vectors
+    def apply(self, op: str, left, right):
+        if type(left) is int and type(right) is int and op in ARITHMETIC:
+            if op != "/":
+                return self.wrap(OP[op](left, right))
+            if right == 0:  # z3's bvsdiv by zero
+                return -1 if left >= 0 else 1
+            quotient = abs(left) // abs(right)
+            return self.wrap(quotient if (left < 0) == (right < 0) else -quotient)
+        return operator.truediv(left, right) if op == "/" else OP[op](left, right)
+
+    def wrap(self, value: int) -> int:
+        half = 2 ** (self.bits - 1)
+        return (value + half) % (2 * half) - half
+
+    def number(self, value) -> int | None:
+        return value.as_signed_long() if is_bv_value(value) else None
+
+
+INT = IntEncoding()
+
+
+# the encoding of a name: "int", "bv<bits>" (e.g. "bv32") or "bounded<bits>"
+def encoding_named(name: str | None) -> IntEncoding:
+    if name is None or name == "int":
+        return INT
+    for prefix, encoding in (("bv", BitVecEncoding), ("bounded", BoundedIntEncoding)):
+        if name.startswith(prefix) and name[len(prefix):].isdigit():
+            return encoding(int(name[len(prefix):]))
+    raise ValueError(f"unknown encoding: {name}")
+
+
+VERIFIED, REFUTED, UNKNOWN = "verified", "refuted", "unknown"
+
+
+# Result of a verification: verified, refuted, or unknown with the reason z3 gave up (e.g. "timeout").
+# attempts lists (step, status, reason) of every step of the retry ladder that ran.
+# It is true only when verified, so it can be used like the booleans returned before
+class Verdict:
+    def __init__(self, status: str, reason: str | None = None, attempts: list | None = None,
+                 obligations: list | None = None, model: dict | None = None):
+        self.status = status
+        self.reason = reason
+        self.attempts = [] if attempts is None else attempts
+        self.obligations = [] if obligations is None else obligations  # when they were checked one by one
+        self.model = model  # name -> value of the constants left free in the query, when the solver gave them
+
+    def __bool__(self):
+        return self.status == VERIFIED
+
+    def __repr__(self):
+        return "<Verdict {0}{1}>".format(self.status, "" if self.reason is None else " ({0})".format(self.reason))
+
+
+# raised when the solver cannot decide whether the holes can be filled
+class SolverUnknown(ValueError):
+    def __init__(self, reason: str):
+        super().__init__("cannot fill holes: {0}".format(reason))
+        self.reason = reason
+
+
+# Limits of every solver call: timeout in milliseconds, rlimit in z3 resource units (unlike the timeout,
+# it gives the same answer on every machine) and max_memory in megabytes. None means no limit
+class Limits:
+    def __init__(self, timeout: int | None = None, rlimit: int | None = None, max_memory: int | None = None):
+        self.timeout = timeout
+        self.rlimit = rlimit
+        self.max_memory = max_memory
+
+    def __repr__(self):
+        return "<Limits timeout={0} rlimit={1} max_memory={2}>".format(self.timeout, self.rlimit, self.max_memory)
+
+    # sets the limits of a solver, unset limits are reset to z3's defaults
+    def apply(self, solver):
+        solver.set("timeout", 4294967295 if self.timeout is None else self.timeout)
+        solver.set("rlimit", 0 if self.rlimit is None else self.rlimit)
+        solver.set("max_memory", 4294967295 if self.max_memory is None else self.max_memory)
+        return solver
+
+
+# Owns the z3 context, the solver and the counters of one request, so that assertions and
+# counters of earlier programs do not pile up. Helpers below work on the innermost active session
+class VerificationSession:
+    def __init__(self, ctx: Context | None = None, timeout: int | None = None, limits: Limits | None = None,
+                 encoding: IntEncoding | None = None):
+        self.ctx = Context() if ctx is None else ctx
+        self.encoding = INT if encoding is None else encoding  # sort of the program's integers
+        self.limits = Limits(timeout) if limits is None else limits  # of every solver call, see check
+        self.timeout = self.limits.timeout  # milliseconds per solver call, None for no limit
+        self.solver = self.new_solver()  # contains assertions
+        self.last_result = None  # result of the last check of the solver
+        self.z3_hole_counter = 0  # used to handle array access with hole expressions
+        self.vc_scopes = []  # named sub-formulas of the VC under construction, one entry per quantifier scope
+        self.terms = TermCache()  # terms built for expressions, shared by the examples of a synthesis request
+        self.timings = {}  # seconds spent in every phase of the request (see phase)
+        self.index_definitions = []  # hole_z3N == hole, see hole_index
+        self.portfolio = None  # a portfolio.Portfolio racing solver configurations instead of the retry ladder
+        self.query_log = None  # a smtlib.QueryLog the queries are written to
+        self.backend = None  # a smtlib.SolverPool answering the queries instead of the z3 solvers
+        self.external = None  # (solver, smtlib.Answer) of the last check the backend or the portfolio answered
+
+    def __enter__(self):
+        sessions.append(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        sessions.pop()
+
+    # accumulates the time spent inside the with block in self.timings[name]
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name] = self.timings.get(name, 0.0) + time.perf_counter() - start
+
+    # a solver in the session's context, with the session's limits
+    def new_solver(self) -> Solver:
+        return self.limits.apply(Solver(ctx=self.ctx))
+
+    # checks a solver under the given limits for this call only, or the session's limits. The query is written
+    # to the query log, and with a backend the solver only holds the assertions that the backend checks
+    def check(self, solver, *assumptions, limits: Limits | None = None):
+        self.external = None
+        start = time.perf_counter()
+        path = None
+        if self.query_log is not None:
+            path = self.query_log.write([*solver.assertions(), *assumptions],
+                                        self.limits if limits is None else limits)
+        if self.backend is not None:
+            self.external = (solver, self.backend.check([*solver.assertions(), *assumptions],
+                                                        self.limits if limits is None else limits))
+            result = self.external[1].result
+        elif limits is None:
+            result = solver.check(*assumptions)
+        else:
+            limits.apply(solver)
+            try:
+                result = solver.check(*assumptions)
+            finally:
+                self.limits.apply(solver)
+        if path is not None:
+            self.query_log.finish(path, result, time.perf_counter() - start)
+        return result
+
+    # checks the assertions of a solver like check, raced by the portfolio when the session has one:
+    # the model of the configuration that answered first is the solver's model (see model_of)
+    def race(self, solver, limits: Limits | None = None):
+        if self.portfolio is None:
+            return self.check(solver, limits=limits)
+        outcome = self.portfolio.run(solver.assertions(), self.limits if limits is None else limits)
+        self.external = (solver, outcome.answer(solver.assertions()))
+        return self.external[1].result
+
+    # the model of the last check of a solver, the backend's when it answered
+    def model_of(self, solver):
+        if self.external is not None and self.external[0] is solver:
+            return self.external[1].model
+        return solver.model()
+
+    # why the last check of a solver gave up
+    def reason_of(self, solver) -> str:
+        if self.external is not None and self.external[0] is solver:
+            return self.external[1].reason
+        return solver.reason_unknown()
+
+    # the status a check gives, sat meaning verified (refuted for a negated query), and z3's reason when unknown
+    def status(self, solver, negated: bool = False, limits: Limits | None = None) -> tuple[str, str | None]:
+        self.last_result = self.check(solver, limits=limits)
+        if self.last_result == unknown:
+            return UNKNOWN, self.reason_of(solver)
+        return VERIFIED if (self.last_result == sat) != negated else REFUTED, None
+
+    # moves a formula into the session's context, python booleans included
+    def formula(self, f) -> Formula:
+        if isinstance(f, bool):
+            return BoolVal(f, self.ctx)
+        if is_expr(f) and f.ctx is not self.ctx:
+            return f.translate(self.ctx)
+        return f
+
+    # names a hole expression used as an array index
+    def hole_index(self, value) -> Formula:
+        z3_var = self.encoding.var('hole_z3' + str(self.z3_hole_counter), self.ctx)
+        self.z3_hole_counter += 1
+        self.index_definitions.append(z3_var == value)
+        self.solver.add(self.index_definitions[-1])
+        return z3_var
+
+    # pushes a scope of the session's solver, returns what pop needs
+    def push(self) -> int:
+        self.solver.push()
+        return len(self.index_definitions)
+
+    # pops a scope of the session's solver. The hole index definitions made in the scope are asserted again
+    # below it: the terms using them stay in the term cache and are used again by the next scope
+    def pop(self, definitions: int) -> None:
+        self.solver.pop()
+        self.solver.add(*self.index_definitions[definitions:])
+
+    # adds the (universally quantified) formula to the solver in a scope of its own, popped after the check so
+    # that later queries of the session are not checked together with it; returns whether it can be satisfied.
+    # when the solver answers unknown, a retry ladder tries the negated formula without quantifiers in a
+    # new solver (when only bound_vars are free in it), then quantifier elimination before the solver.
+    # With a portfolio, its configurations check the solver's assertions at once instead
+    def prove(self, bound_vars: list, formula: Formula, limits: Limits | None = None) -> Verdict:
+        formula = self.formula(formula)
+        query = ForAll(bound_vars, formula) if bound_vars else formula
+        definitions = self.push()
+        try:
+            self.solver.add(query)
+            if self.portfolio is not None:
+                outcome = self.portfolio.run(self.solver.assertions(), self.limits if limits is None else limits)
+                self.last_result = {"sat": sat, "unsat": unsat}.get(outcome.result, unknown)
+                status = {"sat": VERIFIED, "unsat": REFUTED}.get(outcome.result, UNKNOWN)
+                return Verdict(status, outcome.reason,
+                               [("portfolio {0}".format(outcome.winner), status, outcome.reason)])
+            attempts = []
+            for step in ("default", "negated", "qe"):
+                if step == "default":
+                    status, reason = self.status(self.solver, limits=limits)
+                elif step == "negated":
+                    if not free_constants(formula) <= {v.get_id() for v in bound_vars}:
+                        continue  # holes left, the formula is not a validity question
+                    solver = self.new_solver()
+                    solver.add(Not(formula))
+                    status, reason = self.status(solver, negated=True, limits=limits)
+                else:
+                    solver = self.limits.apply(Then("simplify", "qe", "smt", ctx=self.ctx).solver())
+                    solver.add(query, *self.index_definitions)
+                    status, reason = self.status(solver, limits=limits)
+                attempts.append((step, status, reason))
+                if status != UNKNOWN:
+                    break
+            model = None
+            if status == VERIFIED and step == "default":
+                mod = self.model_of(self.solver)
+                model = {str(key): mod[key] for key in mod if 'hole_z' not in str(key)}
+            return Verdict(status, reason, attempts, model=model)
+        finally:
+            self.pop(definitions)
+
+    # Verify function, now handling array constraints
+    def verify(self, P: Invariant, ast: Tree, Q: Invariant, linv: Invariant, limits: Limits | None = None) -> Verdict:
+        with self:
+            pvars = collect_vars(ast)
+            env = mk_env(pvars)
+            with self.phase("vc"):
+                names, definitions, result = vc(Q, ast, linv, env, universal=True)
+            with self.phase("verify"):
+                hypotheses = [self.formula(P(env)), *self.encoding.ranges(env.values()), *definitions]
+                return self.prove(list(extract_z3_variables(env)) + names,
+                                  Implies(And(*hypotheses), self.formula(result)), limits)
+
+
+# LRU cache of the terms built for expressions, keyed by the expression node and the values of its variables.
+# z3 terms are hash-consed per context, so a term is identified by its context and id. The entries keep the
+# node and the values alive, so that their ids are not reused while the entry exists
+class TermCache:
+    def __init__(self, maxsize: int = 4096):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __repr__(self):
+        return "<TermCache {0}/{1} entries, {2} hits, {3} misses>".format(
+            len(self.entries), self.maxsize, self.hits, self.misses)
+
+    # the value build(env, linv) of an expression, built once for equal values of its variables
+    def lookup(self, expr: Tree, env: Env, linv: Invariant, build):
+        info = analyze(expr)
+        values = tuple(env.get(var) for var in info.names)
+        key = (id(expr), info.stamp, id(linv), tuple(term_key(value) for value in values))
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[-1]
+        self.misses += 1
+        result = build(env, linv)
+        self.entries[key] = (expr, linv, values, result)
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+        return result
+
+
+# a hashable key identifying an environment value: a number, a z3 term or an array tuple
+def term_key(value):
+    if isinstance(value, tuple):
+        return tuple(term_key(v) for v in value)
+    if is_expr(value):
+        return id(value.ctx), value.get_id()
+    return type(value), value
+
+
+sessions = [VerificationSession(main_ctx())]  # active sessions, the first one is the process-wide default
+
+
+# the innermost active session
+def current_session() -> VerificationSession:
+    return sessions[-1]
 
 
 # Initialize environment
 def mk_env(pvars: set[PVar]) -> Env:
     env = {}
+    session = current_session()
     for v in pvars:
-        env[v] = Int(v)
+        env[v] = session.encoding.var(v, session.ctx)
     return env
 
 
@@ -41,6 +410,59 @@ def upd(d: Env, k: PVar, v: Formula) -> Env:
     return d
 
 
+# opens a scope in which wp names shared sub-formulas instead of copying them
+def open_vc_scope() -> None:
+    current_session().vc_scopes.append(([], []))
+
+
+# closes the innermost scope, returns the fresh names and their defining equalities
+def close_vc_scope() -> tuple[list, list]:
+    return current_session().vc_scopes.pop()
+
+
+# gives a formula a fresh name in the current scope (Flanagan-Saxe style), so it is built only once
+def share(value, prefix: str = "vc"):
+    vc_scopes = current_session().vc_scopes
+    if not vc_scopes or not is_expr(value):
+        return value
+    names, definitions = vc_scopes[-1]
+    name = FreshConst(value.sort(), prefix)
+    names.append(name)
+    definitions.append(name == value)
+    return name
+
+
+# checks whether two environment values are the same term
+def same_value(a, b) -> bool:
+    if isinstance(a, tuple) and isinstance(b, tuple):
+        return len(a) == len(b) and all(same_value(x, y) for x, y in zip(a, b))
+    if is_expr(a) and is_expr(b):
+        return a.eq(b)
+    return type(a) is type(b) and a == b
+
+
+# merges the environments at the end of both branches of an if statement (phi nodes),
+# returns None when the environments cannot be merged
+def join_envs(cond, true_env: Env, false_env: Env) -> Env | None:
+    if true_env.keys() != false_env.keys():
+        return None
+    joined = {}
+    for var, true_value in true_env.items():
+        false_value = false_env[var]
+        if same_value(true_value, false_value):
+            joined[var] = true_value
+        elif isinstance(cond, bool):
+            joined[var] = true_value if cond else false_value
+        elif isinstance(true_value, tuple) or isinstance(false_value, tuple):
+            if not (isinstance(true_value, tuple) and isinstance(false_value, tuple)) \
+                    or true_value[1:] != false_value[1:]:
+                return None
+            joined[var] = (share(If(cond, true_value[0], false_value[0]), var), *true_value[1:])
+        else:
+            joined[var] = share(If(cond, true_value, false_value), var)
+    return joined
+
+
 # returns a list with array elements, used when initializing arrays
 def parse_num_list(tree, env, linv: Invariant):
     if str(tree.root) == "num":
@@ -69,37 +491,82 @@ def parse_num_list(tree, env, linv: Invariant):
 
 
 
-# Evaluate expressions, now including 2 or 1 dimensional array access with bounds checking
+# Evaluate expressions, now including 2 or 1 dimensional array access with bounds checking.
+# the expression is compiled once into a closure (cached with the analysis of its node), and the
+# result is simplified once, instead of after every arithmetic step
 def eval_expr(expr: Tree, env: Env, linv: Invariant) -> Formula:
-    global z3_hole_counter
-    if str(expr.root) == "num":
-        return int(expr.subtrees[0].root)
-    elif str(expr.root) == "id":
-        var_name = str(expr.subtrees[0].root)
-        if var_name in env:
-            return env[var_name]
-    elif str(expr.root) == "num_list":
+    info = compiled(expr)
+    if info.size <= 2:  # numbers, variables and holes are cheaper to evaluate than to look up
+        return info.evaluate(env, linv)
+    return current_session().terms.lookup(expr, env, linv, info.evaluate)
+
+
+Code: typing.TypeAlias = typing.Callable[[Env, Invariant], Formula]
+
+
+# the compiled closures of an expression, code is used by the enclosing expression,
+# evaluate also simplifies the result and is used for a whole expression
+def compiled(expr: Tree) -> "TreeInfo":
+    info = analyze(expr)
+    if info.code is None:
+        root = str(expr.root)
+        kind = "hole" if root.startswith("hole_") else "op" if root in OP else root
+        info.code = COMPILE.get(kind, compile_default)(expr)
+        info.evaluate = simplified(info.code) if kind == "op" else info.code
+    return info
+
+
+def simplified(code: Code) -> Code:
+    def evaluate(env, linv):
+        result = code(env, linv)
+        if type(result) is not int and type(result) is not bool:
+            result = simplify(result)
+        return result
+    return evaluate
+
+
+def compile_num(expr: Tree) -> Code:
+    value = int(expr.subtrees[0].root)
+    return lambda env, linv: value
+
+
+def compile_id(expr: Tree) -> Code:
+    var_name = str(expr.subtrees[0].root)
+    return lambda env, linv: env.get(var_name, False)
 
+
+def compile_op(expr: Tree) -> Code:
+    op = expr.root
+    left, right = compiled(expr.subtrees[0]).code, compiled(expr.subtrees[1]).code
+    return lambda env, linv: current_session().encoding.apply(op, left(env, linv), right(env, linv))
+
+
+def compile_hole(expr: Tree) -> Code:
+    hole = expr.root
+    return lambda env, linv: current_session().formula(hole)
+
+
+def compile_num_list(expr: Tree) -> Code:
+    def num_list(env, linv):
         elements = [parse_num_list(expr, env, linv)]
         elements = [item for sublist in elements for item in (sublist if isinstance(sublist, list) else [sublist])]
         elements = [item for sublist in elements for item in (sublist if isinstance(sublist, list) else [sublist])]
         length = len(elements)
-        z3_array = K(IntSort(), 0)
+        z3_array = empty_array()
         for idx, val in enumerate(elements):
             z3_array = Store(z3_array, idx, val)
         return (z3_array, length, -1)
-    elif str(expr.root) == "array_access":
-        array_name = expr.subtrees[0].subtrees[0].root
-        index_expr = expr.subtrees[1]
-        if len(expr.subtrees) == 3:
-            inner_index_expr = expr.subtrees[2].subtrees[0]
-        else:
-            inner_index_expr = -1
-        x1 = eval_expr(index_expr, env, linv)
-        if inner_index_expr == -1:
-            x2 = -1
-        else:
-            x2 = eval_expr(inner_index_expr, env, linv)
+    return num_list
+
+
+def compile_array_access(expr: Tree) -> Code:
+    array_name = expr.subtrees[0].subtrees[0].root
+    index = compiled(expr.subtrees[1]).evaluate  # indices are simplified to numbers or holes
+    inner_index = compiled(expr.subtrees[2].subtrees[0]).evaluate if len(expr.subtrees) == 3 else None
+
+    def array_access(env, linv):
+        x1 = index(env, linv)
+        x2 = -1 if inner_index is None else inner_index(env, linv)
 
         array_tuple = env[array_name]
         inner_arr_len = array_tuple[2]
@@ -107,38 +574,36 @@ def eval_expr(expr: Tree, env: Env, linv: Invariant) -> Formula:
         if inner_arr_len != -1 and type(x2) is int and x2 == -1:  # when array is two dimensional, but access is with one index
             raise ValueError("unsupported array access")
 
+        session = current_session()
         if "hole_" in str(x1): # if first index is hole
-            z3_var = Int('hole_z3'+str(z3_hole_counter))
-            z3_hole_counter += 1
-            s.add(z3_var == x1)
-            external_index_value = z3_var
+            external_index_value = session.hole_index(x1)
         else:
-            external_index_value = IntVal(int(str(eval_expr(index_expr, env, linv))))
+            external_index_value = session.encoding.val(int(str(x1)), session.ctx)
 
-        if x2 == -1:
-            internal_index_value = IntVal(-1)
+        if inner_index is None:
+            internal_index_value = session.encoding.val(-1, session.ctx)
         else:
             if "hole_" in str(x2): # if second index is hole
-                z3_var = Int('hole_z3'+str(z3_hole_counter))
-                z3_hole_counter += 1
-                s.add(z3_var == x2)
-                internal_index_value = z3_var
+                internal_index_value = session.hole_index(x2)
             else:
-                internal_index_value = IntVal(int(str(eval_expr(inner_index_expr, env, linv))))
+                internal_index_value = session.encoding.val(int(str(x2)), session.ctx)
 
-        result_get = getter(array_tuple, external_index_value, internal_index_value, env, linv)
-        return result_get
+        return getter(array_tuple, external_index_value, internal_index_value, env, linv)
+    return array_access
 
-    elif str(expr.root) in OP:
-        left = eval_expr(expr.subtrees[0], env, linv)
-        right = eval_expr(expr.subtrees[1], env, linv)
-        result = OP[expr.root](left, right)
-        if type(result) is not int and type(result) is not bool:
-            result = simplify(result)
-        return result
-    elif str(expr.root).startswith("hole_"):
-        return expr.root
-    return False  # Default return for unrecognized expressions
+
+def compile_default(expr: Tree) -> Code:
+    return lambda env, linv: False  # Default return for unrecognized expressions
+
+
+COMPILE = {
+    "num": compile_num,
+    "id": compile_id,
+    "op": compile_op,
+    "hole": compile_hole,
+    "num_list": compile_num_list,
+    "array_access": compile_array_access,
+}
 
 
 # returns the number of nesting in arrays
@@ -188,16 +653,26 @@ def build_nested(tree, env, linv) -> list:
 
         numbers = parse_num_list(tree, env, linv)
         length = len(numbers)
-        z3_array = K(IntSort(), 0)
+        z3_array = empty_array()
         for idx, val in enumerate(numbers):
             z3_array = Store(z3_array, idx, val)
         return [(z3_array, length, -1)]
 
 
 
+# an array of the session's integers, with 0 in every cell
+def empty_array():
+    session = current_session()
+    return K(session.encoding.sort(session.ctx), session.encoding.val(0, session.ctx))
+
+
 # used in array initialization, returns a tuple of the array object, array length, and the nested array length.
 # if the array is one dimensional, the nested array length is defined as -1
 def build_external(tree: Tree, env, linv)->tuple:
+    return current_session().terms.lookup(tree, env, linv, lambda env, linv: build_array(tree, env, linv))
+
+
+def build_array(tree: Tree, env, linv)->tuple:
     arr = build_nested(tree, env, linv)
 
     length_in = -1  # for 1-dimensional array, inner_array length is undefined
@@ -216,7 +691,8 @@ def build_external(tree: Tree, env, linv)->tuple:
         for inner_arr in arr:
             if inner_arr[1] != length_in:
                 raise ValueError("array initialization is not valid")
-        z3_array = K(IntSort(), K(IntSort(), IntVal(0)))
+        session = current_session()
+        z3_array = K(session.encoding.sort(session.ctx), empty_array())
         for idx, val in enumerate(arr):
             z3_array = Store(z3_array, idx, val[0])
 
@@ -263,47 +739,181 @@ def getter(arr_tuple, index_outer, index_inner, env, linv):
         return simplify(Select(Select(arr, index_outer), index_inner))
 
 
-# Collect variables
-def collect_vars(ast: Tree) -> set[str]:
-    vars = set()
-    if str(ast.root) == "id":
-        vars.add(ast.subtrees[0].root)
+# evaluates an array_update command, returns the updated array tuple
+def update_array(c: Tree, env: Env, linv: Invariant) -> tuple:
+    session = current_session()
+    array_name = c.subtrees[0].subtrees[0].root
+    external_index_expr = c.subtrees[1]
+
+    if len(c.subtrees) == 4:
+        inner_index_expr = c.subtrees[2].subtrees[0]
+        value_expr = c.subtrees[3]
     else:
-        for subtree in ast.subtrees:
-            vars.update(collect_vars(subtree))
-    return vars
+        inner_index_expr = Tree('num' ,[Tree(-1 ,[])])
+        value_expr = c.subtrees[2]
+
+    inner_index = eval_expr(inner_index_expr, env, linv)
+    external_index = eval_expr(external_index_expr, env, linv)
+    value = eval_expr(value_expr, env, linv)
+    array_obj, length_external, length_internal = env[array_name]
 
+    if length_internal == -1 and inner_index != -1:  # accessing a 1-dimensional array only with index_inner =-1
+        raise ValueError("Array access out of bounds")
+    elif (((external_index < 0 or external_index >= length_external) or (
+            length_internal > -1 and (inner_index < 0 or inner_index >= length_internal)))
+          and linv(env)):  # Boundary check assertion
+        raise ValueError("Array access out of bounds")
+
+    if "hole_" in str(external_index):  # if first index is hole
+        external_index_value = session.hole_index(external_index)
 
-def find_holes(ast: Tree) -> set[str]:
-    holes = set()
-    if str(ast.root).startswith("hole_"):
-        holes.add(str(ast.root))
     else:
-        for subtree in ast.subtrees:
-            holes.update(find_holes(subtree))
-    return holes
+        external_index_value = session.encoding.val(int(str(eval_expr(external_index_expr, env, linv))), session.ctx)
+
+    if "hole_" in str(inner_index):  # if second index is hole
+        internal_index_value = session.hole_index(inner_index)
 
+    else:
+        internal_index_value = session.encoding.val(int(str(eval_expr(inner_index_expr, env, linv))), session.ctx)
+
+    if internal_index_value == -1:
+        updated_all_array = Store(array_obj, external_index_value, value)
+    else:
+        inner_array = Select(array_obj, external_index_value)
+        updated_inner_array = Store(inner_array, internal_index_value, value)
+        updated_all_array = Store(array_obj,external_index_value, updated_inner_array)
+
+    return (updated_all_array, length_external, length_internal)
+
+
+# Results of one analysis pass over a subtree, cached on its root node as node.info
+class TreeInfo:
+    __slots__ = ("vars", "names", "holes", "arrays", "size", "stamp", "code", "evaluate")
+
+    def __init__(self, vars: frozenset, holes: frozenset, arrays: dict, size: int, stamp: int):
+        self.vars = vars  # variable names
+        self.names = tuple(sorted(vars))
+        self.holes = holes  # hole ids (hole_N), after detect_holes
+        self.arrays = arrays  # array name -> number of dimensions it is initialized or accessed with
+        self.size = size  # number of nodes
+        self.stamp = stamp  # unique to this analysis, keys the terms built from it (see TermCache)
+        self.code = None  # the compiled expression, see compiled()
+        self.evaluate = None
+
+
+analysis_stamps = itertools.count()
+
+
+# drops the analysis of a node when the analysis of one of its subtrees was dropped. The in-place rewrites
+# (detect_holes, fill_assignments) drop the analysis of the nodes they rewrite and call this on their way back
+# up, so the analyses along the rewritten paths are redone and those of other trees are kept
+def invalidate_analysis(node: Tree) -> None:
+    if node.info is not None and any(subtree.info is None for subtree in node.subtrees):
+        node.info = None
+
+
+def is_analyzed(node: Tree) -> bool:
+    return node.info is not None
+
+
+def union(sets) -> frozenset:
+    sets = [s for s in sets if s]
+    return sets[0] if len(sets) == 1 else frozenset().union(*sets)
+
+
+# the number of dimensions of an array_init node: 2 if its elements are bracketed lists
+def init_dims(elements: Tree) -> int:
+    node = elements
+    while str(node.root) != 'lbracket' and node.subtrees:
+        node = node.subtrees[0]
+    return 2 if str(node.root) == 'lbracket' else 1
+
+
+# analyzes a tree in one post-order pass (iteratively, large programs are deeper than the recursion limit),
+# subtrees analyzed before and not rewritten since are not walked again
+def analyze(ast: Tree) -> TreeInfo:
+    for node in PostorderWalk(ast, prune=is_analyzed):
+        if is_analyzed(node):
+            continue
+        root = str(node.root)
+        infos = [subtree.info for subtree in node.subtrees]
+        arrays = {}
+        for info in infos:
+            for name, dims in info.arrays.items():
+                arrays[name] = max(dims, arrays.get(name, 0))
+        if root == "array_init":
+            name = node.subtrees[0].subtrees[0].root
+            arrays[name] = max(init_dims(node.subtrees[1]), arrays.get(name, 0))
+        elif root in ("array_access", "array_update"):
+            name = node.subtrees[0].subtrees[0].root
+            dims = 2 if len(node.subtrees) == (3 if root == "array_access" else 4) else 1
+            arrays[name] = max(dims, arrays.get(name, 0))
+        node.info = TreeInfo(
+            frozenset([node.subtrees[0].root]) if root == "id" else union(info.vars for info in infos),
+            frozenset([root]) if root.startswith("hole_") else union(info.holes for info in infos),
+            arrays,
+            1 + sum(info.size for info in infos),
+            next(analysis_stamps))
+    return ast.info
 
-# Convert while loops into 10 nested if statements
-def break_while_to_ifs(tree: Tree) -> Tree:
+
+# Collect variables
+def collect_vars(ast: Tree) -> frozenset[str]:
+    return analyze(ast).vars
+
+
+def find_holes(ast: Tree) -> frozenset[str]:
+    return analyze(ast).holes
+
+
+UNROLL_DEPTH = 10  # iterations of a loop when no depth is given
+MAX_UNROLL = 32  # deepest unrolling of the adaptive mode
+
+
+# Convert while loops into nested if statements, depth times (an int for every loop, or a list with the depth of
+# every loop, numbered in pre-order). The last copy of the body is followed by an "unwound" command with the loop
+# number, condition and body, which marks where a run that would still loop is cut off
+def break_while_to_ifs(tree: Tree, depth: int | list = UNROLL_DEPTH) -> Tree:
+    return unroll(tree, depth, itertools.count())
+
+
+def unroll(tree: Tree, depth: int | list, loops) -> Tree:
     if str(tree.root) == "while":
+        index = next(loops)
         condition = tree.subtrees[0]  # Loop condition
-        body = tree.subtrees[1]  # Loop body
+        body = unroll(tree.subtrees[1], depth, loops)  # Loop body, with its inner loops unrolled
+        unwound = Tree("unwound", [Tree("num", [Tree(index)]), condition, body])
 
         # Create the first if statement for unwinding
-        current_if = Tree("if", [condition, body, Tree("skip")])
+        current_if = Tree("if", [condition, Tree(";", [body, unwound]), Tree("skip")])
 
-        # Nest additional if statements up to 10 iterations
-        for _ in range(9):
+        # Nest additional if statements up to depth iterations
+        for _ in range((depth if isinstance(depth, int) else depth[index]) - 1):
             current_if = Tree("if", [condition, Tree(";", [body, current_if]), Tree("skip")])
 
         return current_if
 
     # Recursively process subtrees
-    new_subtrees = [break_while_to_ifs(subtree) for subtree in tree.subtrees]
+    new_subtrees = [unroll(subtree, depth, loops) for subtree in tree.subtrees]
     return Tree(tree.root, new_subtrees)
 
 
+# the number of while loops of a program, the loops are numbered in pre-order
+def count_loops(ast: Tree) -> int:
+    return sum(1 for node in ast.iter_nodes() if str(node.root) == "while")
+
+
+# depth every loop of a program was unrolled to, and the loops whose last copy could still be entered
+# (cut off at the deepest unrolling allowed), their results only hold for runs of at most that many iterations
+class UnrollReport:
+    def __init__(self, depths: list, cut: set | None = None):
+        self.depths = depths
+        self.cut = set() if cut is None else cut
+
+    def __repr__(self):
+        return "<UnrollReport depths={0} cut={1}>".format(self.depths, sorted(self.cut))
+
+
 # Weakest precondition calculation
 def wp(Q: Invariant, c: Tree, linv: Invariant, start_env: Env) -> Invariant:
     if c.root == "skip":
@@ -324,58 +934,7 @@ def wp(Q: Invariant, c: Tree, linv: Invariant, start_env: Env) -> Invariant:
 
     if c.root == "array_update":
         array_name = c.subtrees[0].subtrees[0].root
-        external_index_expr = c.subtrees[1]
-
-        if len(c.subtrees) == 4:
-            inner_index_expr = c.subtrees[2].subtrees[0]
-            value_expr = c.subtrees[3]
-        else:
-            inner_index_expr = Tree('num' ,[Tree(-1 ,[])])
-            value_expr = c.subtrees[2]
-
-
-        def array_update_wp(env):
-            inner_index = eval_expr(inner_index_expr, env, linv)
-            external_index = eval_expr(external_index_expr, env, linv)
-            value = eval_expr(value_expr, env, linv)
-            array_obj, length_external, length_internal = env[array_name]
-
-            if length_internal == -1 and inner_index != -1:  # accessing a 1-dimensional array only with index_inner =-1
-                raise ValueError("Array access out of bounds")
-            elif (((external_index < 0 or external_index >= length_external) or (
-                    length_internal > -1 and (inner_index < 0 or inner_index >= length_internal)))
-                  and linv(env)):  # Boundary check assertion
-                raise ValueError("Array access out of bounds")
-
-            if "hole_" in str(external_index):  # if first index is hole
-                z3_var = Int('hole_z3' + str(z3_hole_counter))
-                z3_hole_counter += 1
-                s.add(z3_var == external_index)
-                external_index_value = z3_var
-
-            else:
-                external_index_value = IntVal(int(str(eval_expr(external_index_expr, env, linv))))
-
-            if "hole_" in str(inner_index):  # if second index is hole
-                z3_var = Int('hole_z3' + str(z3_hole_counter))
-                z3_hole_counter += 1
-                s.add(z3_var == inner_index)
-                internal_index_value = z3_var
-
-            else:
-                internal_index_value = IntVal(int(str(eval_expr(inner_index_expr, env, linv))))
-
-            if internal_index_value == -1:
-                updated_all_array = Store(array_obj, external_index_value, value)
-            else:
-                inner_array = Select(array_obj, external_index_value)
-                updated_inner_array = Store(inner_array, internal_index_value, value)
-                updated_all_array = Store(array_obj,external_index_value, updated_inner_array)
-
-            env = upd(env, array_name, (updated_all_array, length_external, length_internal))
-            return Q(env)
-
-        return array_update_wp
+        return lambda env: Q(upd(env, array_name, update_array(c, env, linv)))
 
     if c.root == ";":
         rightQ = wp(Q, c.subtrees[1], linv, start_env)
@@ -383,11 +942,54 @@ def wp(Q: Invariant, c: Tree, linv: Invariant, start_env: Env) -> Invariant:
         return lambda env: leftQ(env)
 
     if c.root == "if":
-        true_label = wp(Q, c.subtrees[1], linv, start_env)
-        false_label = wp(Q, c.subtrees[2], linv, start_env)
-        return lambda env: (
-            Or(And(true_label(env), eval_expr(c.subtrees[0], env, linv)),
-               And(false_label(env), Not(eval_expr(c.subtrees[0], env, linv)))))
+        frames = []  # one frame per evaluation of this if: (scope depth, branch ends) or None
+
+        # continuation of both branches: inside a VC scope, the branch ends are only
+        # recorded and Q is evaluated once on the merged environment
+        def join_label(env):
+            frame = frames[-1]
+            session = current_session()
+            if frame is None or frame[0] != len(session.vc_scopes):
+                return Q(env)
+            placeholder = FreshConst(BoolSort(session.ctx), "post")
+            frame[1].append((placeholder, env))
+            return placeholder
+
+        true_label = wp(join_label, c.subtrees[1], linv, start_env)
+        false_label = wp(join_label, c.subtrees[2], linv, start_env)
+
+        def if_wp(env):
+            session = current_session()
+            vc_scopes = session.vc_scopes
+            cond = eval_expr(c.subtrees[0], env, linv)
+            frames.append((len(vc_scopes), []) if vc_scopes else None)
+            try:
+                true_wp = true_label(env)
+                false_wp = false_label(env)
+            finally:
+                frame = frames.pop()
+            if frame is not None:
+                ends = frame[1]
+                joined = None
+                if len(ends) == 2:
+                    try:
+                        joined = join_envs(cond, ends[0][1], ends[1][1])
+                    except Z3Exception:
+                        joined = None
+                names, definitions = vc_scopes[-1]
+                if joined is not None:
+                    post = share(Q(joined), "post")
+                    for placeholder, _ in ends:
+                        names.append(placeholder)
+                        definitions.append(placeholder == post)
+                else:  # branches cannot be merged, fall back to one copy of Q per branch end
+                    for placeholder, end_env in ends:
+                        names.append(placeholder)
+                        definitions.append(placeholder == Q(end_env))
+            guard = session.formula(cond)
+            return Or(And(session.formula(true_wp), guard), And(session.formula(false_wp), Not(guard)))
+
+        return if_wp
 
     if c.root == "while":
         if linv is None:
@@ -395,30 +997,59 @@ def wp(Q: Invariant, c: Tree, linv: Invariant, start_env: Env) -> Invariant:
         loop_cond = c.subtrees[0]
         loop_body = c.subtrees[1]
         all_vars = collect_vars(loop_cond).union(collect_vars(loop_body))
-        the_vars = [Int(var) for var in collect_vars(loop_cond).union(collect_vars(loop_body))]
 
         def while_wp(env: Env) -> Invariant:
+            the_vars = [current_session().encoding.var(var, current_session().ctx) for var in all_vars]
             the_holes = find_holes(loop_cond).union(find_holes(loop_body))
             new_env = mk_env(all_vars.union(the_holes))
             and1 = linv(env)
+            scoped = bool(current_session().vc_scopes)
+            if scoped:  # names created under the quantifier must stay bound by it
+                open_vc_scope()
             wp_c = wp(linv, loop_body, linv, new_env)(new_env)
-            and2 = ForAll(the_vars,
-                          And(
-                              Implies(And(linv(new_env),
-                                          eval_expr(loop_cond, new_env, linv)), wp_c),
-                              Implies(And(linv(new_env),
-                                          Not(eval_expr(loop_cond, new_env, linv))), Q(new_env))))
-            and3 = Implies(Not(eval_expr(loop_cond, new_env, linv)), Q(new_env))
+            body = And(
+                Implies(And(linv(new_env),
+                            eval_expr(loop_cond, new_env, linv)), wp_c),
+                Implies(And(linv(new_env),
+                            Not(eval_expr(loop_cond, new_env, linv))), Q(new_env)))
+            if scoped:
+                names, definitions = close_vc_scope()
+                and2 = ForAll(the_vars + names, Implies(And(*definitions), body) if definitions else body)
+            else:
+                and2 = ForAll(the_vars, body)
             return And(and1, and2)
 
         return while_wp
 
+    if c.root == "unwound":
+        return Q
+
     if c.root == "assert":
-        return lambda env: And(eval_expr(c.subtrees[0], env, linv), Q(env))
+        return lambda env: And(current_session().formula(eval_expr(c.subtrees[0], env, linv)),
+                               current_session().formula(Q(env)))
 
     raise ValueError(f"Unknown command: {c.root}")
 
 
+# the ids of the uninterpreted constants of a term (its free variables)
+def free_constants(term) -> set[int]:
+    return set(constants(term))
+
+
+# the uninterpreted constants of a term (program variables, holes, fresh constants) by id
+def constants(term) -> dict:
+    todo, seen, free = [term], set(), {}
+    while todo:
+        t = todo.pop()
+        if t.get_id() in seen:
+            continue
+        seen.add(t.get_id())
+        if is_const(t) and t.decl().kind() == Z3_OP_UNINTERPRETED:
+            free[t.get_id()] = t
+        todo.extend(t.children())
+    return free
+
+
 def extract_z3_variables(env: Env) -> list:
     z3_vars = []
     for key, value in env.items():
@@ -429,20 +1060,21 @@ def extract_z3_variables(env: Env) -> list:
     return z3_vars
 
 
-s = Solver()  # contains assertions
-
-
-# Verify function, now handling array constraints
-def verify(P: Invariant, ast: Tree, Q: Invariant, linv: Invariant) -> bool:
-    pvars = collect_vars(ast)
-    env = mk_env(pvars)
-    result = wp(Q, ast, linv, env)
-    s.add(ForAll(list(extract_z3_variables(env)), Implies(P(env), result(env))))
-    if s.check() == unsat:
-        return False
-    else:
-        mod = s.model()
-        # printing the model_list for debugging purposes
-        model_list = {key: mod[key] for key in mod if 'hole_z' not in str(key)}
-        print(model_list)
-        return True
+# builds the verification condition of a program, sharing sub-formulas through named definitions.
+# universal=True binds the names for use under ForAll, otherwise they are left free (existential)
+def vc(Q: Invariant, ast: Tree, linv: Invariant, env: Env, universal: bool = False):
+    open_vc_scope()
+    try:
+        result = wp(Q, ast, linv, env)(env)
+    finally:
+        names, definitions = close_vc_scope()
+    result = current_session().formula(result)
+    if universal:
+        return names, definitions, result
+    return And(*definitions, result)
+
+
+# Verify function, now handling array constraints (in a fresh session)
+def verify(P: Invariant, ast: Tree, Q: Invariant, linv: Invariant, limits: Limits | None = None,
+           encoding: IntEncoding | None = None) -> Verdict:
+    return VerificationSession(limits=limits, encoding=encoding).verify(P, ast, Q, linv)
@@ -0,0 +1,259 @@
+from z3 import K, Store, Not, is_expr, is_true, is_false
+from final.main_program import (OP, eval_expr, build_external, update_array, init_dims, break_while_to_ifs,
+                                current_session, empty_array, Env, Invariant, MAX_UNROLL)
+from final.passive_form import PassiveProgram, merge, cut_off
+from final.syntax.tree import Tree
+
+
+# An array whose elements are all known: python lists (a list of rows for 2 dimensional arrays) and
+# the lengths a symbolic array tuple carries. Arrays are never changed in place, an update makes a copy,
+# so both branches of an if can share them. The z3 array is built only when a hole's value reaches it
+class ConcreteArray:
+    __slots__ = ("elements", "length", "inner_length", "z3_array")
+
+    def __init__(self, elements: list, length: int, inner_length: int = -1):
+        self.elements = elements
+        self.length = length
+        self.inner_length = inner_length
+        self.z3_array = None  # (ctx, array tuple) built by symbolic()
+
+    def __repr__(self):
+        return "<ConcreteArray {0}>".format(self.elements)
+
+    # the array tuple build_external makes for the same elements
+    def symbolic(self) -> tuple:
+        session = current_session()
+        if self.z3_array is None or self.z3_array[0] is not session.ctx:
+            if self.inner_length == -1:
+                array = store_all(empty_array(), self.elements)
+            else:
+                array = K(session.encoding.sort(session.ctx), empty_array())
+                for idx, row in enumerate(self.elements):
+                    array = Store(array, idx, store_all(empty_array(), row))
+            self.z3_array = (session.ctx, (array, self.length, self.inner_length))
+        return self.z3_array[1]
+
+
+def store_all(array, values: list):
+    for idx, val in enumerate(values):
+        array = Store(array, idx, val)
+    return array
+
+
+# raised when a part of the program depends on a hole and has to be evaluated symbolically
+class NotConcrete(Exception):
+    pass
+
+
+# the environment the symbolic helpers (eval_expr, update_array, linv and Q) expect
+def symbolic_env(env: Env) -> Env:
+    return {var: value.symbolic() if isinstance(value, ConcreteArray) else value for var, value in env.items()}
+
+
+# z3 numbers and truth values that simplify returned, back as python values
+def to_python(value):
+    if is_expr(value):
+        number = current_session().encoding.number(value)
+        if number is not None:
+            return number
+        if is_true(value):
+            return True
+        if is_false(value):
+            return False
+    return value
+
+
+def is_concrete(value) -> bool:
+    return type(value) is int or type(value) is bool
+
+
+# evaluates an expression over concrete values only, raises NotConcrete when it meets a hole or a z3 term
+def concrete_value(expr: Tree, env: Env, linv: Invariant):
+    root = str(expr.root)
+    if root == "num":
+        return int(expr.subtrees[0].root)
+    if root == "id":
+        value = env.get(expr.subtrees[0].root, False)
+        if is_concrete(value) or isinstance(value, ConcreteArray):
+            return value
+        raise NotConcrete()
+    if root in OP:
+        left = concrete_value(expr.subtrees[0], env, linv)
+        right = concrete_value(expr.subtrees[1], env, linv)
+        if not is_concrete(left) or not is_concrete(right):
+            raise NotConcrete()
+        return current_session().encoding.apply(root, left, right)
+    if root == "array_access":
+        array = env[expr.subtrees[0].subtrees[0].root]
+        if not isinstance(array, ConcreteArray) or (len(expr.subtrees) == 3) != (array.inner_length != -1):
+            raise NotConcrete()  # the symbolic path reports the unsupported accesses
+        index = concrete_value(expr.subtrees[1], env, linv)
+        inner_index = concrete_value(expr.subtrees[2].subtrees[0], env, linv) if len(expr.subtrees) == 3 else -1
+        if type(index) is not int or type(inner_index) is not int:
+            raise NotConcrete()
+        if not 0 <= index < array.length or (array.inner_length != -1 and not 0 <= inner_index < array.inner_length):
+            return 0  # like a z3 array, cells out of bounds hold the default value
+        row = array.elements[index]
+        return row if array.inner_length == -1 else row[inner_index]
+    if root.startswith("hole_") or root == "num_list":
+        raise NotConcrete()
+    return False  # like eval_expr for unrecognized expressions
+
+
+# evaluates an expression natively when it does not depend on a hole, with eval_expr otherwise
+def expression(expr: Tree, env: Env, linv: Invariant):
+    try:
+        return concrete_value(expr, env, linv)
+    except NotConcrete:
+        return to_python(eval_expr(expr, symbolic_env(env), linv))
+
+
+# the elements of a one dimensional array initialization (like parse_num_list)
+def concrete_numbers(tree: Tree, env: Env, linv: Invariant) -> list:
+    root = str(tree.root)
+    if root == "num_list":
+        numbers = concrete_numbers(tree.subtrees[0], env, linv)
+        if len(tree.subtrees) > 2 and str(tree.subtrees[2].root) == "num_list":
+            numbers.extend(concrete_numbers(tree.subtrees[2], env, linv))
+        return numbers
+    if root == "comma":
+        return []
+    if root in ("num", "id", "array_access") or root in OP:
+        value = concrete_value(tree, env, linv)
+        if not is_concrete(value):
+            raise NotConcrete()
+        return [value]
+    raise NotConcrete()
+
+
+# the rows of a two dimensional array initialization (like build_nested)
+def concrete_rows(tree: Tree, env: Env, linv: Invariant) -> list:
+    if init_dims(tree) == 1:
+        return [concrete_numbers(tree, env, linv)]
+    rows = []
+    if tree.root == "num_list":
+        if len(tree.subtrees) == 3 and tree.subtrees[0].root == "lbracket" and tree.subtrees[1].root == "num_list":
+            rows.extend(concrete_rows(tree.subtrees[1], env, linv))
+        else:
+            rows.extend(concrete_rows(tree.subtrees[0], env, linv))
+            rows.extend(concrete_rows(tree.subtrees[2], env, linv))
+    return rows
+
+
+# the value of an array initialization, with the lengths build_array gives it
+def initializer(tree: Tree, env: Env, linv: Invariant):
+    try:
+        if init_dims(tree) == 1:
+            numbers = concrete_numbers(tree, env, linv)
+            return ConcreteArray(numbers, len(numbers))
+        rows = concrete_rows(tree, env, linv)
+    except NotConcrete:
+        return build_external(tree, symbolic_env(env), linv)
+    if any(len(row) != len(rows[0]) for row in rows):
+        raise ValueError("array initialization is not valid")
+    # build_array takes the length of a single row as the outer length too
+    return ConcreteArray(rows, len(rows[0]) if len(rows) == 1 else len(rows), len(rows[0]))
+
+
+# the value of an array update, copied and updated natively when the array, the indices and the value are known
+def updated(c: Tree, env: Env, linv: Invariant):
+    array = env[c.subtrees[0].subtrees[0].root]
+    try:
+        if not isinstance(array, ConcreteArray):
+            raise NotConcrete()
+        nested = len(c.subtrees) == 4
+        index = concrete_value(c.subtrees[1], env, linv)
+        inner_index = concrete_value(c.subtrees[2].subtrees[0], env, linv) if nested else -1
+        value = concrete_value(c.subtrees[3] if nested else c.subtrees[2], env, linv)
+        if not (type(index) is int and type(inner_index) is int and is_concrete(value)):
+            raise NotConcrete()
+    except NotConcrete:
+        return update_array(c, symbolic_env(env), linv)
+    in_bounds = 0 <= index < array.length and (array.inner_length == -1 or 0 <= inner_index < array.inner_length)
+    if array.inner_length == -1 and inner_index != -1:
+        raise ValueError("Array access out of bounds")
+    elif not in_bounds and linv(symbolic_env(env)):  # Boundary check assertion
+        raise ValueError("Array access out of bounds")
+    if not in_bounds or nested != (array.inner_length != -1):
+        return update_array(c, symbolic_env(env), linv)  # stores outside of the lists
+    elements = list(array.elements)
+    if nested:
+        elements[index] = list(elements[index])
+        elements[index][inner_index] = value
+    else:
+        elements[index] = value
+    return ConcreteArray(elements, array.length, array.inner_length)
+
+
+# runs a loop-free command on a concrete input. Known values stay python values and only the branch
+# taken is run; values a hole flows into become versions of a passive program, and ifs on them are merged
+def execute(c: Tree, env: Env, linv: Invariant, program: PassiveProgram, guard: list) -> Env:
+    if c.root == "skip":
+        return env
+
+    if c.root == ":=":
+        var = c.subtrees[0].subtrees[0].root
+        env[var] = program.version(var, expression(c.subtrees[1], env, linv))
+        return env
+
+    if c.root == "array_init":
+        array_name = c.subtrees[0].subtrees[0].root
+        env[array_name] = program.version(array_name, initializer(c.subtrees[1].subtrees[0], env, linv))
+        return env
+
+    if c.root == "array_update":
+        array_name = c.subtrees[0].subtrees[0].root
+        env[array_name] = program.version(array_name, updated(c, env, linv))
+        return env
+
+    if c.root == ";":
+        env = execute(c.subtrees[0], env, linv, program, guard)
+        return execute(c.subtrees[1], env, linv, program, guard)
+
+    if c.root == "if":
+        cond = expression(c.subtrees[0], env, linv)
+        if isinstance(cond, bool):
+            return execute(c.subtrees[1] if cond else c.subtrees[2], env, linv, program, guard)
+        true_env = execute(c.subtrees[1], env.copy(), linv, program, guard + [cond])
+        false_env = execute(c.subtrees[2], env.copy(), linv, program, guard + [Not(cond)])
+        for branch, other in ((true_env, false_env), (false_env, true_env)):
+            for var, value in branch.items():  # arrays changed on one path only are merged as z3 arrays
+                if isinstance(value, ConcreteArray) and other.get(var) is not value:
+                    branch[var] = value.symbolic()
+        return merge(program, cond, true_env, false_env)
+
+    if c.root == "while":
+        return execute(break_while_to_ifs(c), env, linv, program, guard)
+
+    if c.root == "unwound":
+        cond = expression(c.subtrees[1], env, linv)
+        cut_off(program, int(c.subtrees[0].subtrees[0].root), guard, cond, remaining(c, env, linv, cond))
+        return env
+
+    if c.root == "assert":
+        program.obligation("assert", guard, expression(c.subtrees[0], env, linv))
+        return env
+
+    raise ValueError(f"Unknown command: {c.root}")
+
+
+# the number of iterations a run cut off at an "unwound" command still needs, found by running the body
+# further on the known values. None when a hole's value decides it, or after MAX_UNROLL iterations
+def remaining(c: Tree, env: Env, linv: Invariant, cond) -> int | None:
+    iterations, scratch = 0, PassiveProgram()  # what the extra iterations define is thrown away
+    while cond is True and iterations < MAX_UNROLL:
+        try:
+            env = execute(c.subtrees[2], dict(env), linv, scratch, [])
+        except ValueError:
+            return None
+        iterations += 1
+        cond = expression(c.subtrees[1], env, linv)
+    return iterations if cond is False else None
+
+
+# Partial evaluation of a loop-free program on the input of an example: the residual program holds
+# definitions only for the values that depend on holes, its final state has the arrays as z3 arrays
+def residual_program(ast: Tree, linv: Invariant, inputs: Env) -> PassiveProgram:
+    program = PassiveProgram()
+    program.env = symbolic_env(execute(ast, dict(inputs), linv, program, []))
+    return program
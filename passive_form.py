@@ -0,0 +1,437 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from z3 import (Z3_OP_UNINTERPRETED, Context, FreshConst, If, And, Not, Implies, BoolSort, Solver, sat, unsat,
+                unknown, substitute, is_expr, is_const, is_and)
+from final.main_program import (eval_expr, build_external, update_array, same_value, mk_env, collect_vars,
+                                extract_z3_variables, break_while_to_ifs, current_session, VerificationSession, Env,
+                                Limits, Verdict, SolverUnknown, VERIFIED, REFUTED, UNKNOWN, find_holes,
+                                Formula, Invariant, PVar)
+from final.syntax.tree import Tree
+from final.syntax.while_lang import pretty, statements
+
+
+# A loop-free program in static single assignment (passive) form:
+# every assignment defines a new version of its variable with one equality,
+# and the state at the end of the program maps each variable to its last version
+class PassiveProgram:
+    def __init__(self):
+        self.definitions = []  # version == value, one per assignment / phi node
+        self.obligations = []  # assertions, guarded by the path condition that reaches them
+        self.sources = []  # (what it checks: assert, bounds, initiation or preservation, statement, number of
+        # assumptions made before it) per obligation
+        self.assumptions = []  # facts about havoced variables, guarded by their path condition, in program order
+        self.env = {}  # last version of every variable
+        self.cutoffs = []  # (loop number, path condition, iterations still needed or None) where a loop is cut off
+        self.havoc = False  # whether loops are translated with their invariant instead of being unrolled
+        self.bounds = False  # whether every array access gets a bounds obligation
+
+    # defines a new version of var; concrete values and plain constants are propagated without a definition
+    def version(self, var: PVar, value):
+        if isinstance(value, tuple):  # arrays are versioned by their z3 array, lengths are static
+            return (self.version(var, value[0]), *value[1:])
+        if not is_expr(value) or is_const(value) or is_ground(value):
+            return value
+        name = FreshConst(value.sort(), var)
+        self.definitions.append(name == value)
+        return name
+
+    # adds an obligation of a statement, guarded by the path condition that reaches it
+    def obligation(self, label: str, guard: list, formula, statement: Tree | None = None) -> None:
+        self.obligations.append(guarded(guard, formula))
+        self.sources.append((label, statement, len(self.assumptions)))
+
+    # a formula under the first count assumptions: an obligation may only use the facts of the loops before it,
+    # the exit state of a loop says nothing about its own initiation and preservation
+    def assumed(self, count: int, formula) -> Formula:
+        return guarded(self.assumptions[:count], formula)
+
+    # the obligations one by one and every conjunct of Q on the final state, in the context of the current
+    # session. The statements are numbered from 1 in the order of the program text of ast
+    def checks(self, Q: Invariant, ast: Tree | None = None) -> list:
+        session = current_session()
+        numbers = {} if ast is None else {id(s): n for n, s in enumerate(statements(ast), 1)}
+        checks = [Obligation(label, session.formula(self.assumed(count, formula)), statement,
+                             numbers.get(id(statement)))
+                  for (label, statement, count), formula in zip(self.sources, self.obligations)]
+        return checks + [Obligation("postcondition", session.formula(self.assumed(len(self.assumptions), f)))
+                         for f in conjuncts(session.formula(Q(self.env)))]
+
+    # the flat conjunction of all equalities and obligations, with Q checked on the final state
+    def formula(self, Q: Invariant) -> Formula:
+        return And(*self.definitions, *self.goal(Q))
+
+    # the obligations and Q on the final state, each under the assumptions before it, in the context of the
+    # current session
+    def goal(self, Q: Invariant) -> list:
+        session = current_session()
+        goals = [self.assumed(count, f) for (_, _, count), f in zip(self.sources, self.obligations)]
+        return [session.formula(f) for f in goals + [self.assumed(len(self.assumptions), Q(self.env))]]
+
+    # the same formula with every version replaced by its value, for use under quantifiers
+    def inline(self, Q: Invariant) -> Formula:
+        values = []
+        for definition in self.definitions:
+            name, value = definition.arg(0), definition.arg(1)
+            values.append((name, substitute(value, *values) if values else value))
+        goal = And(*self.goal(Q))
+        return substitute(goal, *values) if values else goal
+
+
+# checks whether a term is built from literals only (e.g. an array initialized with numbers),
+# such terms are kept as they are so that array accesses on them still simplify to numbers
+def is_ground(term) -> bool:
+    todo, seen = [term], set()
+    while todo:
+        t = todo.pop()
+        if t.get_id() in seen:
+            continue
+        seen.add(t.get_id())
+        if is_const(t) and t.decl().kind() == Z3_OP_UNINTERPRETED:
+            return False
+        todo.extend(t.children())
+    return True
+
+
+# guards a formula with the path condition
+def guarded(guard: list, formula: Formula) -> Formula:
+    if any(g is False for g in guard):
+        return True
+    conds = [g for g in guard if g is not True]
+    return Implies(And(*conds), formula) if conds else formula
+
+
+# One proof obligation: what it checks (assert, bounds, initiation, preservation or postcondition) and the
+# statement it comes from with its number in the program. Once solved, its status, z3's reason when unknown
+# and the seconds the solver took
+class Obligation:
+    def __init__(self, label: str, formula: Formula, statement: Tree | None = None, location: int | None = None):
+        self.label = label
+        self.formula = formula
+        self.statement = statement
+        self.location = location
+        self.status = None
+        self.reason = None
+        self.seconds = None
+
+    def __repr__(self):
+        return "<Obligation {0}{1}: {2}>".format(
+            self.label, "" if self.location is None else " at statement {0}".format(self.location), self.status)
+
+    def __str__(self):
+        where = "" if self.statement is None else " of statement {0} ({1})".format(self.location,
+                                                                                   pretty(self.statement))
+        return "{0}{1}: {2}".format(self.label, where, self.status)
+
+
+# the conjuncts of a formula, nested conjunctions flattened
+def conjuncts(formula: Formula) -> list:
+    if is_and(formula):
+        return [f for child in formula.children() for f in conjuncts(child)]
+    return [formula]
+
+
+# records the path condition under which an unrolled loop would run once more than it was unrolled,
+# and how many more iterations it needs when that is known
+def cut_off(program: PassiveProgram, index: int, guard: list, cond, remaining: int | None = None) -> None:
+    if cond is False or any(g is False for g in guard):
+        return
+    conds = [g for g in guard + [cond] if g is not True]
+    program.cutoffs.append((index, And(*conds) if conds else True, remaining))
+
+
+# the variables a command assigns to
+def assigned_vars(c: Tree) -> set[PVar]:
+    return {node.subtrees[0].subtrees[0].root for node in c.iter_nodes()
+            if node.root in (":=", "array_init", "array_update")}
+
+
+# an environment where the given variables have arbitrary new values (array lengths are static)
+def havoc(env: Env, variables: set[PVar]) -> Env:
+    ctx = current_session().ctx
+    env = dict(env)
+    for var in variables:
+        value = env[var]
+        if isinstance(value, tuple):
+            env[var] = (FreshConst(value[0].sort(), var), *value[1:])
+        else:
+            sort = value.sort() if is_expr(value) else BoolSort(ctx) if isinstance(value, bool) else \
+                current_session().encoding.sort(ctx)
+            env[var] = FreshConst(sort, var)
+    return env
+
+
+# merges the states of both branches of an if statement with phi definitions
+def merge(program: PassiveProgram, cond, true_env: Env, false_env: Env) -> Env:
+    merged = {}
+    for var in list(true_env) + [v for v in false_env if v not in true_env]:
+        if var not in false_env or var not in true_env:  # defined on one path only
+            merged[var] = true_env.get(var, false_env.get(var))
+            continue
+        true_value, false_value = true_env[var], false_env[var]
+        if same_value(true_value, false_value):
+            merged[var] = true_value
+        elif isinstance(cond, bool):
+            merged[var] = true_value if cond else false_value
+        elif isinstance(true_value, tuple):
+            if not isinstance(false_value, tuple) or true_value[1:] != false_value[1:]:
+                raise ValueError(f"array {var} has different shapes after if")
+            merged[var] = program.version(var, (If(cond, true_value[0], false_value[0]), *true_value[1:]))
+        else:
+            merged[var] = program.version(var, If(cond, true_value, false_value))
+    return merged
+
+
+# translates a command into passive form, env holds the current version of every variable
+def translate(c: Tree, env: Env, linv: Invariant, program: PassiveProgram, guard: list) -> Env:
+    if c.root == "skip":
+        return env
+
+    if program.bounds:
+        bounds_checks(c, env, linv, program, guard)
+
+    if c.root == ":=":
+        var = c.subtrees[0].subtrees[0].root
+        env[var] = program.version(var, eval_expr(c.subtrees[1], env, linv))
+        return env
+
+    if c.root == "array_init":
+        array_name = c.subtrees[0].subtrees[0].root
+        elements = [build_external(element, env, linv) for element in c.subtrees[1].subtrees]
+        env[array_name] = program.version(array_name, elements[0])
+        return env
+
+    if c.root == "array_update":
+        array_name = c.subtrees[0].subtrees[0].root
+        env[array_name] = program.version(array_name, update_array(c, env, linv))
+        return env
+
+    if c.root == ";":
+        env = translate(c.subtrees[0], env, linv, program, guard)
+        return translate(c.subtrees[1], env, linv, program, guard)
+
+    if c.root == "if":
+        cond = eval_expr(c.subtrees[0], env, linv)
+        if isinstance(cond, bool):  # a known condition: the other branch is dead code
+            return translate(c.subtrees[1] if cond else c.subtrees[2], env, linv, program, guard)
+        true_env = translate(c.subtrees[1], env.copy(), linv, program, guard + [cond])
+        false_env = translate(c.subtrees[2], env.copy(), linv, program, guard + [Not(cond)])
+        return merge(program, cond, true_env, false_env)
+
+    if c.root == "while" and program.havoc:
+        return translate_loop(c, env, linv, program, guard)
+
+    if c.root == "while":
+        return translate(break_while_to_ifs(c), env, linv, program, guard)
+
+    if c.root == "unwound":
+        cut_off(program, int(c.subtrees[0].subtrees[0].root), guard, eval_expr(c.subtrees[1], env, linv))
+        return env
+
+    if c.root == "assert":
+        program.obligation("assert", guard, eval_expr(c.subtrees[0], env, linv), c)
+        return env
+
+    raise ValueError(f"Unknown command: {c.root}")
+
+
+# the expressions a statement evaluates before it runs (a loop condition is checked with the loop)
+def evaluated(c: Tree) -> list:
+    if c.root in (":=", "assert", "if"):
+        return [c.subtrees[-1] if c.root == ":=" else c.subtrees[0]]
+    if c.root == "array_init":
+        return [c.subtrees[1]]
+    if c.root == "array_update":  # the updated cell is checked like an access
+        return [Tree("array_access", c.subtrees[:-1]), c.subtrees[-1]]
+    return []
+
+
+# the condition that an array access is within the lengths of its array
+def in_bounds(access: Tree, env: Env, linv: Invariant):
+    _, length, inner_length = env[access.subtrees[0].subtrees[0].root]
+    indices = [(access.subtrees[1], length)]
+    if len(access.subtrees) == 3 and inner_length != -1:
+        indices.append((access.subtrees[2].subtrees[0], inner_length))
+    conds = []
+    for index, bound in indices:
+        value = eval_expr(index, env, linv)
+        conds.extend([value >= 0, value < bound] if is_expr(value) else [0 <= value < bound])
+    return And(*conds) if any(is_expr(cond) for cond in conds) else all(conds)
+
+
+# adds a bounds obligation for every array access in the expressions of a statement
+def bounds_checks(c: Tree, env: Env, linv: Invariant, program: PassiveProgram, guard: list,
+                  expressions: list | None = None) -> None:
+    for expr in evaluated(c) if expressions is None else expressions:
+        for node in expr.iter_nodes():
+            if node.root == "array_access":
+                program.obligation("bounds", guard, in_bounds(node, env, linv), c)
+
+
+# a loop with linv as its invariant, without quantifiers or unrolling: linv must hold on entry (initiation),
+# one iteration from an arbitrary state satisfying linv and the condition must restore it (preservation),
+# and the program goes on from an arbitrary state satisfying linv but not the condition. The preservation
+# and exit states are fresh constants of their own, so that their assumptions do not contradict each other
+def translate_loop(c: Tree, env: Env, linv: Invariant, program: PassiveProgram, guard: list) -> Env:
+    if linv is None:
+        raise ValueError(f"Linv is None")
+    loop_cond, loop_body = c.subtrees
+    program.obligation("initiation", guard, linv(env), c)
+    modified = assigned_vars(loop_body)
+    iteration = havoc(env, modified)
+    encoding = current_session().encoding
+    program.assumptions.extend(encoding.ranges(iteration[var] for var in modified))
+    if program.bounds:  # the condition is evaluated in every state satisfying linv
+        bounds_checks(c, iteration, linv, program, guard + [linv(iteration)], [loop_cond])
+    entered = guard + [linv(iteration), eval_expr(loop_cond, iteration, linv)]
+    after = translate(loop_body, dict(iteration), linv, program, entered)
+    program.obligation("preservation", entered, linv(after), c)
+    exit_env = havoc(env, modified)
+    program.assumptions.extend(encoding.ranges(exit_env[var] for var in modified))
+    program.assumptions.append(guarded(guard, And(linv(exit_env), Not(eval_expr(loop_cond, exit_env, linv)))))
+    return exit_env
+
+
+# Passive form of a program, starting from the given environment. With havoc=True loops are checked
+# against linv (see translate_loop) instead of being unrolled, with bounds=True array accesses are checked
+def to_passive(ast: Tree, linv: Invariant, env: Env, havoc: bool = False, bounds: bool = False) -> PassiveProgram:
+    program = PassiveProgram()
+    program.havoc = havoc
+    program.bounds = bounds
+    program.env = translate(ast, dict(env), linv, program, [])
+    return program
+
+
+# Verify a loop-free program through its passive form (in a fresh session unless one is given).
+# under the quantifier the versions are substituted back, z3 shares the repeated terms
+def verify_passive(P: Invariant, ast: Tree, Q: Invariant, linv: Invariant,
+                   session: VerificationSession | None = None, limits: Limits | None = None) -> Verdict:
+    session = VerificationSession() if session is None else session
+    with session:
+        env = mk_env(collect_vars(ast))
+        program = to_passive(ast, linv, env)
+        hypotheses = And(session.formula(P(env)), *session.encoding.ranges(env.values()))
+        return session.prove(extract_z3_variables(env), Implies(hypotheses, program.inline(Q)), limits)
+
+
+# Verify a hole-free program with loops as separate quantifier-free checks: every obligation (initiation and
+# preservation of each loop, each assert and array access, and each conjunct of Q) is a query of its own over P
+# and the definitions, under the exit assumptions of the loops before it. The obligations are shared out to
+# max_workers threads (the number of cpus by default), each with a z3 context of its own, z3 releases the GIL
+# while it solves.
+# verdict.obligations holds the obligations with their status and time, verdict.attempts their (label, status, reason)
+def verify_havoc(P: Invariant, ast: Tree, Q: Invariant, linv: Invariant, session: VerificationSession | None = None,
+                 limits: Limits | None = None, max_workers: int | None = None) -> Verdict:
+    if find_holes(ast):
+        raise ValueError("holes must be filled before the loops are checked")
+    session = VerificationSession() if session is None else session
+    with session:
+        env = mk_env(collect_vars(ast))
+        program = to_passive(ast, linv, env, havoc=True, bounds=True)
+        hypotheses = And(session.formula(P(env)), *session.encoding.ranges(env.values()), *program.definitions)
+        obligations = program.checks(Q, ast)
+        limits = session.limits if limits is None else limits
+        workers = max(1, min(len(obligations), max_workers or os.cpu_count() or 1))
+        shares = [obligations[k::workers] for k in range(workers)]
+        queries = [query(hypotheses, share, limits) for share in shares]  # built before any thread starts
+    try:
+        if workers == 1:
+            results = [solve(*queries[0])]
+        else:
+            with ThreadPoolExecutor(workers) as pool:
+                results = list(pool.map(lambda q: solve(*q), queries))
+    finally:
+        release(solver.ctx for solver, _ in queries)
+    for share, statuses in zip(shares, results):
+        for obligation, (status, reason, seconds) in zip(share, statuses):
+            obligation.status, obligation.reason, obligation.seconds = status, reason, seconds
+    attempts = [(obligation.label, obligation.status, obligation.reason) for obligation in obligations]
+    for status in (REFUTED, UNKNOWN):
+        failed = [obligation for obligation in obligations if obligation.status == status]
+        if failed:
+            return Verdict(status, failed[0].reason, attempts, obligations)
+    return Verdict(VERIFIED, None, attempts, obligations)
+
+
+spare_contexts = []  # z3 contexts of finished checks, creating a context takes milliseconds
+spare_lock = threading.Lock()  # verify_havoc may run in several threads at once
+MAX_SPARE_CONTEXTS = os.cpu_count() or 1  # a context keeps the terms built in it, the others are dropped
+
+
+def release(contexts) -> None:
+    with spare_lock:
+        for ctx in contexts:
+            if len(spare_contexts) < MAX_SPARE_CONTEXTS:
+                spare_contexts.append(ctx)
+
+
+# a spare context, or a new one
+def spare_context() -> Context:
+    with spare_lock:
+        ctx = spare_contexts.pop() if spare_contexts else None
+    return Context() if ctx is None else ctx
+
+
+# a solver holding the hypotheses in a context of its own, and the negations of the obligations in that context
+def query(hypotheses: Formula, obligations: list, limits: Limits) -> tuple:
+    ctx = spare_context()
+    solver = limits.apply(Solver(ctx=ctx))
+    solver.add(hypotheses.translate(ctx))
+    return solver, [Not(obligation.formula).translate(ctx) for obligation in obligations]
+
+
+# checks the negations one by one: the status of each obligation, z3's reason when unknown and the seconds taken
+def solve(solver: Solver, negations: list) -> list:
+    results = []
+    for negation in negations:
+        start = time.perf_counter()
+        solver.push()
+        solver.add(negation)
+        result = solver.check()
+        reason = solver.reason_unknown() if result == unknown else None
+        solver.pop()
+        status = UNKNOWN if result == unknown else VERIFIED if result == unsat else REFUTED
+        results.append((status, reason, time.perf_counter() - start))
+    return results
+
+
+# searches an input satisfying P on which a hole-free, loop-free program violates Q or an assert.
+# returns the values of the program variables in that input, or None if the program is correct.
+# raises SolverUnknown when the solver gives up
+def find_counterexample(P: Invariant, ast: Tree, Q: Invariant, linv: Invariant) -> dict | None:
+    env = mk_env(collect_vars(ast))
+    program = to_passive(ast, linv, env)
+    session = current_session()
+    solver = session.new_solver()
+    solver.add(session.formula(P(env)), *session.encoding.ranges(env.values()), *program.definitions,
+               Not(And(*program.goal(Q))))
+    result = session.check(solver)
+    if result == unknown:
+        raise SolverUnknown(session.reason_of(solver))
+    if result != sat:
+        return None
+    model = session.model_of(solver)
+    return {var: session.encoding.number(model.eval(value, model_completion=True))
+            for var, value in env.items() if not isinstance(value, tuple)}
+
+
+# the loops of an unrolled program that some input satisfying P still runs after their last copy,
+# i.e. the loops whose depth the result depends on. The path conditions are checked in one solver
+def cut_loops(P: Invariant, ast: Tree, linv: Invariant) -> set[int]:
+    env = mk_env(collect_vars(ast))
+    program = to_passive(ast, linv, env)
+    session = current_session()
+    solver = session.new_solver()
+    solver.add(session.formula(P(env)), *program.definitions)
+    cut = set()
+    for index, reached, _ in program.cutoffs:
+        if index in cut:
+            continue
+        solver.push()
+        solver.add(session.formula(reached))
+        if session.check(solver) != unsat:  # unknown counts as reachable
+            cut.add(index)
+        solver.pop()
+    return cut
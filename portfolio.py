@@ -0,0 +1,187 @@
+import multiprocessing
+import time
+from multiprocessing.connection import wait
+
+from z3 import (Context, Solver, Then, Not, FreshConst, parse_smt2_string, substitute_vars, is_quantifier, sat, unsat,
+                unknown)
+from final.main_program import Limits, free_constants, constants
+from final.smtlib import Answer, read_values
+
+
+# A solver configuration of the portfolio: a tactic pipeline (None for z3's default solver), solver parameters
+# and the encoding of the query. "quantified" checks the query as it is, "quantifier-free" proves every
+# assertion valid by checking its negated body instead, for queries without free constants (no holes)
+class Configuration:
+    def __init__(self, name: str, tactics: tuple | None = None, params: dict | None = None,
+                 encoding: str = "quantified"):
+        self.name = name
+        self.tactics = tactics
+        self.params = {} if params is None else params
+        self.encoding = encoding
+
+    def __repr__(self):
+        return "<Configuration {0}>".format(self.name)
+
+    def solver(self, ctx: Context, limits: Limits) -> Solver:
+        solver = Solver(ctx=ctx) if self.tactics is None else Then(*self.tactics, ctx=ctx).solver()
+        limits.apply(solver)
+        for name, value in self.params.items():
+            solver.set(name, value)
+        return solver
+
+
+CONFIGURATIONS = [
+    Configuration("default"),
+    Configuration("mbqi", params={"smt.auto_config": False, "smt.mbqi": True, "smt.ematching": False}),
+    Configuration("qe", tactics=("simplify", "qe", "smt")),
+    Configuration("lia", tactics=("simplify", "propagate-values", "solve-eqs", "smt")),
+    Configuration("seed 1", params={"random_seed": 1, "smt.random_seed": 1}),
+    Configuration("quantifier-free", encoding="quantifier-free"),
+]
+
+
+# Outcome of a portfolio run: "sat", "unsat" or "unknown", the configuration that answered first, the model
+# it found (names of the constants to SMT-LIB values) and the answer of every configuration that finished
+# before the others were cancelled: name -> (result, reason, seconds)
+class PortfolioResult:
+    def __init__(self, result: str, winner: str | None, seconds: float, answers: dict, model: dict | None = None):
+        self.result = result
+        self.winner = winner
+        self.seconds = seconds
+        self.answers = answers
+        self.model = model
+
+    @property
+    def reason(self) -> str | None:
+        if self.result != "unknown":
+            return None
+        return "; ".join("{0}: {1}".format(name, answer[1]) for name, answer in self.answers.items())
+
+    # the outcome as an answer over the constants of the assertions it was run on, with the model as z3 values
+    def answer(self, assertions) -> Answer:
+        result = {"sat": sat, "unsat": unsat}.get(self.result, unknown)
+        if result != sat or not assertions:
+            return Answer(result, self.reason, seconds=self.seconds)
+        names = {}
+        for assertion in assertions:
+            names.update((str(constant), constant) for constant in constants(assertion).values())
+        response = "({0})".format(" ".join("({0} {1})".format(names[name].sexpr(), value)
+                                           for name, value in (self.model or {}).items() if name in names))
+        values = read_values(response, {constant.sexpr(): constant for constant in names.values()},
+                             assertions[0].ctx)
+        return Answer(result, None, values, self.seconds, assertions[0].ctx)
+
+    def __repr__(self):
+        return "<PortfolioResult {0} by {1} ({2:.3f}s)>".format(self.result, self.winner, self.seconds)
+
+
+# the class of a query that the wins are counted by: whether it has quantifiers and arrays
+def query_class(smt2: str) -> str:
+    quantified = "(forall" in smt2 or "(exists" in smt2
+    arrays = "(Array" in smt2
+    return "{0}{1}".format("quantified" if quantified else "quantifier-free", " arrays" if arrays else "")
+
+
+# Races solver configurations on the same query, each in a process of its own: the first definitive answer
+# wins and the other processes are terminated. At most max_workers configurations run at once (all by
+# default), the ones that won most often for the class of the query start first. wins counts the winners
+# per query class, the defaults to start from
+class Portfolio:
+    def __init__(self, configurations=CONFIGURATIONS, max_workers: int | None = None):
+        self.configurations = list(configurations)
+        self.max_workers = max_workers
+        self.wins = {}  # query class -> {configuration name: wins}
+
+    # the configurations, the ones that won most often for the class first
+    def ordered(self, cls: str) -> list:
+        wins = self.wins.get(cls, {})
+        return sorted(self.configurations, key=lambda configuration: -wins.get(configuration.name, 0))
+
+    # the configuration that won most often for every query class
+    def defaults(self) -> dict:
+        return {cls: max(wins, key=wins.get) for cls, wins in self.wins.items()}
+
+    # checks the conjunction of the assertions (z3 formulas of one context)
+    def run(self, assertions, limits: Limits | None = None) -> PortfolioResult:
+        start = time.perf_counter()
+        limits = Limits() if limits is None else limits
+        query = Solver(ctx=assertions[0].ctx) if assertions else Solver()
+        query.add(*assertions)
+        smt2 = query.sexpr()
+        cls = query_class(smt2)
+        pending = self.ordered(cls)
+        running = {}  # connection -> (configuration, process)
+        answers, winner, model = {}, None, None
+        try:
+            while (pending or running) and winner is None:
+                while pending and len(running) < (self.max_workers or len(self.configurations)):
+                    configuration = pending.pop(0)
+                    receiver, sender = multiprocessing.Pipe(duplex=False)
+                    process = multiprocessing.Process(target=run_configuration,
+                                                      args=(configuration, smt2, limits, sender), daemon=True)
+                    process.start()
+                    sender.close()
+                    running[receiver] = (configuration, process)
+                for receiver in wait(list(running)):
+                    configuration, process = running.pop(receiver)
+                    try:
+                        result, reason, seconds, found = receiver.recv()
+                    except EOFError:  # the process died, e.g. out of memory
+                        result, reason, seconds, found = "unknown", "process exited", None, None
+                    receiver.close()
+                    answers[configuration.name] = (result, reason, seconds)
+                    if result != "unknown" and winner is None:
+                        winner, model = configuration.name, found
+        finally:
+            for receiver, (_, process) in running.items():
+                process.terminate()
+                receiver.close()
+            for _, process in running.values():
+                process.join()
+        if winner is not None:
+            wins = self.wins.setdefault(cls, {})
+            wins[winner] = wins.get(winner, 0) + 1
+        result = answers[winner][0] if winner is not None else "unknown"
+        return PortfolioResult(result, winner, time.perf_counter() - start, answers, model)
+
+
+# runs one configuration on the query in a process, and sends (result, reason, seconds, model) back
+def run_configuration(configuration: Configuration, smt2: str, limits: Limits, sender) -> None:
+    start = time.perf_counter()
+    try:
+        ctx = Context()
+        assertions = parse_smt2_string(smt2, ctx=ctx)
+        if configuration.encoding == "quantifier-free":
+            result, reason, model = check_valid(configuration, assertions, ctx, limits)
+        else:
+            solver = configuration.solver(ctx, limits)
+            solver.add(*assertions)
+            check = solver.check()
+            result = str(check)
+            reason = solver.reason_unknown() if result == "unknown" else None
+            model = {str(decl): solver.model()[decl].sexpr() for decl in solver.model()
+                     if decl.arity() == 0} if check == sat else None
+    except Exception as e:  # the configuration cannot handle the query
+        result, reason, model = "unknown", str(e), None
+    sender.send((result, reason, time.perf_counter() - start, model))
+    sender.close()
+
+
+# a query without free constants is satisfiable when every assertion is valid: when the negation of its body,
+# with fresh constants for the universally bound variables, is unsatisfiable
+def check_valid(configuration: Configuration, assertions, ctx: Context, limits: Limits) -> tuple:
+    if any(free_constants(assertion) for assertion in assertions):
+        return "unknown", "the query has free constants", None
+    for assertion in assertions:
+        body = assertion
+        if is_quantifier(assertion) and assertion.is_forall():
+            bound = [FreshConst(assertion.var_sort(k), assertion.var_name(k)) for k in range(assertion.num_vars())]
+            body = substitute_vars(assertion.body(), *reversed(bound))
+        solver = configuration.solver(ctx, limits)
+        solver.add(Not(body))
+        check = solver.check()
+        if check == sat:
+            return "unsat", None, None
+        if check != unsat:
+            return "unknown", solver.reason_unknown(), None
+    return "sat", None, {}
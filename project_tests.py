@@ -5,9 +5,27 @@ Before each test, there is a documentation of the case it tests.
 """
 
 
-from z3 import And, Or, Implies
-from final.syntax.while_lang import parse
-from final.finalfeatures import main_func
+import contextlib
+import io
+import os
+import tempfile
+
+from z3 import And, Or, Implies, Solver, sat, Int, ForAll
+from final.syntax.while_lang import parse, WhileParser, pretty
+from final.syntax.tree import Tree, TreeInterner
+from final.syntax.parsing.earley.earley import Parser, ParseTrees, no_unit_cycles, prefer
+from final.finalfeatures import main_func, cegis, SynthesisSession, fill_assignments, stream
+from final.main_program import (vc, mk_env, collect_vars, find_holes, break_while_to_ifs, analyze, TermCache,
+                                VerificationSession, UnrollReport, Limits, verify, BitVecEncoding, BoundedIntEncoding,
+                                encoding_named)
+from final.passive_form import to_passive, verify_havoc, spare_contexts, MAX_SPARE_CONTEXTS
+from final.partial_eval import residual_program, ConcreteArray
+from final import batch
+from final.batch import Job, BatchStats, synthesize_batch, verify_batch, job_key
+from final.cache import ResultCache
+from final.portfolio import Portfolio, Configuration
+from final.smtlib import QueryLog, SolverPool, ExternalSolver, to_smtlib, split_sexprs
+from final.streaming import JsonlExamples, read_examples, stratified_sample, Deduplicator, example_key
 
 
 # fill in basic hole
@@ -466,3 +484,474 @@ def test_41():
     examples_41 = []
     assert not main_func(parse(program_41), P41, Q41, linv41, examples_41)
 
+
+
+
+# a long chain of if statements: the shared (DAG) wp keeps the formula linear in the program size
+def test_42():
+    program_42 = "; ".join(f"if y > {100 + i} then y := y - 1 else y := y + x" for i in range(16))
+    tree_42 = parse(program_42)
+    env_42 = mk_env(collect_vars(tree_42))
+    Q42 = lambda env: env['y'] == 32
+    formula_42 = vc(Q42, tree_42, None, env_42)
+    assert len(formula_42.sexpr()) < 10000
+    solver_42 = Solver()
+    solver_42.add(formula_42, env_42['y'] == 0)
+    assert solver_42.check() == sat and solver_42.model()[env_42['x']] == 2
+
+
+# passive (SSA) form: one definition per assignment, a phi definition after if, array versions for updates
+def test_43():
+    program_43 = "a := [1, 2]; if x > 0 then y := x + 1 else y := x - 1; a[1] := y; z := a[1]"
+    tree_43 = parse(program_43)
+    env_43 = mk_env(collect_vars(tree_43))
+    passive_43 = to_passive(tree_43, lambda env: True, env_43)
+    assert len(passive_43.definitions) == 5
+    solver_43 = Solver()
+    solver_43.add(passive_43.formula(lambda env: env['z'] == 4))
+    assert solver_43.check() == sat and solver_43.model()[env_43['x']] == 3
+
+
+# CEGIS: out of many examples, only the ones the current hole values fail on are sent to the solver
+def test_44():
+    program_44 = "x := ??; if (y - x) > 10 then z := 5 else z := 6"
+    examples_44 = [{'input': {"y": y}, 'output': {"z": 5 if y - 7 > 10 else 6}} for y in range(-50, 50)]
+    P44 = lambda d: True
+    Q44 = lambda d: And(Implies(d['y'] - d['x'] > 10, d['z'] == 5),
+                        Implies(d['y'] - d['x'] <= 10, d['z'] == 6))
+    result_44 = cegis(parse(program_44), P44, Q44, [], examples_44)
+    assert result_44.verified and list(result_44.assignment.values()) == [7]
+    assert len(result_44.examples) < len(examples_44)
+    assert result_44.iterations == len(result_44.rounds) == len(result_44.examples)
+
+
+# every request runs in its own session: a refuted program leaves no assertions or hole numbers behind
+def test_45():
+    P45 = lambda env: True
+    Q45 = lambda env: True
+    session_45 = SynthesisSession()
+    assert not session_45.main_func(parse("a := [[1,6,7],[3,4,8]]; x := a[??][??]; assert x = 17"), P45, Q45, P45, [])
+    assert session_45.hole_counter == 2
+    fresh_45 = SynthesisSession()
+    assert fresh_45.ctx is not session_45.ctx
+    assert fresh_45.main_func(parse("x := ??; assert x = 3"), P45, Q45, P45, [])
+    assert fresh_45.hole_counter == 1 and len(fresh_45.holes_solver.assertions()) == 0
+
+
+# batch synthesis on a process pool, with P and Q given as SMT-LIB text and a per-job timeout
+def test_46():
+    examples_46 = [{'input': {"y": 4}, 'output': {"z": 6}}, {'input': {"y": 14}, 'output': {"z": 5}}]
+    Q46 = "(and (=> (> (- y x) 10) (= z 5)) (=> (<= (- y x) 10) (= z 6)))"
+    jobs_46 = [Job("holes", "x := ??; if (y - x) > 10 then z := 5 else z := 6", "true", Q46, examples=examples_46),
+               Job("wrong", "x := 1", "true", "(= x 2)"),
+               Job("loop", "i := 0; while i < 3 do i := i + 1", "true", "(= i 3)", "(<= i 3)"),
+               Job("broken", "x := := 1"),
+               Job("slow", "x := 1", timeout=0.000001)]
+    stats_46 = BatchStats()
+    results_46 = {result.name: result.status for result in synthesize_batch(jobs_46, max_workers=2, stats=stats_46)}
+    assert results_46 == {"holes": "verified", "wrong": "refuted", "loop": "verified", "broken": "error",
+                          "slow": "timeout"}
+    assert stats_46.completed == stats_46.submitted == 5 and stats_46.throughput > 0
+
+
+# the parse forest of an ambiguous array literal: trees are counted without building them, the filters pick one
+def test_47():
+    parser_47 = WhileParser()
+    earley_47 = Parser(parser_47.grammar, list(parser_47.tokenizer("a := [1, 2, 3, 4, 5]")))
+    earley_47.parse()
+    assert earley_47.is_valid_sentence()
+    assert len(ParseTrees(earley_47, [no_unit_cycles, prefer("S1", "id := lbracket num_list rbracket")])) == 14
+    assert len(ParseTrees(earley_47, parser_47.FILTERS)) == 1
+    a_47 = parse("a := [" + ", ".join(str(i) for i in range(40)) + "]; y := a[39]; assert y = 39")
+    assert main_func(a_47, lambda env: True, lambda env: True, lambda env: True, [])
+
+
+# interning an unrolled loop: equal subtrees become one immutable object
+def test_48():
+    tree_48 = break_while_to_ifs(parse("x := 0; while x < 3 do (y := y + x; x := x + 1)"))
+    interner_48 = TreeInterner()
+    frozen_48 = interner_48.intern(tree_48)
+    assert frozen_48 == interner_48.intern(tree_48.clone()) and frozen_48.thaw() == tree_48
+    assert interner_48.intern(tree_48.clone()) is frozen_48
+    assert len(interner_48) < len(tree_48.nodes)
+    ifs_48 = [node for node in frozen_48.nodes if node.root == "if"]
+    assert len(ifs_48) == 10 and len({id(node.subtrees[0]) for node in ifs_48}) == 1
+
+
+# parsing, variables and holes of a program nested deeper than the recursion limit
+def test_49():
+    tree_49 = Tree("skip")
+    for i in range(5000):
+        assign_49 = Tree(":=", [Tree("id", [Tree(f"x{i % 7}")]), Tree(f"hole_{i}" if i % 1000 == 0 else "num", [])])
+        tree_49 = Tree(";", [assign_49, tree_49])
+    assert collect_vars(tree_49) == {f"x{i}" for i in range(7)}
+    assert find_holes(tree_49) == {f"hole_{i}" for i in range(0, 5000, 1000)}
+    assert tree_49.depth == 5002 and len(tree_49.nodes) == 25001
+    program_49 = "; ".join("a[{0}] := x{1} + ??".format(i % 3, i % 7) if i % 100 == 0 else
+                           "x{0} := (x{0} + {1}) * 2".format(i % 7, i) for i in range(1200))
+    parsed_49 = parse("a := [1, 2, 3]; " + program_49)
+    assert parsed_49.depth > 1200 and str(parsed_49.subtrees[1].subtrees[0].root) == "array_update"
+    assert collect_vars(parsed_49) == {"a", *(f"x{i}" for i in range(7))}
+
+
+# the analysis of a tree is cached on its nodes and recomputed after the tree is rewritten, the analyses of other
+# trees are kept
+def test_50():
+    tree_50 = parse("a := [[1,2],[3,4]]; b := [5, 6]; x := ??; y := a[x][1] + b[y]")
+    other_50 = parse("z := w + 1")
+    kept_50 = analyze(other_50)
+    info_50 = analyze(tree_50)
+    assert info_50.vars == {"a", "b", "x", "y"} and info_50.holes == set()
+    assert info_50.arrays == {"a": 2, "b": 1} and info_50.size == len(tree_50.nodes)
+    assert analyze(tree_50) is info_50 and collect_vars(tree_50) is info_50.vars
+    session_50 = SynthesisSession()
+    session_50.detect_holes(tree_50)
+    assert find_holes(tree_50) == {"hole_0"}
+    fill_assignments({"hole_0": 1}, tree_50)
+    assert find_holes(tree_50) == set() and analyze(tree_50).size == info_50.size + 1
+    assert analyze(other_50) is kept_50
+    loop_50 = parse("while x < ?? do x := x + 1")
+    session_50.detect_holes(loop_50)
+    loop_50 = break_while_to_ifs(loop_50)  # the copies of the loop share the hole
+    assert find_holes(loop_50) == {"hole_1"}
+    fill_assignments({"hole_1": 3}, loop_50)
+    assert find_holes(loop_50) == set() and analyze(other_50) is kept_50
+
+
+# terms that do not depend on the example are built once for all examples
+def test_51():
+    session_51 = SynthesisSession()
+    tree_51 = parse("a := [1, 2, 3, 4]; c := ??; d := a[2] * c; x := d + y")
+    examples_51 = [{'input': {'y': i}, 'output': {'x': i + 6}} for i in range(5)]
+    assert session_51.main_func(tree_51, lambda env: True, lambda env: True, lambda env: True, examples_51)
+    assert str(tree_51.subtrees[1].subtrees[0].subtrees[1]) == "num{2}"
+    assert session_51.terms.hits >= len(examples_51) - 1
+    cache_51 = TermCache(maxsize=2)
+    for i in range(3):
+        assert cache_51.lookup(tree_51, {}, None, lambda env, linv: i) == 0  # built once
+    assert len(cache_51) == 1 and cache_51.hits == 2 and cache_51.misses == 1
+
+
+# partial evaluation of the examples: known values are computed in python, only what a hole reaches is left to z3
+def test_52():
+    program_52 = "a := [0, 0, 0, 0]; i := 0; while i < 4 do (a[i] := i * x; i := i + 1); y := a[3] + ??"
+    examples_52 = [{'input': {'x': x}, 'output': {'y': 3 * x + 7}} for x in range(6)]
+    tree_52 = parse(program_52)
+    assert SynthesisSession().main_func(tree_52, lambda env: True, lambda env: True, lambda env: True, examples_52)
+    assert str(tree_52.subtrees[1].subtrees[1].subtrees[1].subtrees[1].subtrees[1]) == "num{7}"
+    unrolled_52 = break_while_to_ifs(tree_52)
+    with SynthesisSession() as session_52:
+        concrete_52 = residual_program(unrolled_52, lambda env: True, {'x': 5})
+        assert concrete_52.definitions == [] and concrete_52.env['y'] == 22 and concrete_52.env['i'] == 4
+        symbolic_52 = residual_program(unrolled_52, lambda env: True, {'x': Int('x', session_52.ctx)})
+        assert len(symbolic_52.definitions) == 4  # a[1], a[2] and a[3] depend on x, and y
+    array_52 = ConcreteArray([[1, 2], [3, 4]], 2, 2)
+    with SynthesisSession():
+        assert array_52.symbolic() is array_52.symbolic()
+
+
+# adaptive unrolling: each loop is unrolled as deep as the examples and P need, ten copies are too few here
+def test_53():
+    program_53 = "i := 0; s := 0; while i < n do (s := s + ??; i := i + 1); j := 0; while j < 2 do j := j + 1"
+    examples_53 = [{'input': {'n': n}, 'output': {'s': 2 * n}} for n in (3, 12)]
+    P53 = lambda env: And(env['n'] >= 0, env['n'] <= 12)
+    session_53 = SynthesisSession()
+    assert session_53.main_func(parse(program_53), P53, lambda env: True, P53, examples_53, unroll="adaptive")
+    assert session_53.unrolling.depths == [12, 2] and not session_53.unrolling.cut
+    unbounded_53 = SynthesisSession()
+    assert unbounded_53.main_func(parse(program_53), lambda env: True, lambda env: True, P53, examples_53,
+                                  unroll="adaptive", max_unroll=16)
+    assert unbounded_53.unrolling.depths == [16, 2] and unbounded_53.unrolling.cut == {0}
+    for steps_53, index_53 in ((3, 3), (2, 2), (5, 0)):  # the index of the loop condition is a hole at every depth
+        indexed_53 = parse("a := [5, 1, 2, 3]; i := 0; while i < a[??] do i := i + 1")
+        assert main_func(indexed_53, lambda env: True, lambda env: True, lambda env: True,
+                         [{'input': {}, 'output': {'i': steps_53}}], unroll="adaptive")
+        filled_53 = "a := [5, 1, 2, 3]; i := 0; while i < a[{0}] do i := i + 1".format(index_53)
+        assert str(indexed_53) == str(parse(filled_53))
+    try:
+        main_func(parse(program_53), P53, lambda env: True, P53, examples_53, unroll=10)
+        assert False
+    except ValueError as e:
+        assert str(e) == "cannot fill holes"
+
+
+# one incremental solver per request: the model is checked once, an example can be retracted,
+# the verification frame is popped again and every phase is timed
+def test_54():
+    session_54 = SynthesisSession()
+    tree_54 = parse("x := ??; y := x + z")
+    session_54.detect_holes(tree_54)
+    wrong_54 = {'input': {'z': 1}, 'output': {'y': 5}}
+    session_54.add_constraints(tree_54, None, lambda env: True, None,
+                               [{'input': {'z': 1}, 'output': {'y': 4}}, wrong_54])
+    try:
+        session_54.solve()
+        assert False
+    except ValueError as e:
+        assert str(e) == "cannot fill holes"
+    session_54.retract_example(wrong_54)
+    model_54 = session_54.solve()
+    assert session_54.solve() is model_54 and session_54.check_solver() is model_54
+    session_54.check_fill(tree_54)
+    assert str(tree_54.subtrees[0].subtrees[1]) == "num{3}"
+    assertions_54 = len(session_54.solver.assertions())
+    assert session_54.verify_filled(lambda env: True, tree_54, lambda env: env['y'] == env['z'] + 3, None)
+    assert len(session_54.solver.assertions()) == assertions_54
+    assert {"constraints", "solve", "verify"} <= set(session_54.timings)
+
+
+# solver limits: a verdict is verified, refuted or unknown with z3's reason, after the whole retry ladder
+def test_55():
+    tree_55 = parse("y := x * x; assert y >= 0")
+    true_55 = lambda env: True
+    verified_55 = VerificationSession().verify(true_55, tree_55, true_55, true_55)
+    assert verified_55 and verified_55.status == "verified"
+    refuted_55 = VerificationSession().verify(true_55, parse("y := x * x"), lambda env: env['y'] > 0, true_55)
+    assert not refuted_55 and refuted_55.status == "refuted"
+    reused_55 = VerificationSession()  # a query is not checked together with the earlier ones
+    assert not reused_55.verify(true_55, parse("y := x + 1"), lambda env: env['y'] > env['x'] + 1, true_55)
+    assert reused_55.verify(true_55, parse("y := x + 1"), lambda env: env['y'] > env['x'], true_55)
+    assert len(reused_55.solver.assertions()) == 0
+    x_55, h_55 = Int('x', reused_55.ctx), Int('h', reused_55.ctx)
+    with contextlib.redirect_stdout(io.StringIO()) as out_55:
+        assert reused_55.prove([x_55], x_55 + h_55 > x_55).model['h'].as_long() > 0
+    assert out_55.getvalue() == ""
+    unknown_55 = VerificationSession(limits=Limits(rlimit=1)).verify(true_55, tree_55, true_55, true_55)
+    assert not unknown_55 and unknown_55.status == "unknown" and "resource" in unknown_55.reason
+    assert [step for step, _, _ in unknown_55.attempts] == ["default", "negated", "qe"]
+    examples_55 = [{'input': {'x': 1}, 'output': {'y': 2}}]
+    verdict_55 = main_func(parse("y := x + ??"), true_55, true_55, true_55, examples_55, limits=Limits(rlimit=1))
+    assert verdict_55.status == "unknown" and verdict_55.attempts[0][0] == "synthesis"
+    session_55 = SynthesisSession()
+    loop_55 = parse("i := 0; while i < 3 do i := i + 1; y := x + ??")
+    session_55.detect_holes(loop_55)
+    session_55.unrolling = UnrollReport([4])
+    session_55.add_constraints(loop_55, None, true_55, true_55, examples_55, 4)
+    session_55.check_fill(loop_55)
+    lowered_55 = session_55.verify_unrolled(true_55, loop_55, lambda env: env['y'] == env['x'] + 1, true_55,
+                                            Limits(rlimit=1))
+    assert lowered_55.status == "unknown" and session_55.unrolling.depths == [1]
+    assert lowered_55.attempts[-1][0] == "qe at depths [1]"
+    assert session_55.verify_unrolled(true_55, loop_55, lambda env: env['y'] == env['x'] + 1, true_55)
+
+
+# loops checked with their invariant as separate quantifier-free checks, on havoced variables
+def test_56():
+    tree_56 = parse("i := 0; j := 0; while i < 3 do (j := 0; while j < i do j := j + 1; i := i + 1); assert j <= i")
+    linv_56 = lambda env: And(env['i'] >= 0, env['i'] <= 3, env['j'] >= 0, env['j'] <= env['i'])
+    verdict_56 = verify_havoc(lambda env: True, tree_56, lambda env: env['i'] == 3, linv_56)
+    assert verdict_56 and [label for label, _, _ in verdict_56.attempts] == \
+        ["initiation", "initiation", "preservation", "preservation", "assert", "postcondition"]
+    twice_56 = parse("i := 0; while i < n do i := i + 2")
+    P56 = lambda env: env['n'] >= 0
+    refuted_56 = verify_havoc(P56, twice_56, lambda env: env['i'] == env['n'], lambda env: env['i'] <= env['n'])
+    assert not refuted_56 and [status for _, status, _ in refuted_56.attempts] == ["verified", "refuted", "verified"]
+    once_56 = parse("i := 0; while i < n do i := i + 1")
+    assert verify_havoc(P56, once_56, lambda env: env['i'] == env['n'], lambda env: env['i'] <= env['n'])
+    for _ in range(3):  # the contexts of the checks are kept for reuse, at most one per cpu
+        verify_havoc(P56, once_56, lambda env: env['i'] == env['n'], lambda env: env['i'] <= env['n'], max_workers=4)
+    assert len(spare_contexts) <= MAX_SPARE_CONTEXTS
+    exitless_56 = verify_havoc(P56, once_56, lambda env: env['i'] == env['n'], lambda env: env['i'] <= env['n'] - 1)
+    assert exitless_56.status == "refuted" and exitless_56.attempts[1][1] == "refuted"
+    assert not verify(P56, once_56, lambda env: env['i'] == env['n'], lambda env: env['i'] <= env['n'] - 1)
+    try:
+        verify_havoc(P56, once_56, lambda env: True, None)
+        assert False
+    except ValueError as e:
+        assert str(e) == "Linv is None"
+
+
+# one obligation per assert, array access and conjunct of Q, with the statement it comes from, solved by threads
+def test_57():
+    program_57 = "a := [1, 2, 3]; x := a[1] + a[2]; i := 0; while i < n do (i := i + 1; assert i > 0); y := a[4]"
+    tree_57 = parse(program_57)
+    assert pretty(tree_57) == program_57 and parse(pretty(tree_57)) == tree_57
+    verdict_57 = verify_havoc(lambda env: env['n'] >= 0, tree_57, lambda env: And(env['x'] == 5, env['i'] == env['n']),
+                              lambda env: And(env['i'] >= 0, env['i'] <= env['n']), max_workers=2)
+    assert not verdict_57 and verdict_57.status == "refuted"
+    assert [(o.label, o.location, o.status) for o in verdict_57.obligations] == [
+        ("bounds", 2, "verified"), ("bounds", 2, "verified"), ("initiation", 4, "verified"),
+        ("assert", 6, "verified"), ("preservation", 4, "verified"), ("bounds", 7, "refuted"),
+        ("postcondition", None, "verified"), ("postcondition", None, "verified")]
+    assert str(verdict_57.obligations[5]) == "bounds of statement 7 (y := a[4]): refuted"
+    assert all(o.seconds >= 0 for o in verdict_57.obligations)
+
+
+# a portfolio of solver configurations racing in processes: the first definitive answer wins, and is counted
+def test_58():
+    session_58 = VerificationSession()
+    session_58.portfolio = Portfolio()
+    verdict_58 = session_58.verify(lambda env: env['n'] >= 0, parse("i := 0; while i < n do i := i + 1"),
+                                   lambda env: env['i'] == env['n'], lambda env: env['i'] <= env['n'])
+    winner_58 = verdict_58.attempts[0][0][len("portfolio "):]
+    assert verdict_58 and session_58.portfolio.wins == {"quantified": {winner_58: 1}}
+    assert session_58.portfolio.ordered("quantified")[0].name == winner_58
+    assert session_58.portfolio.defaults() == {"quantified": winner_58}
+    refuted_58 = SynthesisSession()
+    refuted_58.portfolio = Portfolio(max_workers=2)
+    assert not refuted_58.verify(lambda env: True, parse("y := x + 1"), lambda env: env['y'] > env['x'] + 1, None)
+    closed_58 = Portfolio([Configuration("quantifier-free", encoding="quantifier-free")])
+    x_58, hole_58 = Int('x', session_58.ctx), Int('hole_0', session_58.ctx)
+    assert closed_58.run([ForAll([x_58], x_58 * x_58 >= 0)]).result == "sat"
+    open_58 = closed_58.run([ForAll([x_58], x_58 + hole_58 > x_58)])
+    assert open_58.result == "unknown" and open_58.winner is None and "free constants" in open_58.reason
+    holes_58 = SynthesisSession()
+    holes_58.portfolio = Portfolio()
+    tree_58 = parse("a := [5, 1, 2, 3]; i := 0; while i < a[??] do i := i + 1")
+    assert holes_58.main_func(tree_58, lambda env: True, lambda env: True, lambda env: True,
+                              [{'input': {}, 'output': {'i': 3}}], unroll="adaptive")
+    assert str(tree_58) == str(parse("a := [5, 1, 2, 3]; i := 0; while i < a[3] do i := i + 1"))
+    assert sum(holes_58.portfolio.wins["quantifier-free arrays"].values()) >= 1
+
+
+# the persistent result cache: unchanged jobs are answered from the file, the least recently used entries are evicted
+def test_59():
+    with tempfile.TemporaryDirectory() as directory_59:
+        path_59 = os.path.join(directory_59, "cache.sqlite")
+        jobs_59 = [Job("holes", "x := ??; y := x + z", "true", "(= y (+ z 3))",
+                       examples=[{'input': {'z': 1}, 'output': {'y': 4}}]),
+                   Job("wrong", "y := x + 1", "true", "(> y (+ x 1))"),
+                   Job("broken", "y := := 1")]
+        with ResultCache(path_59) as cache_59:
+            results_59 = list(synthesize_batch(jobs_59, max_workers=1, cache=cache_59))
+            first_59 = {r.name: (r.status, r.cached) for r in results_59}
+            first_59_model = [r.model for r in results_59 if r.name == "holes"][0]
+            assert first_59 == {"holes": ("verified", False), "wrong": ("refuted", False), "broken": ("error", False)}
+            assert len(cache_59) == 2
+        with ResultCache(path_59) as cache_59:
+            second_59 = {r.name: r for r in synthesize_batch(jobs_59, max_workers=1, cache=cache_59)}
+            assert second_59["holes"].cached and second_59["holes"].assignment == {"hole_0": "3"}
+            assert second_59["holes"].model == first_59_model and "hole_0" in first_59_model
+            assert second_59["wrong"].cached and not second_59["broken"].cached
+        spaced_59 = Job("holes", "x := ??;  y := (x + z)", "true", "(=  y (+ z 3))",
+                        examples=[{'input': {'z': 1}, 'output': {'y': 4}}])
+        assert job_key(spaced_59, True) == job_key(jobs_59[0], True) != job_key(jobs_59[0], False)
+        key_59 = job_key(jobs_59[0], True)
+        batch.ENGINE_VERSION += 1  # results of an older engine are not served
+        try:
+            assert job_key(jobs_59[0], True) != key_59
+        finally:
+            batch.ENGINE_VERSION -= 1
+        with ResultCache(os.path.join(directory_59, "small.sqlite"), max_bytes=120) as small_59:
+            for k in range(5):
+                small_59.put(str(k), {"status": "verified", "program": "x" * 20})
+            assert len(small_59) == 2 and small_59.get("0") is None and small_59.get("4") is not None
+
+
+# integer encodings: bit-vectors wrap around like machine integers, bounded Int keeps the variables in range
+def test_60():
+    bv8_60 = BitVecEncoding(8)
+    assert bv8_60.apply("+", 127, 1) == -128 and bv8_60.apply("*", 16, 16) == 0
+    assert bv8_60.apply("/", -7, 2) == -3 and bv8_60.apply("/", 5, 0) == -1
+    assert encoding_named("bv32").bits == 32 and encoding_named("bounded16").high == 2 ** 15 - 1
+    assert encoding_named(None).name == encoding_named("int").name == "int"
+    try:
+        encoding_named("float")
+        assert False
+    except ValueError:
+        pass
+    overflow_60 = parse("y := x + 1; assert y > x")
+    assert verify(lambda env: True, overflow_60, lambda env: True, lambda env: True)
+    assert verify(lambda env: True, overflow_60, lambda env: True, lambda env: True, encoding=BoundedIntEncoding(8))
+    refuted_60 = verify(lambda env: True, overflow_60, lambda env: True, lambda env: True, encoding=bv8_60)
+    assert refuted_60.status == "refuted"
+    square_60 = parse("y := x * x")
+    assert not verify(lambda env: True, square_60, lambda env: env['y'] >= 0, lambda env: True, encoding=bv8_60)
+    session_60 = SynthesisSession(encoding=bv8_60)
+    holes_60 = parse("y := x + ??")
+    assert session_60.main_func(holes_60, lambda env: True, lambda env: env['y'] == env['x'] - 3, lambda env: True,
+                                [{'input': {'x': 5}, 'output': {'y': 2}}])
+    assert "-3" in str(holes_60)
+    cegis_60 = cegis(parse("y := x + ??"), lambda env: True, lambda env: env['y'] == env['x'] - 3, lambda env: True,
+                     [{'input': {'x': 5}, 'output': {'y': 2}}], encoding=bv8_60)
+    assert cegis_60.verified and cegis_60.assignment == {"hole_0": -3}
+    loop_60 = parse("a := [1, 2, 3]; i := 0; while i < 3 do (a[i] := a[i] * ??; i := i + 1); y := a[2] + x")
+    assert main_func(loop_60, lambda env: True, lambda env: True, lambda env: True,
+                     [{'input': {'x': x}, 'output': {'y': 15 + x}} for x in range(3)], encoding=BitVecEncoding(16))
+    havoc_60 = verify_havoc(lambda env: env['n'] >= 0, parse("i := 0; while i < n do i := i + 1"),
+                            lambda env: env['i'] == env['n'], lambda env: And(env['i'] >= 0, env['i'] <= env['n']),
+                            session=VerificationSession(encoding=bv8_60))
+    assert havoc_60
+    jobs_60 = [Job("int", "y := x + 1", "true", "(> y x)"), Job("bv8", "y := x + 1", "true", "(bvsgt y x)",
+                                                                  encoding="bv8")]
+    statuses_60 = {r.name: r.status for r in verify_batch(jobs_60, max_workers=1)}
+    assert statuses_60 == {"int": "verified", "bv8": "refuted"}
+
+
+# SMT-LIB export of the queries and an external solver pool answering them
+def test_61():
+    assert split_sexprs('sat\n((hole_0 3) (|a b| (- 2)))\n"end"\nuns', stream=True) == (
+        ["sat", "((hole_0 3) (|a b| (- 2)))", '"end"'], "uns")
+    with tempfile.TemporaryDirectory() as directory_61, SolverPool(size=2) as pool_61:
+        session_61 = VerificationSession()
+        session_61.query_log, session_61.backend = QueryLog(directory_61), pool_61
+        loop_61 = parse("i := 0; while i < n do i := i + 1")
+        assert session_61.verify(lambda env: env['n'] >= 0, loop_61, lambda env: env['i'] == env['n'],
+                                 lambda env: And(env['i'] >= 0, env['i'] <= env['n']))
+        assert session_61.verify(lambda env: True, parse("y := x + 1"), lambda env: env['y'] > env['x'] + 1,
+                                 lambda env: True).status == "refuted"
+        assert len(session_61.query_log.entries) == 2 and session_61.query_log.slowest(1)[0][2] > 0
+        with open(session_61.query_log.entries[0][0]) as f:
+            logged_61 = f.read()
+        assert "(check-sat)" in logged_61 and logged_61.rstrip().split("\n")[-1].startswith("; sat in")
+        replay_61 = ExternalSolver()
+        try:
+            assert str(replay_61.check(logged_61.replace("(check-sat)", ""), {}).result) == "sat"
+        finally:
+            replay_61.close()
+        holes_61 = SynthesisSession()
+        holes_61.backend = pool_61
+        tree_61 = parse("y := x * ??; z := y + ??")
+        assert "hole_1" in to_smtlib([Int('hole_1', holes_61.ctx) > 0])
+        assert holes_61.main_func(tree_61, lambda env: True, lambda env: env['z'] == 3 * env['x'] + 1,
+                                  lambda env: True, [{'input': {'x': 2}, 'output': {'y': 6, 'z': 7}}])
+        assert str(tree_61) == str(parse("y := x * 3; z := y + 1"))
+        cegis_61 = SynthesisSession()
+        cegis_61.backend = pool_61
+        assert cegis_61.cegis(parse("y := x * ??"), lambda env: True, lambda env: env['y'] == 4 * env['x'],
+                              lambda env: True, [{'input': {'x': 2}, 'output': {'y': 8}}]).assignment == {"hole_0": 4}
+        started_61 = pool_61.started
+        x_61, y_61, z_61 = Int('x', session_61.ctx), Int('y', session_61.ctx), Int('z', session_61.ctx)
+        hard_61 = pool_61.check([x_61 * x_61 * x_61 + y_61 * y_61 * y_61 == z_61 * z_61 * z_61 + 33, x_61 > 1000],
+                                Limits(timeout=200))
+        assert str(hard_61.result) == "unknown" and hard_61.reason == "timeout"
+        assert pool_61.check([x_61 == 1]).values[x_61].as_long() == 1 and pool_61.started == started_61 + 1
+
+
+# synthesis from examples streamed from JSONL / CSV files: sampled, deduplicated and checked pass by pass
+def test_62():
+    with tempfile.TemporaryDirectory() as directory_62:
+        jsonl_62, csv_62 = os.path.join(directory_62, "io.jsonl"), os.path.join(directory_62, "io.csv")
+        with open(jsonl_62, "w") as f, open(csv_62, "w") as g:
+            g.write("x,y_out\n")
+            for k in range(3000):
+                x = (k * 37) % 401 - 200
+                y = 3 * x + 7 if x >= 0 else -x
+                f.write('{{"output": {{"y": {0}}}, "input": {{"x": {1}}}}}\n'.format(y, x) if k % 2 else
+                        '{{"input": {{"x": {0}}}, "output": {{"y": {1}}}}}\n'.format(x, y))
+                g.write("{0},{1}\n".format(x, y))
+        examples_62 = JsonlExamples(jsonl_62)
+        assert sum(1 for _ in examples_62) == 3000 and sum(1 for _ in examples_62) == 3000
+        dedup_62 = Deduplicator()
+        sample_62 = stratified_sample(examples_62, 4, dedup_62)
+        assert len(sample_62) == 4 and dedup_62.duplicates == 3000 - 401
+        assert {x['input']['x'] > 0 for x in sample_62} == {True, False}
+        small_62 = Deduplicator(max_keys=2)
+        fresh_62 = [small_62.fresh({'input': {'x': x}, 'output': {}}) for x in (1, 2, 1, 3, 2)]
+        assert fresh_62 == [True, True, False, True, True]
+        assert example_key({'input': {'x': 1, 'z': 2}, 'output': {}}) == example_key({'output': {},
+                                                                                     'input': {'z': 2, 'x': 1}})
+        assert len({example_key({'input': {'x': x}, 'output': {}}) for x in (-2, -1, 1, 2)}) == 4
+        program_62 = "if x > ?? then y := (x * ??) + ?? else y := x * ??"
+        tree_62 = parse(program_62)
+        result_62 = stream(tree_62, lambda env: True, lambda env: True, lambda env: True, examples_62, sample_size=8)
+        assert result_62.verified and result_62.checked <= 401 * result_62.passes
+        assert len(result_62.examples) <= 8 + 8 * result_62.passes
+        assert str(tree_62) == str(parse("if x > -1 then y := (x * 3) + 7 else y := x * -1"))
+        tree_62 = parse(program_62)
+        from_csv_62 = read_examples(csv_62, {"y_out": "y"})
+        assert stream(tree_62, lambda env: True, lambda env: True, lambda env: True, from_csv_62,
+                      sample_size=8).assignment == {"hole_0": -1, "hole_1": 3, "hole_2": 7, "hole_3": -1}
+        limited_62 = stream(parse(program_62), lambda env: True, lambda env: True, lambda env: True, examples_62,
+                            sample_size=1, batch_size=1, max_examples=1)
+        assert limited_62.verdict.status == "unknown" and "1 examples" in limited_62.verdict.reason
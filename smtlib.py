@@ -0,0 +1,294 @@
+import argparse
+import os
+import select
+import subprocess
+import threading
+import time
+
+try:
+    import resource
+except ImportError:  # no memory limits for the solver processes (windows)
+    resource = None
+
+from z3 import Context, Solver, parse_smt2_string, sat, unsat, unknown
+from final.main_program import Limits, constants
+
+DEFAULT_COMMAND = ("z3", "-in")  # any SMT-LIB 2 solver reading commands from stdin, e.g. ("cvc5", "--incremental")
+END = "end-of-query"  # echoed after the commands of a query, the answers before it belong to the query
+
+
+# The SMT-LIB 2 text of a query: the declarations of its constants, named like the program variables and holes,
+# and the assertions (z3 formulas of one context)
+def to_smtlib(assertions) -> str:
+    solver = Solver(ctx=assertions[0].ctx) if assertions else Solver()
+    solver.add(*assertions)
+    return solver.sexpr()
+
+
+# Writes the queries of a session to numbered SMT-LIB files in a directory (0001.smt2, ...). A file can be
+# replayed with any solver ("z3 0001.smt2"), its last line is a comment with the answer and the solver time.
+# entries holds (path, answer, seconds) of the queries answered, slowest() the slow ones to replay
+class QueryLog:
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.entries = []
+        self.count = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def __repr__(self):
+        return "<QueryLog {0}: {1} queries>".format(self.directory, self.count)
+
+    # writes a query, returns the path of its file
+    def write(self, assertions, limits: Limits | None = None) -> str:
+        self.count += 1
+        path = os.path.join(self.directory, "{0:04d}.smt2".format(self.count))
+        with open(path, "w") as f:
+            if limits is not None:
+                f.write("; {0}\n".format(limits))
+            f.write(to_smtlib(assertions))
+            f.write("(check-sat)\n")
+        return path
+
+    # records the answer to the query of a file
+    def finish(self, path: str, result, seconds: float) -> None:
+        with open(path, "a") as f:
+            f.write("; {0} in {1:.4f}s\n".format(result, seconds))
+        self.entries.append((path, str(result), seconds))
+
+    # the n queries that took the longest, slowest first
+    def slowest(self, n: int = 10) -> list:
+        return sorted(self.entries, key=lambda entry: -entry[2])[:n]
+
+
+# Answer of an external solver: sat, unsat or unknown (z3's check results), the reason when unknown and the
+# values of the constants when sat. model is a z3 model of these values, for model.eval and filter_model
+class Answer:
+    def __init__(self, result, reason: str | None = None, values: dict | None = None, seconds: float = 0.0,
+                 ctx: Context | None = None):
+        self.result = result
+        self.reason = reason
+        self.values = {} if values is None else values  # constant -> value, z3 terms
+        self.seconds = seconds
+        self.ctx = ctx
+        self._model = None
+
+    def __repr__(self):
+        return "<Answer {0}{1}>".format(self.result, "" if self.reason is None else " ({0})".format(self.reason))
+
+    @property
+    def model(self):
+        if self._model is None:
+            solver = Solver(ctx=self.ctx)
+            solver.add(*[constant == value for constant, value in self.values.items()])
+            solver.check()
+            self._model = solver.model()
+        return self._model
+
+
+# the top level s-expressions and atoms of SMT-LIB text, and the rest of the text after the last complete one.
+# In a stream, an atom at the end of the text may not be complete yet
+def split_sexprs(text: str, stream: bool = False) -> tuple[list, str]:
+    items, k, n = [], 0, len(text)
+    while True:
+        while k < n and text[k].isspace():
+            k += 1
+        if k == n:
+            return items, ""
+        start, depth = k, 0
+        while k < n:
+            c = text[k]
+            if c in "|\"":  # quoted symbol or string literal, "" inside a string is a quote
+                end = text.find(c, k + 1)
+                while c == "\"" and end != -1 and text[end + 1:end + 2] == "\"":
+                    end = text.find(c, end + 2)
+                if end == -1:
+                    return items, text[start:]
+                k = end + 1
+            elif c == "(":
+                depth, k = depth + 1, k + 1
+            elif c == ")":
+                depth, k = depth - 1, k + 1
+                if depth == 0:
+                    break
+            elif depth == 0 and c.isspace():
+                break
+            else:
+                k += 1
+        if depth > 0 or (stream and k == n and text[start] != "("):  # the rest of the answer is not read yet
+            return items, text[start:]
+        items.append(text[start:k])
+
+
+# the items of a parenthesized s-expression
+def inner(sexpr: str) -> list:
+    return split_sexprs(sexpr.strip()[1:-1])[0]
+
+
+# A solver binary in a subprocess that reads SMT-LIB commands on stdin and answers on stdout. Every query
+# starts with (reset), so the process is kept for the next query. max_memory (megabytes) is a hard limit
+# of the process' address space: a solver that needs more dies, and the query is answered unknown
+class ExternalSolver:
+    def __init__(self, command=DEFAULT_COMMAND, max_memory: int | None = None):
+        self.command = list(command)
+        limit = None if max_memory is None or resource is None else max_memory * 2 ** 20
+        self.process = subprocess.Popen(self.command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                        stderr=subprocess.DEVNULL,
+                                        preexec_fn=None if limit is None else
+                                        lambda: resource.setrlimit(resource.RLIMIT_AS, (limit, limit)))
+        self.pending = ""  # output read after the last complete answer
+
+    def __repr__(self):
+        return "<ExternalSolver {0} pid {1}>".format(" ".join(self.command), self.process.pid)
+
+    def alive(self) -> bool:
+        return self.process.poll() is None
+
+    def close(self) -> None:
+        if self.alive():
+            self.process.kill()
+        self.process.wait()
+        self.process.stdin.close()
+        self.process.stdout.close()
+
+    # sends commands followed by the end marker, returns the answers to them. Raises TimeoutError after
+    # the deadline (time.monotonic) and EOFError when the process exits
+    def send(self, commands: str, deadline: float | None = None) -> list:
+        self.process.stdin.write('{0}\n(echo "{1}")\n'.format(commands, END).encode())
+        self.process.stdin.flush()
+        answers = []
+        while True:
+            items, self.pending = split_sexprs(self.pending, stream=True)
+            for k, item in enumerate(items):
+                if item.strip("\"") == END:
+                    self.pending = " ".join([*items[k + 1:], self.pending])
+                    return answers
+                answers.append(item)
+            wait = None if deadline is None else max(0.0, deadline - time.monotonic())
+            if not select.select([self.process.stdout], [], [], wait)[0]:
+                raise TimeoutError()
+            data = os.read(self.process.stdout.fileno(), 65536)
+            if not data:
+                raise EOFError()
+            self.pending += data.decode()
+
+    # checks a query (SMT-LIB declarations and assertions), the values of the given constants are read when
+    # it is satisfiable. The timeout (milliseconds) bounds the whole exchange, the process is killed after it
+    def check(self, smt2: str, names: dict, timeout: int | None = None, ctx: Context | None = None) -> Answer:
+        start = time.monotonic()
+        deadline = None if timeout is None else start + timeout / 1000
+        try:
+            answers = self.send("(reset)\n(set-option :produce-models true)\n{0}(check-sat)".format(smt2), deadline)
+            results = [answer for answer in answers if answer in ("sat", "unsat", "unknown")]
+            if not results:
+                errors = [answer for answer in answers if answer.startswith("(error")]
+                return Answer(unknown, errors[0] if errors else "no answer", seconds=time.monotonic() - start)
+            result = {"sat": sat, "unsat": unsat, "unknown": unknown}[results[0]]
+            if result == unknown:
+                info = [answer for answer in self.send("(get-info :reason-unknown)", deadline) if answer[:1] == "("]
+                reason = inner(info[0])[-1].strip("\"") if info else "unknown"
+                return Answer(unknown, reason, seconds=time.monotonic() - start)
+            values = {}
+            if result == sat and names:
+                response = self.send("(get-value ({0}))".format(" ".join(names)), deadline)
+                values = read_values(response[0], names, ctx) if response else {}
+            return Answer(result, None, values, time.monotonic() - start, ctx)
+        except TimeoutError:
+            self.close()
+            return Answer(unknown, "timeout", seconds=time.monotonic() - start)
+        except (EOFError, BrokenPipeError):
+            self.close()
+            return Answer(unknown, "solver process exited", seconds=time.monotonic() - start)
+
+
+# the values of a (get-value ...) answer as z3 terms, names maps the SMT-LIB names to the constants.
+# values the z3 parser does not read (e.g. solver specific array values) are left out
+def read_values(response: str, names: dict, ctx: Context | None) -> dict:
+    values = {}
+    decls = {str(constant): constant for constant in names.values()}
+    for pair in inner(response) if response.startswith("(") else []:
+        items = inner(pair)
+        if len(items) != 2 or items[0] not in names:
+            continue
+        constant = names[items[0]]
+        try:
+            equality = parse_smt2_string("(assert (= {0} {1}))".format(*items), decls=decls, ctx=ctx)[0]
+        except Exception:
+            continue
+        values[constant] = equality.arg(1)
+    return values
+
+
+# A pool of persistent solver processes answering the queries of sessions (session.backend = SolverPool()).
+# At most size processes run (one per cpu by default), each query takes an idle one or starts one, a process
+# that timed out or died is replaced on the next query. The timeout of the limits bounds every query, the
+# memory limit is the pool's, set on the processes when they start; rlimit is z3's own and not passed on
+class SolverPool:
+    def __init__(self, command=DEFAULT_COMMAND, size: int | None = None, max_memory: int | None = None):
+        self.command = list(command)
+        self.size = size or os.cpu_count() or 1
+        self.max_memory = max_memory
+        self.idle = []
+        self.started = 0  # processes started, replacements included
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(self.size)
+
+    def __repr__(self):
+        return "<SolverPool {0} x{1}, {2} started>".format(" ".join(self.command), self.size, self.started)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self) -> None:
+        with self.lock:
+            for process in self.idle:
+                process.close()
+            self.idle = []
+
+    # checks the conjunction of the assertions (z3 formulas of one context)
+    def check(self, assertions, limits: Limits | None = None) -> Answer:
+        limits = Limits() if limits is None else limits
+        ctx = assertions[0].ctx if assertions else None
+        names = {}
+        for assertion in assertions:
+            names.update((constant.sexpr(), constant) for constant in constants(assertion).values())
+        smt2 = to_smtlib(assertions)
+        with self.slots:
+            with self.lock:
+                process = self.idle.pop() if self.idle else None
+            if process is None or not process.alive():
+                process = ExternalSolver(self.command, self.max_memory)
+                self.started += 1
+            answer = process.check(smt2, names, limits.timeout, ctx)
+            if process.alive():
+                with self.lock:
+                    self.idle.append(process)
+        return answer
+
+
+# python -m final.smtlib 0001.smt2 ...: replays logged queries with an external solver, prints the answer
+# and the seconds of every query
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(prog="python -m final.smtlib", description="Replay SMT-LIB queries.")
+    parser.add_argument("queries", nargs="+", help="SMT-LIB files, e.g. written by a QueryLog")
+    parser.add_argument("--solver", default=" ".join(DEFAULT_COMMAND), help="solver command (default: %(default)s)")
+    parser.add_argument("--timeout", type=int, default=None, help="milliseconds per query")
+    args = parser.parse_args(argv)
+    solver = ExternalSolver(args.solver.split())
+    try:
+        for path in args.queries:
+            with open(path) as f:
+                smt2 = "".join(line for line in f if not line.startswith(("(check-sat)", ";")))
+            if not solver.alive():
+                solver = ExternalSolver(args.solver.split())
+            answer = solver.check(smt2, {}, args.timeout)
+            print("{0}\t{1}\t{2:.4f}s".format(path, answer.result if answer.reason is None else
+                                              "{0} ({1})".format(answer.result, answer.reason), answer.seconds))
+    finally:
+        solver.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+import csv
+import hashlib
+import json
+import mmap
+import random
+from collections import OrderedDict
+
+
+# the lines of a file, read through a memory map (the pages are read by the os as the lines are used,
+# and are not kept by the process). Plain reads for files that cannot be mapped
+def lines(path: str):
+    with open(path, "rb") as f:
+        try:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, OSError):  # empty file, or not a regular file
+            yield from (line.decode() for line in f)
+            return
+        with mapped:
+            for line in iter(mapped.readline, b""):
+                yield line.decode()
+
+
+# Examples read lazily from a JSON lines file, one {"input": {...}, "output": {...}} object per line. Every
+# iteration reads the file again, so the examples can be passed over many times without holding them
+class JsonlExamples:
+    def __init__(self, path: str):
+        self.path = path
+
+    def __repr__(self):
+        return "<JsonlExamples {0}>".format(self.path)
+
+    def __iter__(self):
+        for line in lines(self.path):
+            if line.strip():
+                yield json.loads(line)
+
+
+# Examples read lazily from a CSV file with a header row and integer values. outputs names the output columns,
+# as a list or as a dict column -> program variable (e.g. {"y_out": "y"}); the other columns are inputs
+class CsvExamples:
+    def __init__(self, path: str, outputs):
+        self.path = path
+        self.outputs = dict(outputs) if isinstance(outputs, dict) else {column: column for column in outputs}
+
+    def __repr__(self):
+        return "<CsvExamples {0}>".format(self.path)
+
+    def __iter__(self):
+        reader = csv.reader(lines(self.path))
+        header = next(reader, None)
+        for row in reader:
+            if not row:
+                continue
+            io = {'input': {}, 'output': {}}
+            for column, value in zip(header, row):
+                if column in self.outputs:
+                    io['output'][self.outputs[column]] = int(value)
+                else:
+                    io['input'][column] = int(value)
+            yield io
+
+
+# the examples of a file by its extension: .jsonl (or .json) or .csv, with the output columns
+def read_examples(path: str, outputs=()):
+    if path.endswith(".csv"):
+        return CsvExamples(path, outputs)
+    return JsonlExamples(path)
+
+
+# the sha256 digest of an example, the same for equal examples whatever the order of their keys. Unlike hash(),
+# distinct examples do not collide (which would drop an example as a duplicate), and a key is 32 bytes however
+# large the example
+def example_key(io) -> bytes:
+    return hashlib.sha256(repr([sorted(io['input'].items()), sorted(io['output'].items())]).encode()).digest()
+
+
+# Drops the examples that were seen before. Holds the keys of at most max_keys examples, the least recently
+# seen are forgotten first, so a duplicate far apart in a huge stream may pass
+class Deduplicator:
+    def __init__(self, max_keys: int = 2 ** 16):
+        self.max_keys = max_keys
+        self.keys = OrderedDict()
+        self.duplicates = 0
+
+    def fresh(self, io) -> bool:
+        key = example_key(io)
+        if key in self.keys:
+            self.keys.move_to_end(key)
+            self.duplicates += 1
+            return False
+        self.keys[key] = None
+        if len(self.keys) > self.max_keys:
+            self.keys.popitem(last=False)
+        return True
+
+
+# the class of an example for sampling: the sign (-1, 0, 1) of every integer input and output, so that
+# examples with negative values, zeros, or other branches of the program are picked early
+def signature(io) -> tuple:
+    return tuple((part, var, (value > 0) - (value < 0)) for part in ("input", "output")
+                 for var, value in sorted(io[part].items()) if type(value) is int)
+
+
+# Takes size examples of a stream in one pass and bounded memory: a reservoir sample per signature (at most
+# size signatures, later ones share one reservoir), then one example of every signature in turn. Duplicates
+# (by dedup) are left out
+def stratified_sample(examples, size: int, dedup: Deduplicator | None = None, rng: random.Random | None = None):
+    rng = random.Random(0) if rng is None else rng
+    dedup = Deduplicator() if dedup is None else dedup
+    strata = {}  # signature -> (examples seen, reservoir)
+    for io in examples:
+        if not dedup.fresh(io):
+            continue
+        key = signature(io)
+        if key not in strata and len(strata) >= size:
+            key = None  # too many signatures
+        seen, reservoir = strata.setdefault(key, [0, []])
+        strata[key][0] = seen + 1
+        if len(reservoir) < size:
+            reservoir.append(io)
+        else:
+            k = rng.randrange(seen + 1)
+            if k < size:
+                reservoir[k] = io
+    sample, reservoirs = [], [reservoir for _, reservoir in strata.values()]
+    while len(sample) < size and any(reservoirs):
+        for reservoir in reservoirs:
+            if reservoir and len(sample) < size:
+                sample.append(reservoir.pop(rng.randrange(len(reservoir))))
+    return sample
@@ -2,7 +2,7 @@ import typing
 from functools import reduce
 
 from final.syntax.tree import Tree
-from final.syntax.parsing.earley.earley import Grammar, Parser, ParseTrees
+from final.syntax.parsing.earley.earley import Grammar, Parser, ParseTrees, no_unit_cycles, prefer
 from final.syntax.parsing.silly import SillyLexer
 
 
@@ -25,6 +25,9 @@ class LambdaParser:
     let_ ->  let id = E in E
     """
 
+    # disambiguation of the parse forest: an expression that is not an application ending with an abstraction is an E1
+    FILTERS = [no_unit_cycles, prefer("E", "E1")]
+
     def __init__(self) -> None:
         self.tokenizer = SillyLexer(self.TOKENS)
         self.grammar = Grammar.from_string(self.GRAMMAR)
@@ -36,9 +39,9 @@ class LambdaParser:
         earley.parse()
 
         if earley.is_valid_sentence():
-            trees = ParseTrees(earley)
+            trees = ParseTrees(earley, self.FILTERS)
             assert len(trees) == 1
-            return self.postprocess(trees.nodes[0])
+            return self.postprocess(trees.tree())
         else:
             return None
 
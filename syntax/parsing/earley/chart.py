@@ -1,7 +1,15 @@
 class Chart:
     def __init__(self, rows):
-        """An Earley chart is a list of rows for every input word"""
-        self.rows = rows
+        """An Earley chart is a list of rows for every input word.
+        A dictionary of the rows guards against duplicates, and the rows are
+        indexed by their next category for the completer"""
+        self.rows = []
+        self.keys = {}
+        self.waiting = {}
+        self.predicted = set()
+        self.nullable = {}  # category -> complete rows that derived it from no words here
+        for row in rows:
+            self.add_row(row)
 
     def __len__(self):
         """Chart length"""
@@ -15,9 +23,54 @@ class Chart:
         return st
 
     def add_row(self, row):
-        """Add a row to chart, only if wasn't already there"""
-        if row not in self.rows:
-            self.rows.append(row)
+        """Add a row to chart, only if wasn't already there.
+        Otherwise its derivation is packed into the existing row.
+        Returns true if the row was added"""
+        existing = self.keys.get(row)
+        if existing is not None:
+            if row.previous is not None or row.completing is not None:
+                self.add_derivation(existing, row.previous, row.completing)
+            return False
+        self.keys[row] = row
+        self.rows.append(row)
+        next_cat = row.next_category()
+        if next_cat is not None:
+            self.waiting.setdefault(next_cat, []).append(row)
+        return True
+
+    def add_derivation(self, row, previous, completing):
+        """Add another way of deriving a row, unless the row already has it
+        or it would make the row derive itself (through unit or empty rules).
+        Only children spanning the same words as the row can derive it"""
+        if previous is not None and self.keys.get(previous) is previous:
+            # completing derives no words, the parser may find such a derivation twice
+            for p, c in row.derivations:
+                if p is previous and c is completing:
+                    return
+            if self.derives(previous, row):
+                return
+        if completing is not None and completing.start == row.start and self.derives(completing, row):
+            return
+        row.derivations.append((previous, completing))
+
+    def derives(self, source, target):
+        """Returns true if the target row is part of a derivation of the source row.
+        Only rows of this chart with the target's start can be, as they span the same words"""
+        todo, seen = [source], set()
+        while todo:
+            row = todo.pop()
+            if row is target:
+                return True
+            if row.start != target.start or self.keys.get(row) is not row or id(row) in seen:
+                continue
+            seen.add(id(row))
+            for derivation in row.derivations:
+                todo.extend(child for child in derivation if child is not None)
+        return False
+
+    def rows_waiting_for(self, category):
+        """Rows whose next category is the given one, in chart order"""
+        return self.waiting.get(category, ())
 
 
 class ChartRow:
@@ -30,6 +83,10 @@ class ChartRow:
         self.start = start
         self.completing = completing
         self.previous = previous
+        # (previous, completing) pairs, one for every way of deriving the row
+        self.derivations = [(previous, completing)]
+        self.key = (rule, dot, start)
+        self.hash = hash(self.key)
 
     def __len__(self):
         """A chart's length is its rule's length"""
@@ -47,21 +104,21 @@ class ChartRow:
 
     def __eq__(self, other):
         """Two rows are equal if they share the same rule, start and dot"""
-        if len(self) == len(other):
-            if self.dot == other.dot:
-                if self.start == other.start:
-                    if self.rule == other.rule:
-                        return True
-        return False
+        return self.key == other.key
+
+    def __hash__(self):
+        """Rows are hashed by their rule, dot and start, like equality"""
+        return self.hash
 
     def is_complete(self):
         """Returns true if rule was completely parsed, i.e. the dot is at the end"""
-        return len(self) == self.dot
+        return len(self.rule.rhs) == self.dot
 
     def next_category(self):
         """Return next category to parse, i.e. the one after the dot"""
-        if self.dot < len(self):
-            return self.rule[self.dot]
+        rhs = self.rule.rhs
+        if self.dot < len(rhs):
+            return rhs[self.dot]
         return None
 
     def prev_category(self):
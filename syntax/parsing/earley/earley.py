@@ -2,7 +2,7 @@ import sys
 from .grammar import Grammar
 from .sentence import Sentence, Word  # @UnusedImport
 from .parser import Parser
-from .parse_trees import ParseTrees
+from .parse_trees import ParseTrees, first_derivation, no_unit_cycles, left_associative, prefer
 
 
 def run():
@@ -6,6 +6,7 @@ class Rule:
         """Initializes grammar rule: LHS -> [RHS]"""
         self.lhs = lhs
         self.rhs = rhs
+        self.hash = hash((lhs, tuple(rhs)))
 
     def __len__(self):
         """A rule's length is its RHS's length"""
@@ -21,11 +22,17 @@ class Rule:
 
     def __eq__(self, other):
         """Rules are equal iff both their sides are equal"""
+        if self is other:
+            return True
         if self.lhs == other.lhs:
             if self.rhs == other.rhs:
                 return True
         return False
 
+    def __hash__(self):
+        """Rules are hashed by both their sides, like equality"""
+        return self.hash
+
 
 class Grammar:
     def __init__(self):
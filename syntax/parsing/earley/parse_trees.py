@@ -2,49 +2,164 @@ from final.syntax.tree import Tree
 
 
 class ParseTrees:
-    def __init__(self, parser):
-        """Initialize a syntax tree parsing process"""
+    def __init__(self, parser, filters=()):
+        """Initialize a syntax tree parsing process.
+        The complete chart rows form a shared packed parse forest: every row keeps
+        all of its derivations, so trees are only built when asked for.
+        Filters take a row and its derivations and return the ones to keep"""
         self.parser = parser
         self.charts = parser.charts
         self.length = len(parser)
+        self.filters = list(filters)
+        self.roots = list(parser.complete_parses)
 
-        self.nodes = []
-        for root in parser.complete_parses:
-            self.nodes.extend(self.build_nodes(root))
+        self._derivations = {}  # id(row) -> derivations that pass the filters
+        self._counts = {}  # id(row) -> number of trees of the row
 
     def __len__(self):
-        """Trees count"""
-        return len(self.nodes)
+        """Trees count, computed on the forest without building the trees"""
+        return sum(self.count(root) for root in self.roots)
+
+    def __iter__(self):
+        """Builds the trees one at a time"""
+        for root in self.roots:
+            for k in range(self.count(root)):
+                yield self.build_tree(root, k)
 
     def __repr__(self):
         """String representation of a list of trees with indexes"""
         return "<Parse Trees>\n{0}</Parse Trees>".format(
             "\n".join(
-                "Parse tree #{0}:\n{1}\n\n".format(i + 1, str(self.nodes[i]))
-                for i in range(len(self))
+                "Parse tree #{0}:\n{1}\n\n".format(i + 1, str(tree))
+                for i, tree in enumerate(self)
             )
         )
 
-    def build_nodes(self, root):
-        """Recursively create subtree for given parse chart row"""
-        # find subtrees of current symbol
-        if root.completing:
-            down = self.build_nodes(root.completing)
-        elif root.dot > 0:
-            down = [Tree(root.prev_category())]
-        else:
-            down = []
-
-        # prepend subtrees of previous symbols
-        prev = root.previous
-        left = []
-        if prev:
-            left[:0] = [x.subtrees for x in self.build_nodes(prev)]
-            prev = prev.previous
-        else:
-            left = [[]]
-
-        for x in left:
-            x.extend(down)
-
-        return [Tree(root.rule.lhs, subtrees) for subtrees in left]
+    @property
+    def nodes(self):
+        """All the trees (there may be exponentially many, prefer tree(k))"""
+        return list(self)
+
+    def tree(self, k=0):
+        """Returns the k-th parse tree, building only that tree"""
+        for root in self.roots:
+            n = self.count(root)
+            if k < n:
+                return self.build_tree(root, k)
+            k -= n
+        raise IndexError("parse tree index out of range")
+
+    def derivations(self, row):
+        """Derivations of a row that pass the filters"""
+        key = id(row)
+        if key not in self._derivations:
+            derivations = row.derivations
+            for f in self.filters:
+                derivations = f(row, derivations)
+            self._derivations[key] = list(derivations)
+        return self._derivations[key]
+
+    def count(self, row):
+        """Number of trees of a row: the sum over its derivations of the
+        product of the numbers of trees of their children (iterative)"""
+        if row is None:
+            return 1
+        todo = [row]
+        while todo:
+            top = todo[-1]
+            if id(top) in self._counts:
+                todo.pop()
+                continue
+            children = [child for derivation in self.derivations(top) for child in derivation
+                        if child is not None and id(child) not in self._counts]
+            if children:
+                todo.extend(children)  # the forest is acyclic, see Chart.add_derivation
+                continue
+            todo.pop()
+            self._counts[id(top)] = sum(self.count_of(p) * self.count_of(c) for p, c in self.derivations(top))
+        return self._counts[id(row)]
+
+    def count_of(self, row):
+        """Number of trees of an already counted row"""
+        return 1 if row is None else self._counts[id(row)]
+
+    def pick(self, row, k):
+        """The derivation of the k-th tree of a row, with the indexes of
+        the trees of its previous and completing rows"""
+        for previous, completing in self.derivations(row):
+            n_completing = self.count(completing)
+            n = self.count(previous) * n_completing
+            if k < n:
+                return previous, completing, k // n_completing, k % n_completing
+            k -= n
+        raise IndexError("parse tree index out of range")
+
+    def children(self, row, k):
+        """The subtrees of the k-th tree of a row, following its previous rows:
+        leaves for scanned words and (row, index) pairs for completed categories"""
+        down = []
+        while row is not None:
+            previous, completing, k, k_completing = self.pick(row, k)
+            if completing is not None:
+                down.append((completing, k_completing))
+            elif row.dot > 0:
+                down.append(Tree(row.prev_category()))
+            row = previous
+        down.reverse()
+        return down
+
+    def build_tree(self, root, k):
+        """Builds the k-th tree of a complete row (iterative)"""
+        tree = Tree(root.rule.lhs)
+        todo = [(tree, root, k)]
+        while todo:
+            node, row, k = todo.pop()
+            for child in self.children(row, k):
+                if isinstance(child, Tree):
+                    node.subtrees.append(child)
+                else:
+                    subtree = Tree(child[0].rule.lhs)
+                    node.subtrees.append(subtree)
+                    todo.append((subtree, *child))
+        return tree
+
+
+def first_derivation(row, derivations):
+    """Filter keeping the derivation found first, i.e. one tree per row"""
+    return derivations[:1]
+
+
+def no_unit_cycles(row, derivations):
+    """Filter dropping a unit rule A -> B completed by B -> A,
+    a detour that derives the same words again"""
+    if len(row.rule) != 1:
+        return derivations
+    return [(p, c) for p, c in derivations
+            if c is None or len(c.rule) != 1 or c.rule[0] != row.rule.lhs]
+
+
+def left_associative(lhs):
+    """Filter making the rules lhs -> lhs ... lhs group to the left,
+    by dropping derivations whose last child is the same rule"""
+
+    def accept(row, derivations):
+        rule = row.rule
+        if rule.lhs != lhs or len(rule) < 2 or rule[0] != lhs or rule[-1] != lhs or not row.is_complete():
+            return derivations
+        return [(p, c) for p, c in derivations if c is None or c.rule != rule]
+
+    return accept
+
+
+def prefer(lhs, rhs):
+    """Filter choosing the rule lhs -> rhs (e.g. prefer("E", "E1")) over the
+    other rules of lhs, where they derive the same words of a row"""
+    rhs = rhs.split()
+
+    def accept(row, derivations):
+        preferred = {c.start for p, c in derivations
+                     if c is not None and c.rule.lhs == lhs and c.rule.rhs == rhs}
+        return [(p, c) for p, c in derivations
+                if c is None or c.rule.lhs != lhs or c.rule.rhs == rhs or c.start not in preferred]
+
+    return accept
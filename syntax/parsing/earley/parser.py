@@ -38,50 +38,52 @@ class Parser:
             for rule in rules:
                 chart.add_row(ChartRow(rule, 1, position - 1))
 
-    def predict(self, chart, position):
+    def predict(self, chart, row, position):
         """Predict next parse by looking up grammar rules
-        for pending categories in current chart"""
-        for row in chart.rows:
-            next_cat = row.next_category()
-            rules = self.grammar[next_cat]
-            if rules:
-                for rule in rules:
-                    new = ChartRow(rule, 0, position)
-                    chart.add_row(new)
+        for the pending category of a row (once per chart).
+        If the category was already derived from no words at this
+        position, the row is promoted over it right away (Aycock-Horspool),
+        as completing that empty row did not see this row yet"""
+        next_cat = row.next_category()
+        for empty in chart.nullable.get(next_cat, ()):
+            chart.add_row(ChartRow(row.rule, row.dot + 1, row.start, row, empty))
+        if next_cat in chart.predicted:
+            return
+        chart.predicted.add(next_cat)
+        rules = self.grammar[next_cat]
+        if rules:
+            for rule in rules:
+                new = ChartRow(rule, 0, position)
+                chart.add_row(new)
 
-    def complete(self, chart, position):
+    def complete(self, chart, row, position):
         """Complete a rule that was done parsing, and
         promote previously pending rules"""
-        for row in chart.rows:
-            if row.is_complete():
-                completed = row.rule.lhs
-                for r in self.charts[row.start].rows:
-                    if completed == r.next_category():
-                        new = ChartRow(r.rule, r.dot + 1, r.start, r, row)
-                        chart.add_row(new)
+        completed = row.rule.lhs
+        if row.start == position:
+            chart.nullable.setdefault(completed, []).append(row)
+        for r in self.charts[row.start].rows_waiting_for(completed):
+            new = ChartRow(r.rule, r.dot + 1, r.start, r, row)
+            chart.add_row(new)
 
     def parse(self):
         """Main Earley's Parser loop"""
         self.init_first_chart()
 
-        i = 0
         # we go word by word
-        while i < len(self.charts):
-            chart = self.charts[i]
+        for i, chart in enumerate(self.charts):
             self.prescan(chart, i)  # scan current input
 
-            # predict & complete loop
-            # rinse & repeat until chart stops changing
-            length = len(chart)
-            old_length = -1
-            while old_length != length:
-                self.predict(chart, i)
-                self.complete(chart, i)
-
-                old_length = length
-                length = len(chart)
-
-            i += 1
+            # the rows of the chart are its agenda: rows are only appended,
+            # and every row is predicted or completed exactly once
+            j = 0
+            while j < len(chart.rows):
+                row = chart.rows[j]
+                if row.is_complete():
+                    self.complete(chart, row, i)
+                else:
+                    self.predict(chart, row, i)
+                j += 1
 
         # finally, print charts for debuggers
         if self.debug:
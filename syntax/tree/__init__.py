@@ -1,4 +1,5 @@
 class Tree:
+    __slots__ = ("root", "subtrees", "info")
 
     def __init__(self, root, subtrees=None):
         self.root = root
@@ -6,6 +7,7 @@ class Tree:
             self.subtrees = []
         else:
             self.subtrees = subtrees
+        self.info = None  # analysis results cached by clients, not part of the tree's value
 
     def __eq__(self, other):
         if not isinstance(other, Tree):
@@ -41,29 +43,27 @@ class Tree:
     def reconstruct(cls, t):
         return cls(t.root, [cls.reconstruct(s) for s in t.subtrees])
 
+    def iter_nodes(self, prune=None):
+        """Lazy pre-order iteration, not below the nodes for which prune returns true."""
+        return iter(PreorderWalk(self, prune))
+
     @property
     def nodes(self):
-        return list(PreorderWalk(self))
+        return list(self.iter_nodes())
 
     @property
     def leaves(self):
-        return [n for n in PreorderWalk(self) if not n.subtrees]
+        return [n for n in self.iter_nodes() if not n.subtrees]
 
     @property
     def terminals(self):
         """@return a list of the values located at the leaf nodes."""
-        return [n.root for n in self.leaves]
+        return [n.root for n in self.iter_nodes() if not n.subtrees]
 
     @property
     def depth(self):
         """Computes length of longest branch (iterative version)."""
-        stack = [(0, self)]
-        max_depth = 0
-        while stack:
-            depth, top = stack[0]
-            max_depth = max(depth, max_depth)
-            stack[:1] = [(depth + 1, x) for x in top.subtrees]
-        return max_depth
+        return max(depth for depth, _ in PreorderWalk(self).with_depth())
 
     def split(self, separator=None):
         if separator is None:
@@ -74,6 +74,83 @@ class Tree:
             return [self]
 
 
+class FrozenTree(Tree):
+    """An immutable tree: the subtrees are a tuple and the structural hash is
+    computed once, from the cached hashes of the subtrees."""
+
+    __slots__ = ("hash",)
+
+    def __init__(self, root, subtrees=()):
+        subtrees = tuple(subtrees)
+        object.__setattr__(self, "root", root)
+        object.__setattr__(self, "subtrees", subtrees)
+        object.__setattr__(self, "hash", hash((root, subtrees)))
+        object.__setattr__(self, "info", None)
+
+    def __setattr__(self, name, value):
+        if name != "info":
+            raise AttributeError("FrozenTree is immutable, use thaw() for a mutable copy")
+        object.__setattr__(self, name, value)
+
+    def __reduce__(self):
+        return FrozenTree, (self.root, self.subtrees)
+
+    def __eq__(self, other):
+        if self is other:
+            return True
+        if isinstance(other, FrozenTree) and self.hash != other.hash:
+            return False
+        return Tree.__eq__(self, other)
+
+    def __hash__(self):
+        return self.hash
+
+    def thaw(self):
+        """@return a mutable copy of the tree."""
+        return Tree.reconstruct(self)
+
+
+class TreeInterner:
+    """Hash-consing of trees: equal (sub)trees interned by the same interner
+    become one FrozenTree object, so analyses of subtrees can be memoized by
+    identity, and repeated subtrees (e.g. unrolled loop bodies) are stored once."""
+
+    def __init__(self):
+        self.table = {}  # (root type, root, ids of interned subtrees) -> FrozenTree
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.table)
+
+    def __call__(self, tree):
+        return self.intern(tree)
+
+    def intern(self, tree):
+        """Bottom-up (iterative), so every node is looked up by its root and the
+        identities of its already interned subtrees."""
+        done = {}  # id(node) -> interned node
+        stack = [(tree, False)]
+        while stack:
+            top, expanded = stack.pop()
+            if id(top) in done:
+                continue
+            if not expanded:
+                stack.append((top, True))
+                stack.extend((x, False) for x in top.subtrees if id(x) not in done)
+                continue
+            subtrees = tuple(done[id(x)] for x in top.subtrees)
+            key = (type(top.root), top.root, tuple(id(x) for x in subtrees))
+            node = self.table.get(key)
+            if node is None:
+                node = self.table[key] = FrozenTree(top.root, subtrees)
+                self.misses += 1
+            else:
+                self.hits += 1
+            done[id(top)] = node
+        return done[id(tree)]
+
+
 # @deprecated: clients should use .tree.walk.RichTreeWalk instead
 from .walk import PreorderWalk, RichTreeWalk as Walk
 
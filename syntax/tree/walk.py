@@ -1,9 +1,15 @@
 """
 Traditional tree walks:
 - Pre-order walk
-- Post-order walk [not implemented yet]
+- Post-order walk
+- Level-order (breadth-first) walk
 - In-order walk - for binary trees [not implemented yet]
+
+The walks are iterative and linear in the size of the tree. A prune callback
+can stop a walk from descending below a node (the node itself is still
+visited), and with_depth() yields (depth, node) pairs.
 """
+from collections import deque
 
 
 class TreeWalk:
@@ -14,8 +20,9 @@ class TreeWalk:
         def done(self):
             return None
 
-    def __init__(self, tree):
+    def __init__(self, tree, prune=None):
         self.tree = tree
+        self.prune = prune
 
     def __call__(self, visitor):
         for x in self:
@@ -23,30 +30,49 @@ class TreeWalk:
         return visitor.done()
 
     def __iter__(self):
+        return (node for _, node in self.with_depth())
+
+    def with_depth(self):
         raise NotImplementedError
 
+    def children(self, node):
+        if self.prune is not None and self.prune(node):
+            return ()
+        return node.subtrees
+
 
 class PreorderWalk(TreeWalk):
 
-    def __iter__(self):
-        stack = [self.tree]
+    def with_depth(self):
+        stack = [(0, self.tree)]
         while stack:
-            top = stack[0]
-            yield top
-            stack[:1] = top.subtrees
+            depth, top = stack.pop()
+            yield depth, top
+            stack.extend((depth + 1, x) for x in reversed(self.children(top)))
 
 
 class PostorderWalk(TreeWalk):
 
-    def __iter__(self):
+    def with_depth(self):
         DOWN, UP = 0, 1
-        stack = [(DOWN, self.tree)]
+        stack = [(DOWN, 0, self.tree)]
         while stack:
-            direction, top = stack.pop()
+            direction, depth, top = stack.pop()
             if direction == UP:
-                yield top
+                yield depth, top
             else:
-                stack += [(UP, top)] + [(DOWN, x) for x in top.subtrees]
+                stack.append((UP, depth, top))
+                stack.extend((DOWN, depth + 1, x) for x in reversed(self.children(top)))
+
+
+class LevelorderWalk(TreeWalk):
+
+    def with_depth(self):
+        queue = deque([(0, self.tree)])
+        while queue:
+            depth, top = queue.popleft()
+            yield depth, top
+            queue.extend((depth + 1, x) for x in self.children(top))
 
 
 class RichTreeWalk:
@@ -117,3 +143,6 @@ if __name__ == "__main__":
         tree = TreeAssistant.build(input)
         print(tree)
         print([x.root for x in PreorderWalk(tree)])
+        print([x.root for x in PostorderWalk(tree)])
+        print([(d, x.root) for d, x in LevelorderWalk(tree).with_depth()])
+        print([x.root for x in PreorderWalk(tree, prune=lambda x: x.root == 2)])
@@ -1,6 +1,7 @@
+import functools
 import typing
 from final.syntax.tree import Tree
-from final.syntax.parsing.earley.earley import Grammar, Parser, ParseTrees
+from final.syntax.parsing.earley.earley import Grammar, Parser, ParseTrees, no_unit_cycles, left_associative, prefer
 from final.syntax.parsing.silly import SillyLexer
 
 _all_ = ["parse"]
@@ -20,7 +21,7 @@ class WhileParser:
     )
 
     GRAMMAR = r"""
-    S   ->   S1     |   S1 ; S
+    S   ->   S1     |   S ; S1                                # a list, Earley parses left recursion in linear time
     S1  ->   skip   |   id := E   |   if E then S else S1   |   while E do S1 | assert E
     S1  ->   id := lbracket num_list rbracket               # Array initialization
     S1  ->   id lbracket E rbracket array_indices := E                          # Array update with nested indices
@@ -35,6 +36,9 @@ class WhileParser:
     num_list ->  E  | num_list comma num_list |  lbracket num_list rbracket
     """
 
+    # disambiguation of the parse forest: [...] lists group to the left, and id := [...] is an array initialization
+    FILTERS = [no_unit_cycles, left_associative("num_list"), prefer("S1", "id := lbracket num_list rbracket")]
+
     def __init__(self) -> None:
         self.tokenizer = SillyLexer(self.TOKENS)
         self.grammar = Grammar.from_string(self.GRAMMAR)
@@ -46,24 +50,50 @@ class WhileParser:
         earley.parse()
 
         if earley.is_valid_sentence():
-            trees = ParseTrees(earley)
+            trees = ParseTrees(earley, self.FILTERS)
             assert len(trees) == 1
-            return self.postprocess(trees.nodes[0])
+            return self.postprocess(trees.tree())
         else:
             return None
 
     def postprocess(self, t: Tree) -> Tree:
+        """Turns a parse tree into an abstract syntax tree. Iterative, as the parse trees of long programs are
+        deeper (one level per statement) than the recursion limit: every node is rewritten by rewrite() once
+        its subtrees are."""
+        results = []  # the rewritten subtrees of the nodes on the stack, in order
+        stack = [(t, None, 0)]
+        while stack:
+            node, build, count = stack.pop()
+            if build is None:
+                subtrees, build = self.rewrite(node)
+                stack.append((node, build, len(subtrees)))
+                stack.extend((subtree, None, 0) for subtree in reversed(subtrees))
+            else:
+                rewritten = results[len(results) - count:]
+                del results[len(results) - count:]
+                results.append(build(rewritten))
+        return results[0]
 
-        if t.root == "E0" and len(t.subtrees) == 5 and t.subtrees[4].root == "array_indices":
-            return Tree("array_access", [self.postprocess(s) for s in [t.subtrees[0], t.subtrees[2], t.subtrees[4]]])
-
+    def rewrite(self, t: Tree) -> tuple:
+        """The subtrees of a parse tree node to postprocess, and how to build its abstract syntax tree from them."""
 
+        if t.root == "E0" and len(t.subtrees) == 5 and t.subtrees[4].root == "array_indices":
+            return [t.subtrees[0], t.subtrees[2], t.subtrees[4]], lambda s: Tree("array_access", s)
 
         elif t.root == "S1" and len(t.subtrees) == 7 and t.subtrees[4].root == "array_indices":
-            return Tree("array_update", [self.postprocess(s) for s in [t.subtrees[0], t.subtrees[2], t.subtrees[4], t.subtrees[6]]])
+            return [t.subtrees[0], t.subtrees[2], t.subtrees[4], t.subtrees[6]], lambda s: Tree("array_update", s)
 
         elif t.root in ["γ", "S", "S1", "E", "E0"] and len(t.subtrees) == 1:
-            return self.postprocess(t.subtrees[0])
+            return [t.subtrees[0]], lambda s: s[0]
+
+        # a statement list, parsed to the left: rebuilt as nested to the right, s1; (s2; (... ; sn))
+        elif t.root == "S" and len(t.subtrees) == 3:
+            statements = []
+            while t.root == "S" and len(t.subtrees) == 3:
+                statements.append(t.subtrees[2])
+                t = t.subtrees[0]
+            statements.append(t)
+            return statements[::-1], self.sequence
 
         # Handle assignment and operations
         elif (
@@ -71,70 +101,123 @@ class WhileParser:
                 and len(t.subtrees) == 3
                 and t.subtrees[1].root in [":=", ";", "op"]
         ):
-            return Tree(
-                t.subtrees[1].subtrees[0].root,
-                [self.postprocess(s) for s in [t.subtrees[0], t.subtrees[2]]],
-            )
+            return [t.subtrees[0], t.subtrees[2]], lambda s: Tree(t.subtrees[1].subtrees[0].root, s)
 
         elif len(t.subtrees) == 3 and t.subtrees[0].root == "(":
-            return self.postprocess(t.subtrees[1])
+            return [t.subtrees[1]], lambda s: s[0]
 
         elif t.root == "S1" and t.subtrees[0].root in ["if", "while", "assert"]:
-            return self.postprocess(Tree(t.subtrees[0].root, t.subtrees[1::2]))
+            return t.subtrees[1::2], lambda s: Tree(t.subtrees[0].root, s)
 
         elif t.root == "num":
-            return Tree(t.root, [Tree(int(t.subtrees[0].root))])  # Parse ints
+            return [], lambda s: Tree(t.root, [Tree(int(t.subtrees[0].root))])  # Parse ints
 
         elif t.root == "hole":  # Parse hole
-            return Tree(t.root, [])
+            return [], lambda s: Tree(t.root, [])
 
         # Handle array initialization
         elif t.root == "S1" and len(t.subtrees) >= 4 and t.subtrees[2].root == "lbracket":
-            elements = [self.postprocess(sub) for sub in t.subtrees[3:-1] if sub.root != ","]
-            return Tree("array_init", [self.postprocess(t.subtrees[0]), Tree("elements", elements)])
+            elements = [sub for sub in t.subtrees[3:-1] if sub.root != ","]
+            return [t.subtrees[0], *elements], lambda s: Tree("array_init", [s[0], Tree("elements", s[1:])])
 
         # Handle nested array access with multiple indices
         elif t.root == "E0" and t.subtrees[1].root == "lbracket":
-            array_var = self.postprocess(t.subtrees[0])
-            indices = self.collect_indices(t.subtrees[1:])  # Updated function
-            return Tree("array_access", [array_var] + indices)
+            return [t.subtrees[0], *self.collect_indices(t.subtrees[1:])], lambda s: Tree("array_access", s)
 
         # Handle nested array update
         elif t.root == "S1" and t.subtrees[1].root == "lbracket":
-            array_var = self.postprocess(t.subtrees[0])
-            indices = self.collect_indices(t.subtrees[1:-2])
-            value = self.postprocess(t.subtrees[-1])  # Updated value
-            return Tree("array_update", [array_var] + indices + [value])
+            # the array, its indices and the updated value
+            return ([t.subtrees[0], *self.collect_indices(t.subtrees[1:-2]), t.subtrees[-1]],
+                    lambda s: Tree("array_update", s))
 
         elif t.root == "array_indices":
-            # Handle array indices or nested brackets
-
-            indices = []
+            # Handle array indices or nested brackets: the expression inside the brackets for every index
+            indices = [t.subtrees[1] for subtree in t.subtrees if subtree.root == "lbracket"]
+            return indices, lambda s: Tree("array_indices", s)  # Return all collected indices as a node
 
-            for subtree in t.subtrees:
+        return t.subtrees, lambda s: Tree(t.root, s)
 
-                if subtree.root == "lbracket":  # Found start of index
+    # the statements as a right nested sequence
+    def sequence(self, statements: list) -> Tree:
+        tree = statements[-1]
+        for statement in reversed(statements[:-1]):
+            tree = Tree(";", [statement, tree])
+        return tree
 
-                    index_expr = self.postprocess(t.subtrees[1])  # Process inside brackets
-
-                    indices.append(index_expr)
-
-            return Tree("array_indices", indices)  # Return all collected indices as a node
-
-        return Tree(t.root, [self.postprocess(s) for s in t.subtrees])
-
-    # Helper function to collect all nested array indices
+    # Helper function to collect all nested array indices (the expressions inside the brackets)
     def collect_indices(self, subtrees: list) -> list:
         indices = []
         i = 0
         while i < len(subtrees):
             if subtrees[i].root == "lbracket":
-                indices.append(self.postprocess(subtrees[i + 1]))  # Process inside brackets
+                indices.append(subtrees[i + 1])  # the expression inside brackets
                 i += 3  # Move past 'lbracket E rbracket'
             else:
                 i += 1
         return indices
 
 
+# the parser is stateless between calls, so one instance (lexer regex and grammar built once) is shared
+@functools.cache
+def shared_parser() -> WhileParser:
+    return WhileParser()
+
+
 def parse(program_text: str) -> typing.Optional[Tree]:
-    return WhileParser()(program_text)
+    return shared_parser()(program_text)
+
+
+STATEMENTS = ("skip", ":=", "array_init", "array_update", "if", "while", "assert")
+
+
+def pretty(t: Tree) -> str:
+    """Formats a statement or an expression as program text."""
+    root = str(t.root)
+    if root in ("id", "num"):
+        return str(t.subtrees[0].root)
+    if root == "hole" or root.startswith("hole_"):
+        return "??" if root == "hole" else root
+    if root == "skip":
+        return "skip"
+    if root == ";":
+        return "%s; %s" % (pretty(t.subtrees[0]), pretty(t.subtrees[1]))
+    if root == ":=":
+        return "%s := %s" % (pretty(t.subtrees[0]), pretty(t.subtrees[1]))
+    if root == "if":
+        return "if %s then %s else %s" % (pretty(t.subtrees[0]), block(t.subtrees[1]), block(t.subtrees[2]))
+    if root == "while":
+        return "while %s do %s" % (pretty(t.subtrees[0]), block(t.subtrees[1]))
+    if root == "assert":
+        return "assert %s" % pretty(t.subtrees[0])
+    if root == "array_init":
+        return "%s := [%s]" % (pretty(t.subtrees[0]), pretty(t.subtrees[1].subtrees[0]))
+    if root == "array_update":
+        return "%s := %s" % ("".join(pretty(s) if i == 0 else "[%s]" % pretty(s) for i, s in
+                                     enumerate(t.subtrees[:-1])), pretty(t.subtrees[-1]))
+    if root == "array_access":
+        return "".join(pretty(s) if i == 0 else "[%s]" % pretty(s) for i, s in enumerate(t.subtrees))
+    if root == "array_indices":
+        return pretty(t.subtrees[0])
+    if root == "num_list":
+        return "".join(pretty(s) for s in t.subtrees)
+    if root in ("lbracket", "rbracket"):
+        return "[" if root == "lbracket" else "]"
+    if root == "comma":
+        return ", "
+    if len(t.subtrees) == 2:  # binary operator, operators nested in it are parenthesized
+        return " ".join([operand(t.subtrees[0]), root, operand(t.subtrees[1])])
+    return str(t)
+
+
+def block(t: Tree) -> str:
+    return "(%s)" % pretty(t) if t.root == ";" else pretty(t)
+
+
+def operand(t: Tree) -> str:
+    return "(%s)" % pretty(t) if len(t.subtrees) == 2 and t.root not in STATEMENTS + ("array_access",) else pretty(t)
+
+
+def statements(ast: Tree) -> list:
+    """The statements of a program (not the sequences), in the order of the program text."""
+    simple = ("skip", ":=", "array_init", "array_update", "assert")
+    return [node for node in ast.iter_nodes(prune=lambda n: n.root in simple) if node.root in STATEMENTS]